@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    The hosts the app answers to. Requests for any other host are proxy
+    probes or misrouted, see app.limit_open_proxy_requests.
+'''
+
+import os
+
+# Comma separated. hostname:port, hostname (any port) or *.domain (any subdomain)
+ALLOWED_HOSTS = os.environ.get('ALLOWED_HOSTS', '*.herokuapp.com,*.ngrok.io,localhost:8080,127.0.0.1,0.0.0.0:80')
+
+class HostAllowList(object):
+    """Patterns precompiled into sets, so a check costs a few set lookups
+    however many patterns there are.
+    """
+    def __init__(self, patterns=ALLOWED_HOSTS):
+        if isinstance(patterns, str):
+            patterns = patterns.split(',')
+        self._hosts = set()
+        self._domains = set()
+        for pattern in patterns:
+            pattern = pattern.strip().lower()
+            if pattern.startswith('*.'):
+                self._domains.add(pattern[2:])
+            elif pattern:
+                self._hosts.add(pattern)
+
+    def allows(self, host):
+        """host as in the Host header, with an optional port
+        """
+        host = host.lower()
+        if host in self._hosts:
+            return True
+        hostname = host.rsplit(':', 1)[0] if host.count(':') == 1 else host
+        if hostname in self._hosts:
+            return True
+        dot = hostname.find('.')
+        while dot != -1:
+            if hostname[dot + 1:] in self._domains:
+                return True
+            dot = hostname.find('.', dot + 1)
+        return False
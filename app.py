@@ -6,43 +6,154 @@ Description:
     Web app that generates beautiful order documents for ePages Beyond shops.
 '''
 
+import math
 import os
-import logging
 import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlencode, urlparse, unquote
 
-from flask import Flask, render_template, request, Response, abort, escape, jsonify
+from flask import Flask, render_template, request, Response, abort, escape, jsonify, g
+import requests
 
+from allowed_hosts import HostAllowList
 from app_installations import AppInstallations, PostgresAppInstallations
+from caches import TTLCache
+from http_cache import PrecomputedResponse, StaticAssets
 from shops import Shop, PostgresShops, get_shop_id
-from payment_method_definitions import create_payment_method
+from payment_method_definitions import AUTO_INSTALLED_PAYMENT_METHOD_DEFINITIONS, create_payment_method, payment_method_created
 import payments
-from signers import sign
+from payment_ledger import PENDING, CANCELED, CAPTURED, PostgresPaymentLedger
+from payment_results import PaymentResult, PostgresPaymentResults
+from provisioning import PostgresProvisionedPaymentMethods
+from circuit_breakers import HostUnavailable
+from load_shedding import LoadShedder
+from rate_limits import PostgresTokenBuckets, TokenBuckets
+from payment_tokens import create_payment_token, read_payment_token, verify_payment_token
+from signers import sign, verify, verify_bearer_token
+from token_refresher import TokenRefresher
+import json_codec
+import logs
+import metrics
+import migrations
+import profiling
 
 app = Flask(__name__)
+json_codec.init_app(app)
+# Routes must be added before the first request, which may run create_app
+profiling.init_app(app)
 
 APP_INSTALLATIONS = None
 SHOPS = None
+PROVISIONED_PAYMENT_METHODS = None
+PAYMENT_RESULTS = None
+PAYMENT_LEDGER = None
 CLIENT_SECRET = ''
 DEFAULT_HOSTNAME = ''
-LOGGER = logging.getLogger('app')
+LOGGER = logs.get_logger('app')
+REQUEST_LOGGER = logs.get_logger('app.requests')
+SIGNATURE_LOGGER = logs.get_logger('app.signatures')
+# Maximum number of concurrent Beyond API calls made by one install callback
+CALLBACK_CONCURRENCY = int(os.environ.get('CALLBACK_CONCURRENCY', '4'))
+# Bearer token required to scrape /metrics, if set
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+# Rendered pages that only depend on their template arguments
+PAGE_CACHE_SIZE = int(os.environ.get('PAGE_CACHE_SIZE', '1024'))
+PAGE_CACHE_SECONDS = int(os.environ.get('PAGE_CACHE_SECONDS', '300'))
+# Requests per second and burst allowed per shop on the payment routes, 0 disables the limit
+SHOP_RATE_LIMIT = float(os.environ.get('SHOP_RATE_LIMIT', '10'))
+SHOP_RATE_LIMIT_BURST = int(os.environ.get('SHOP_RATE_LIMIT_BURST', '20'))
+# Share the limits of all workers through Postgres instead of limiting per process
+SHOP_RATE_LIMIT_SHARED = os.environ.get('SHOP_RATE_LIMIT_SHARED', '').lower() == 'true'
+# See load_shedding.py, 0 disables a limit. Threaded workers can't have more
+# requests in flight than threads, so by default only the queue time counts.
+SHED_MAX_IN_FLIGHT = int(os.environ.get('SHED_MAX_IN_FLIGHT', '0'))
+SHED_MAX_QUEUE_SECONDS = float(os.environ.get('SHED_MAX_QUEUE_SECONDS', '10'))
+SHED_RETRY_AFTER = int(os.environ.get('SHED_RETRY_AFTER', '1'))
+
+PAGE_CACHE = TTLCache(maxsize=PAGE_CACHE_SIZE, ttl=PAGE_CACHE_SECONDS)
+STATIC_ASSETS = None
+HOST_ALLOW_LIST = HostAllowList()
+LOAD_SHEDDER = LoadShedder(SHED_MAX_IN_FLIGHT, SHED_MAX_QUEUE_SECONDS)
+SHOP_RATE_LIMITS = None
+
+# Constant responses, serialized once
+MERCHANT_ACCOUNT_STATUS = PrecomputedResponse.json({
+    'ready' : True,
+    'details' : {
+        'primaryEmail' : 'example@b.c'
+    }
+})
+CAPTURE_RESULTS = dict((state, PrecomputedResponse.json({'paymentStatus' : state})) for state in (CAPTURED, CANCELED))
+NOT_FOUND = PrecomputedResponse.html('<h1>404 File Not Found! :(</h1>', status=404)
+
+REQUEST_SECONDS = metrics.histogram('http_request_duration_seconds', 'Duration of requests per route', ['route', 'method', 'status'])
+REQUESTS_SHED = metrics.counter('http_requests_shed_total', 'Requests turned away before doing any work', ['route', 'reason'])
 
-AUTO_INSTALLED_PAYMENT_METHOD_DEFINITIONS = [
-    'beautiful-test-payment-embedded',
-    'beautiful-test-payment-embedded-selection',
-    'beautiful-test-payment-capture-on-demand'
-]
+_init_lock = threading.Lock()
+_initialized = False
+
+@app.before_request
+def ensure_initialized():
+    # For servers importing app instead of calling create_app
+    if not _initialized:
+        create_app()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.observe(time.perf_counter() - started, route=route, method=request.method, status=response.status_code)
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if METRICS_TOKEN and not verify_bearer_token(request.headers.get('Authorization', ''), METRICS_TOKEN):
+        return Response('Forbidden', status=403)
+    return Response(metrics.exposition(), mimetype='text/plain; version=0.0.4')
+
+@app.url_defaults
+def hashed_static_urls(endpoint, values):
+    if endpoint == 'static' and STATIC_ASSETS is not None:
+        values['filename'] = STATIC_ASSETS.url_filename(values['filename'])
+
+@app.endpoint('static')
+def static_file(filename):
+    asset = STATIC_ASSETS.get(filename)
+    if asset is None:
+        abort(404)
+    return precomputed(asset)
+
+def precomputed(response):
+    body, status, headers = response.parts(request.headers)
+    return Response(body, status=status, headers=headers)
+
+def render_cached(template_name, **context):
+    ''' render_template for pages that only depend on their arguments
+    '''
+    key = (request.script_root, template_name, tuple(sorted(context.items())))
+    page = PAGE_CACHE.get(key)
+    if page is None:
+        page = render_template(template_name, **context)
+        PAGE_CACHE.set(key, page)
+    return page
 
 @app.route('/')
 def root():
     if DEFAULT_HOSTNAME != '':
-        return render_template('index.html', installed=True, hostname=DEFAULT_HOSTNAME)
-    return render_template('index.html', installed=False)
+        return render_cached('index.html', installed=True, hostname=DEFAULT_HOSTNAME)
+    return render_cached('index.html', installed=False)
 
 
 @app.route('/<hostname>')
 def root_hostname(hostname):
-    return render_template('index.html', installed=True, hostname=hostname)
+    return render_cached('index.html', installed=True, hostname=hostname)
 
 @app.route('/callback')
 def callback():
@@ -53,30 +164,48 @@ def callback():
     code = args.get('code')
     signature = unquote(args.get('signature'))
 
-    APP_INSTALLATIONS.retrieve_token_from_auth_code(api_url, code, access_token_url, signature)
+    installation = APP_INSTALLATIONS.install_from_auth_code(api_url, code, access_token_url, signature)
 
-    hostname = urlparse(api_url).hostname
-    installation = get_installation(hostname)
-
-    created_payment_methods = _auto_create_payment_methods(installation)
-    _get_and_store_shop_id(installation)
+    # The payment methods and the shop id lookup don't depend on each other
+    with ThreadPoolExecutor(max_workers=CALLBACK_CONCURRENCY) as executor:
+        shop_id_stored = executor.submit(_get_and_store_shop_id, installation)
+        created_payment_methods = _auto_create_payment_methods(installation, executor)
+        shop_id_error = _error_of(shop_id_stored)
+    PROVISIONED_PAYMENT_METHODS.record(installation.hostname, [created['payment_method_definition_name'] for created in created_payment_methods
+                                                               if payment_method_created(created['status_code'])])
 
     return render_template('callback_result.html',
                             return_url=return_url,
-                            created_payment_methods=created_payment_methods)
+                            created_payment_methods=created_payment_methods,
+                            shop_id_error=shop_id_error)
+
+def _auto_create_payment_methods(installation, executor):
+    futures = [(pmd_name, executor.submit(create_payment_method, installation, pmd_name))
+               for pmd_name in AUTO_INSTALLED_PAYMENT_METHOD_DEFINITIONS]
 
-def _auto_create_payment_methods(installation):
     created_payment_methods = []
-    for pmd_name in AUTO_INSTALLED_PAYMENT_METHOD_DEFINITIONS:
-        status = create_payment_method(installation, pmd_name)
+    for pmd_name, future in futures:
+        error = _error_of(future)
+        status = None if error else future.result()
         created_payment_methods.append({
             'status_code': status,
-            'payment_method_definition_name': pmd_name
+            'payment_method_definition_name': pmd_name,
+            'error': error
         })
-        print('Created payment method for %s in shop %s with status %i' % (pmd_name, installation.hostname, status))
+        if error:
+            LOGGER.warning('Creating payment method failed', payment_method_definition=pmd_name, hostname=installation.hostname, error=error)
+        else:
+            LOGGER.info('Created payment method', payment_method_definition=pmd_name, hostname=installation.hostname, status=status)
 
     return created_payment_methods
 
+def _error_of(future):
+    error = future.exception()
+    if error is not None:
+        LOGGER.error('Install callback step failed', exc_info=error)
+        return str(error) or error.__class__.__name__
+    return None
+
 def _get_and_store_shop_id(installation):
     shop_id = get_shop_id(installation)
     shop = Shop(shop_id, installation.hostname)
@@ -84,17 +213,15 @@ def _get_and_store_shop_id(installation):
 
 @app.route('/merchants/<shop_id>')
 def merchant_account_status(shop_id):
-    print('Serving always ready merchant account status')
-    return jsonify({
-        'ready' : True,
-        'details' : {
-            'primaryEmail' : 'example@b.c'
-        }
-    })
+    REQUEST_LOGGER.info('Serving always ready merchant account status', shop_id=shop_id)
+    return precomputed(MERCHANT_ACCOUNT_STATUS)
 
 @app.route('/payments', methods=['POST'])
 def create_payment():
-    print('Creating payment with paymentNote')
+    REQUEST_LOGGER.info('Creating payment with paymentNote')
+    payload = request.get_json(force=True, silent=True) or {}
+    if payload.get('paymentId'):
+        PAYMENT_LEDGER.record(payload['paymentId'], PENDING, payload.get('shopId'))
     return jsonify({
         'paymentNote': 'Please transfer the money using the reference %s to the account %s' % (generate_id(), generate_id()),
     })
@@ -115,8 +242,12 @@ def create_embedded_payment():
         'shop': shop,
         'shopId': shop_id
     }
+    known_shop = SHOPS.get_shop(shop_id)
+    if known_shop:
+        params['token'] = create_payment_token(shop_id, known_shop.hostname, payment_id, CLIENT_SECRET)
     embeddedApprovalUri = 'https://%s/embedded-payment-approval?%s' % (app_hostname, urlencode(params))
-    print('Created embedded payment for shop %s' % shop)
+    PAYMENT_LEDGER.record(payment_id, PENDING, shop_id)
+    REQUEST_LOGGER.info('Created embedded payment', shop=shop, shop_id=shop_id, payment_id=payment_id)
     return jsonify({
         'embeddedApprovalUri': embeddedApprovalUri
     })
@@ -128,69 +259,146 @@ def embedded_payment_approval():
     signature = unquote(args.get('signature', ''))
     shop = unquote(args.get('shop', ''))
     shop_id = unquote(args.get('shopId', ''))
+    token = unquote(args.get('token', ''))
     approve_uri = '/payments/%s/approve' % payment_id
     cancel_uri = '/payments/%s/cancel' % payment_id
 
-    if _validate_signature(signature, shop_id, payment_id):
+    if token:
+        payment_token = read_payment_token(token, CLIENT_SECRET)
+        if payment_token is not None and (payment_token.payment_id, payment_token.shop_id) != (payment_id, shop_id):
+            # The page would show another payment or shop than the form approves
+            return Response('Bad Request', status=400)
+        valid = payment_token is not None
+    else:
+        valid = _validate_signature(signature, shop_id, payment_id)
+    if valid:
         return render_template('embedded_payment_approval.html',
                             state='PENDING',
                             signature=signature,
+                            token=token,
                             shop=shop,
                             shop_id=shop_id,
                             approve_uri=approve_uri,
                             cancel_uri=cancel_uri)
-    return render_template('embedded_payment_approval.html',
-                            state='ERROR')
+    return render_cached('embedded_payment_approval.html', state='ERROR')
 
 def _validate_signature(signature_to_validate, shop_id, payment_id):
-    expected_signature = sign('%s:%s' % (shop_id, payment_id), CLIENT_SECRET)
-    match = signature_to_validate == expected_signature
-    print('Validated signatures: %s | %s | match: %s' % (signature_to_validate, expected_signature, str(match)))
+    match = verify('%s:%s' % (shop_id, payment_id), signature_to_validate, CLIENT_SECRET)
+    SIGNATURE_LOGGER.info('Validated signature', shop_id=shop_id, payment_id=payment_id, match=match)
     return match
 
 @app.route('/payments/<payment_id>/approve', methods=['POST'])
 def approve_payment(payment_id):
     ''' Currently only needed for embedded payments
     '''
-    print('Approving payment %s' % payment_id)
-
-    shop_id = request.form.get('shop_id', '')
-    signature = request.form.get('signature', '')
-    shop = SHOPS.get_shop(shop_id)
-    installation = get_installation(shop.hostname)
-
-    if _validate_signature(signature, shop_id, payment_id):
-        return_uri = payments.approve_payment(installation, payment_id)
-        return render_template('embedded_payment_approval.html',
-                            state='APPROVED',
-                            return_uri=return_uri)
-    return render_template('embedded_payment_approval.html',
-                            state='ERROR')
+    REQUEST_LOGGER.info('Approving payment', payment_id=payment_id)
+    return _complete_payment(payment_id, 'approve', payments.approve_payment, 'APPROVED')
 
 @app.route('/payments/<payment_id>/cancel', methods=['POST'])
 def cancel_payment(payment_id):
     ''' Currently only needed for embedded payments
     '''
-    print('Canceling payment %s' % payment_id)
-
-    shop_id = request.form.get('shop_id', '')
-    signature = request.form.get('signature', '')
-    shop = SHOPS.get_shop(shop_id)
-    installation = get_installation(shop.hostname)
+    REQUEST_LOGGER.info('Canceling payment', payment_id=payment_id)
+    return _complete_payment(payment_id, 'cancel', payments.cancel_payment, 'CANCELED')
 
-    if _validate_signature(signature, shop_id, payment_id):
-        return_uri = payments.cancel_payment(installation, payment_id)
-        return render_template('embedded_payment_approval.html',
-                            state='CANCELED',
-                            return_uri=return_uri)
+def _complete_payment(payment_id, action, call, state):
+    ''' Repeated requests for the same payment and action, e.g. double clicks,
+    get the result of the first one without calling Beyond again.
+    '''
+    find_installation = _authorize(payment_id)
+    if find_installation is None:
+        return render_cached('embedded_payment_approval.html', state='ERROR')
+
+    result = PAYMENT_RESULTS.cached(payment_id, action)
+    if result is None:
+        # Looked up before the payment is claimed, so the lease only
+        # has to cover the Beyond call
+        installation = find_installation()
+        result = PAYMENT_RESULTS.complete(payment_id, action, lambda: _complete(installation, payment_id, action, call, state))
     return render_template('embedded_payment_approval.html',
-                           state='ERROR')
+                            state=result.state,
+                            return_uri=result.return_uri)
+
+def _complete(installation, payment_id, action, call, state):
+    if installation is None:
+        return PaymentResult(payment_id, action, 'ERROR', completed=False)
+    try:
+        return_uri = call(installation, payment_id)
+    except HostUnavailable as e:
+        # Don't wait on a shop whose API is failing or overloaded
+        LOGGER.warning('Failing fast', payment_id=payment_id, action=action, hostname=e.hostname, reason=e.reason)
+        return PaymentResult(payment_id, action, 'ERROR', completed=False)
+    except requests.RequestException as e:
+        # Timeouts and connection errors left after the retries, not worth a 500
+        LOGGER.warning('Calling Beyond failed', payment_id=payment_id, action=action, error=str(e))
+        return PaymentResult(payment_id, action, 'ERROR', completed=False)
+    if return_uri is not None:
+        PAYMENT_LEDGER.record(payment_id, state)
+    return PaymentResult(payment_id, action, state, return_uri, completed=return_uri is not None)
+
+def _authorize(payment_id):
+    ''' Checks the credentials of the posted approval form without doing any I/O.
+    Returns None if they are invalid, else a function looking up the installation
+    of the shop the form belongs to.
+    '''
+    credentials = _form_credentials(payment_id)
+    if credentials is None:
+        return None
+    shop_id, hostname = credentials
+    if hostname:
+        return lambda: get_installation(hostname)
+
+    def find_installation():
+        shop = SHOPS.get_shop(shop_id)
+        if shop is None:
+            return None
+        return get_installation(shop.hostname)
+    return find_installation
+
+def _form_credentials(payment_id):
+    ''' Shop id and hostname the posted approval form's token vouches for,
+    or shop id and None for a valid signature, else None. Verified once per
+    request, shed_load needs them too.
+    '''
+    if 'form_credentials' not in g:
+        g.form_credentials = None
+        token = request.form.get('token', '')
+        if token:
+            payment_token = verify_payment_token(token, payment_id, CLIENT_SECRET)
+            if payment_token is not None:
+                g.form_credentials = (payment_token.shop_id, payment_token.hostname)
+        else:
+            # Approval forms rendered before payment tokens were introduced
+            shop_id = request.form.get('shop_id', '')
+            if _validate_signature(request.form.get('signature', ''), shop_id, payment_id):
+                g.form_credentials = (shop_id, None)
+    return g.form_credentials
 
 @app.route('/payments/<payment_id>/capture', methods=['POST'])
 def capture_payment(payment_id):
-    print('Capturing payment %s' % payment_id)
+    REQUEST_LOGGER.info('Capturing payment', payment_id=payment_id)
+    result = PAYMENT_RESULTS.cached(payment_id, 'capture')
+    if result is None:
+        # Like the installation in _complete_payment, read before the payment is claimed
+        payment = PAYMENT_LEDGER.get_payment(payment_id)
+        result = PAYMENT_RESULTS.complete(payment_id, 'capture', lambda: _capture(payment_id, payment))
+    return precomputed(CAPTURE_RESULTS[result.state])
+
+def _capture(payment_id, payment):
+    if payment is not None and payment.state == CANCELED:
+        return PaymentResult(payment_id, 'capture', CANCELED)
+    PAYMENT_LEDGER.record(payment_id, CAPTURED)
+    return PaymentResult(payment_id, 'capture', CAPTURED)
+
+@app.route('/payments/<payment_id>')
+def payment_status(payment_id):
+    payment = PAYMENT_LEDGER.get_payment(payment_id)
+    if payment is None:
+        abort(404)
     return jsonify({
-        'paymentStatus' : 'CAPTURED',
+        'paymentId' : payment.payment_id,
+        'shopId' : payment.shop_id,
+        'paymentStatus' : payment.state,
     })
 
 def generate_id():
@@ -205,18 +413,63 @@ def limit_open_proxy_requests():
     http://stackoverflow.com/questions/22251038/how-to-limit-flask-dev-server-to-only-one-visiting-ip-address
     '''
     if not is_allowed_request():
-        print('Someone is messing with us:')
-        print(request.url_root)
-        print(request)
+        LOGGER.warning('Someone is messing with us', url_root=request.url_root, request=repr(request))
         abort(403)
 
 def is_allowed_request():
-    url = request.url_root
-    return '.herokuapp.com' in url or \
-           '.ngrok.io' in url or \
-           'localhost:8080' in url or \
-           '127.0.0' in url or \
-           '0.0.0.0:80' in url
+    return HOST_ALLOW_LIST.allows(request.host)
+
+def _approval_rate_limit_key():
+    ''' The shop the approval form's credentials vouch for. Forms without
+    valid credentials can name any shop, so they share a bucket per client
+    address instead of draining the named shop's.
+    '''
+    credentials = _form_credentials(request.view_args['payment_id'])
+    if credentials is None:
+        return 'unverified:%s' % request.remote_addr
+    return credentials[0] or credentials[1]
+
+# Routes doing database or Beyond API work, with the key their requests are rate limited by
+SHED_ROUTES = {
+    'callback': lambda: None,
+    'create_payment': lambda: (request.get_json(force=True, silent=True) or {}).get('shopId'),
+    'create_embedded_payment': lambda: (request.get_json(force=True, silent=True) or {}).get('shopId'),
+    'approve_payment': _approval_rate_limit_key,
+    'cancel_payment': _approval_rate_limit_key,
+    'capture_payment': lambda: None,
+    'payment_status': lambda: None,
+}
+
+@app.before_request
+def shed_load():
+    ''' Turns requests away while the process is overloaded (503) or their
+    shop sends too many (429), before they do any work.
+    '''
+    shop_id_of = SHED_ROUTES.get(request.endpoint)
+    if shop_id_of is None:
+        return None
+    reason = LOAD_SHEDDER.try_enter(request.headers.get('X-Request-Start'))
+    if reason is not None:
+        return _shed(reason, 503, SHED_RETRY_AFTER)
+    g.load_shedder_entered = True
+
+    shop_id = shop_id_of()
+    if shop_id and SHOP_RATE_LIMITS is not None:
+        retry_after = SHOP_RATE_LIMITS.try_acquire(str(shop_id))
+        if retry_after > 0:
+            return _shed('rate_limited', 429, retry_after)
+    return None
+
+def _shed(reason, status, retry_after):
+    REQUESTS_SHED.inc(route=request.url_rule.rule, reason=reason)
+    LOGGER.warning('Shedding request', route=request.url_rule.rule, reason=reason)
+    return Response('Too Many Requests' if status == 429 else 'Service Unavailable', status=status,
+                    headers={'Retry-After': str(max(1, int(math.ceil(retry_after))))})
+
+@app.teardown_request
+def leave_load_shedder(error):
+    if g.pop('load_shedder_entered', False):
+        LOAD_SHEDDER.leave()
 
 def get_installation(hostname):
     installation = APP_INSTALLATIONS.get_installation(hostname)
@@ -226,7 +479,7 @@ def get_installation(hostname):
 
 @app.errorhandler(404)
 def page_not_found(e):
-    return '<h1>404 File Not Found! :(</h1>', 404
+    return precomputed(NOT_FOUND)
 
 class ShopNotKnown(Exception):
     def __init__(self, hostname):
@@ -235,30 +488,69 @@ class ShopNotKnown(Exception):
 
 @app.errorhandler(ShopNotKnown)
 def shop_not_known(e):
-    return render_template('index.html', installed=False, error_message='App not installed for the requested shop with hostname %s' % e.hostname)
+    return render_cached('index.html', installed=False, error_message='App not installed for the requested shop with hostname %s' % e.hostname)
 
 @app.errorhandler(Exception)
 def all_exception_handler(error):
     LOGGER.exception(error)
     return 'Error', 500
 
-def init():
+def create_app():
+    '''Wire up logging, metrics and the stores, once per process. Does no
+    I/O: the schema is created by migrations.py, once per deploy.
+
+    Run with: gunicorn -c gunicorn.conf.py 'app:create_app()'
+    '''
+    global _initialized
+    with _init_lock:
+        if not _initialized:
+            _init()
+            _initialized = True
+    return app
+
+def _init():
     global APP_INSTALLATIONS
     global SHOPS
+    global PROVISIONED_PAYMENT_METHODS
+    global PAYMENT_RESULTS
+    global PAYMENT_LEDGER
+    global STATIC_ASSETS
+    global SHOP_RATE_LIMITS
     global DEFAULT_HOSTNAME
     global CLIENT_SECRET
 
+    logs.setup()
+    metrics.setup()
+
+    STATIC_ASSETS = StaticAssets(app.static_folder)
+    metrics.register_cache('pages', PAGE_CACHE)
+
     CLIENT_ID = os.environ.get('CLIENT_ID', '')
     CLIENT_SECRET = os.environ.get('CLIENT_SECRET', '')
 
-    print('Initialize PostgresAppInstallations')
+    LOGGER.info('Initialize PostgresAppInstallations')
     APP_INSTALLATIONS = PostgresAppInstallations(os.environ.get('DATABASE_URL'), CLIENT_ID, CLIENT_SECRET)
-    APP_INSTALLATIONS.create_schema()
+    metrics.register_cache('installations', APP_INSTALLATIONS.cache)
 
-    print('Initialize PostgresShops')
+    LOGGER.info('Initialize PostgresShops')
     SHOPS = PostgresShops(os.environ.get('DATABASE_URL'))
-    SHOPS.create_schema()
 
-init()
+    PROVISIONED_PAYMENT_METHODS = PostgresProvisionedPaymentMethods(os.environ.get('DATABASE_URL'))
+
+    PAYMENT_RESULTS = PostgresPaymentResults(os.environ.get('DATABASE_URL'))
+    metrics.register_cache('payment_results', PAYMENT_RESULTS.cache)
+
+    PAYMENT_LEDGER = PostgresPaymentLedger(os.environ.get('DATABASE_URL'))
+
+    if SHOP_RATE_LIMIT > 0 and SHOP_RATE_LIMIT_SHARED:
+        SHOP_RATE_LIMITS = PostgresTokenBuckets(os.environ.get('DATABASE_URL'), SHOP_RATE_LIMIT, SHOP_RATE_LIMIT_BURST)
+    elif SHOP_RATE_LIMIT > 0:
+        SHOP_RATE_LIMITS = TokenBuckets(SHOP_RATE_LIMIT, SHOP_RATE_LIMIT_BURST)
+
+    if os.environ.get('TOKEN_REFRESHER_IN_PROCESS', '').lower() == 'true':
+        LOGGER.info('Start background token refresher')
+        TokenRefresher(APP_INSTALLATIONS).start()
+
 if __name__ == '__main__':
-    app.run()
+    migrations.migrate(os.environ.get('DATABASE_URL'))
+    create_app().run()
@@ -1,14 +1,31 @@
 # -*- coding: utf-8 -*-
 
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from urllib.parse import urlparse
-import requests
 import os
-import psycopg2
+import threading
 
-from signers import sign
+from caches import TTLCache
+from psycopg2.extras import execute_values
+
+from db import BULK_PAGE_SIZE, advisory_lock, batched, get_pool, last_by_key
+import http_client
+import logs
+from metrics import DB_QUERY_SECONDS, TOKEN_REFRESHES, timed
+from signers import verify
+from singleflight import SingleFlight
+
+INSTALLATION_CACHE_SIZE = int(os.environ.get('INSTALLATION_CACHE_SIZE', '1024'))
+INSTALLATION_CACHE_TTL = float(os.environ.get('INSTALLATION_CACHE_TTL', '300'))
+# Longest time a worker waits for another worker's token refresh
+TOKEN_REFRESH_LOCK_TIMEOUT = os.environ.get('TOKEN_REFRESH_LOCK_TIMEOUT', '30s')
+
+LOGGER = logs.get_logger('installations')
 
 class Installation(object):
+    EXPIRY_MARGIN = timedelta(minutes=15)
+
     def __init__(self, api_url, access_token, refresh_token=None, expiry_date=None):
         self.api_url = api_url
         self.access_token = access_token
@@ -17,11 +34,17 @@ class Installation(object):
         self.hostname = urlparse(api_url).hostname
 
     def is_expired(self):
-        return datetime.now() > (self.expiry_date - timedelta(minutes=15))
+        return self.expires_within(Installation.EXPIRY_MARGIN)
+
+    def expires_within(self, horizon):
+        return datetime.now() > (self.expiry_date - horizon)
+
+    def seconds_until_expired(self):
+        return (self.expiry_date - Installation.EXPIRY_MARGIN - datetime.now()).total_seconds()
 
     @staticmethod
     def _from_token_response(api_url, token_response):
-        print('Token response: ' + repr(token_response))
+        LOGGER.info('Token response', api_url=api_url, keys=sorted(token_response), expires_in=token_response.get('expires_in'))
         return Installation(api_url=api_url,
             access_token=token_response.get('access_token'),
             refresh_token=token_response.get('refresh_token', None),
@@ -29,89 +52,178 @@ class Installation(object):
 
 class AppInstallations(object):
 
-    def __init__(self, client_id, client_secret):
+    def __init__(self, client_id, client_secret, cache=None):
         self.client_secret = client_secret
         self.client_id = client_id
         self.installations = {}
+        # hostname: (failed refreshes, datetime before which it isn't retried)
+        self.refresh_failures = {}
+        # Guards installations and refresh_failures, shared by all request threads of a worker
+        self._installations_lock = threading.Lock()
+        self.cache = cache if cache is not None else TTLCache(maxsize=INSTALLATION_CACHE_SIZE, ttl=INSTALLATION_CACHE_TTL)
+        self.refreshes = SingleFlight()
 
     def retrieve_token_from_auth_code(self, api_url, auth_code, token_url, signature):
         """Retrieve a token using the auth code and initialize app installation data
         """
+        return self.install_from_auth_code(api_url, auth_code, token_url, signature).access_token
+
+    def install_from_auth_code(self, api_url, auth_code, token_url, signature):
+        """Like retrieve_token_from_auth_code, but returns the stored installation
+        """
 
         assert api_url != '' and auth_code != '' and token_url != '' and signature != ''
 
-        calculated_signature = self._calculate_signature(auth_code, token_url, self.client_secret)
-        assert signature == calculated_signature, "signature invalid - found %s but expected %s" % (signature, calculated_signature)
+        assert self._verify_signature(signature, auth_code, token_url, self.client_secret), "signature invalid - found %s" % signature
 
         params = {
             'grant_type': 'authorization_code',
             'code': auth_code
         }
-        token_response = requests.post(url=token_url, data=params, auth=(self.client_id, self.client_secret)).json()
+        token_response = http_client.json_body(http_client.post(url=token_url, data=params, auth=(self.client_id, self.client_secret),
+                                                                operation='token_authorization_code'))
 
         installation = Installation._from_token_response(api_url, token_response)
 
         self.create_or_update_installation(installation)
 
-        return installation.access_token
+        return installation
 
     def retrieve_token_from_client_credentials(self, api_url):
         """Retrieve a token using client credentials and initialize app installation data
         """
+        return self._install_from_client_credentials(api_url).access_token
+
+    def _install_from_client_credentials(self, api_url, session=None):
         assert api_url != ''
         params = {
             'grant_type': 'client_credentials'
         }
         token_url = self._token_url(api_url)
-        token_response = requests.post(url=token_url,
+        token_response = http_client.json_body(http_client.post(url=token_url,
                                    data=params,
-                                   auth=(self.client_id, self.client_secret)).json()
+                                   auth=(self.client_id, self.client_secret),
+                                   operation='token_client_credentials'))
+        TOKEN_REFRESHES.inc(grant_type='client_credentials')
 
         installation = Installation._from_token_response(api_url, token_response)
 
-        self.create_or_update_installation(installation)
+        self._store_installation(session, installation)
 
-        return installation.access_token
+        return installation
 
     def get_installation(self, hostname):
+        installation = self.cache.get(hostname)
+        if installation is not None and not installation.is_expired():
+            return installation
+
         installation = self._find_installation(hostname)
         if (installation is not None and installation.is_expired()):
-            if (installation.refresh_token):
-                print("Token expired for %s - refreshing it using refresh token" % installation.hostname)
-                self._refresh_token(installation)
-            else:
-                print("Token expired for %s - getting a new one using client credentials" % installation.hostname)
-                self.retrieve_token_from_client_credentials(installation.api_url)
-            installation = self._find_installation(hostname)
+            installation = self.refresh_installation(hostname)
+        if installation is not None:
+            # Never keep a token in the cache past the point where it counts as expired
+            self.cache.set(hostname, installation, ttl=installation.seconds_until_expired())
         return installation
 
-    def create_or_update_installation(self, installation):
-        self.installations[installation.hostname] = installation
+    def refresh_installation(self, hostname, horizon=Installation.EXPIRY_MARGIN):
+        """Refresh the token of an installation if it expires within the given horizon
+        """
+        # Concurrent callers in this process wait for a single refresh
+        return self.refreshes.do(hostname, self._refresh_expiring_installation, hostname, horizon)
+
+    def find_hostnames_expiring_within(self, horizon, limit=None):
+        """Hostnames whose token expires within the horizon, soonest first,
+        leaving out those backing off after a failed refresh
+        """
+        now = datetime.now()
+        with self._installations_lock:
+            expiring = sorted((installation.expiry_date, hostname)
+                              for hostname, installation in self.installations.items()
+                              if installation.expiry_date < now + horizon
+                              and self.refresh_failures.get(hostname, (0, now))[1] <= now)
+        return [hostname for _, hostname in expiring[:limit]]
+
+    def record_refresh_failure(self, hostname, backoff, max_backoff):
+        """Leave the installation out of find_hostnames_expiring_within for
+        backoff seconds, doubling with every further failure up to
+        max_backoff, until a new token is stored
+        """
+        with self._installations_lock:
+            attempts = self.refresh_failures.get(hostname, (0, None))[0] + 1
+            self.refresh_failures[hostname] = (attempts, datetime.now() + timedelta(seconds=min(backoff * 2 ** (attempts - 1), max_backoff)))
+
+    def _refresh_expiring_installation(self, hostname, horizon):
+        with self._refresh_lock(hostname) as session:
+            # Whoever held the lock before us may already have refreshed the token
+            installation = self._find_installation(hostname, session)
+            if (installation is not None and installation.expires_within(horizon)):
+                if (installation.refresh_token):
+                    LOGGER.info('Token expiring - refreshing it using refresh token', hostname=installation.hostname)
+                    self._refresh_token(installation, session)
+                else:
+                    LOGGER.info('Token expiring - getting a new one using client credentials', hostname=installation.hostname)
+                    self._install_from_client_credentials(installation.api_url, session)
+                installation = self._find_installation(hostname, session)
+            return installation
+
+    @contextmanager
+    def _refresh_lock(self, hostname):
+        """Serializes token refreshes for a hostname across processes.
+        Yields what _find_installation and _store_installation need to run
+        while holding the lock.
+
+        Within a single process the SingleFlight in get_installation suffices.
+        """
+        yield None
 
-    def _find_installation(self, hostname):
-        return self.installations[hostname]
+    def hostnames(self):
+        with self._installations_lock:
+            return sorted(self.installations)
 
-    def _calculate_signature(self, code, access_token_url, client_secret):
+    def create_or_update_installation(self, installation):
+        self._store_installation(None, installation)
+
+    def create_or_update_installations(self, installations):
+        count = 0
+        for installation in installations:
+            self.create_or_update_installation(installation)
+            count += 1
+        return count
+
+    def _find_installation(self, hostname, session=None):
+        with self._installations_lock:
+            return self.installations[hostname]
+
+    def _store_installation(self, session, installation):
+        self.cache.invalidate(installation.hostname)
+        with self._installations_lock:
+            self.installations[installation.hostname] = installation
+            self.refresh_failures.pop(installation.hostname, None)
+
+    def _verify_signature(self, signature, code, access_token_url, client_secret):
         message = '%s:%s' % (code, access_token_url)
-        return sign(message, client_secret)
+        return verify(message, signature, client_secret)
 
-    def _refresh_token(self, installation):
+    def _refresh_token(self, installation, session=None):
         """Get a new token using the refresh token
         """
+        self.cache.invalidate(installation.hostname)
 
         params = {
             'grant_type': 'refresh_token',
             'client_id': self.client_id,
             'refresh_token': installation.refresh_token
         }
-        response = requests.post(
+        response = http_client.post(
             url=self._token_url(installation.api_url),
             data=params,
-            auth=(self.client_id, self.client_secret))
+            auth=(self.client_id, self.client_secret),
+            operation='token_refresh')
+        TOKEN_REFRESHES.inc(grant_type='refresh_token')
 
-        installation = Installation._from_token_response(installation.api_url, response.json())
+        installation = Installation._from_token_response(installation.api_url, http_client.json_body(response))
 
-        self.create_or_update_installation(installation)
+        self._store_installation(session, installation)
 
         return installation.access_token
 
@@ -122,42 +234,93 @@ class AppInstallations(object):
 class PostgresAppInstallations(AppInstallations):
     """Access app installation data using postgres
     """
-    def __init__(self, database_url, client_id, client_secret):
-        super().__init__(client_id, client_secret)
+    def __init__(self, database_url, client_id, client_secret, pool=None, cache=None):
+        super().__init__(client_id, client_secret, cache)
         self.database_url = database_url
+        self.pool = pool or get_pool(database_url)
 
-    def create_schema(self):
-        with psycopg2.connect(self.database_url) as conn:
-            with conn.cursor() as curs:
-                curs.execute("""CREATE TABLE IF NOT EXISTS APP_INSTALLATIONS (
-                              HOSTNAME varchar(255) UNIQUE NOT NULL,
-                              API_URL varchar(255) NOT NULL,
-                              ACCESS_TOKEN varchar(4096) NOT NULL,
-                              REFRESH_TOKEN varchar(4096) NOT NULL,
-                              EXPIRY_DATE timestamp NOT NULL
-                            )""")
+    UPSERT_SQL = """INSERT INTO APP_INSTALLATIONS (HOSTNAME, API_URL, ACCESS_TOKEN, REFRESH_TOKEN, EXPIRY_DATE) VALUES %s
+                    ON CONFLICT (HOSTNAME) DO UPDATE SET
+                        API_URL=EXCLUDED.API_URL,
+                        ACCESS_TOKEN=EXCLUDED.ACCESS_TOKEN,
+                        REFRESH_TOKEN=EXCLUDED.REFRESH_TOKEN,
+                        EXPIRY_DATE=EXCLUDED.EXPIRY_DATE,
+                        REFRESH_ATTEMPTS=0,
+                        REFRESH_RETRY_AFTER=NULL"""
 
     def create_or_update_installation(self, installation):
-        sql = ''
-        if self._find_installation(installation.hostname):
-            print("Updating APP_INSTALLATIONS entry for %s" % installation.hostname)
-            sql = "UPDATE APP_INSTALLATIONS SET API_URL=%s, ACCESS_TOKEN=%s, REFRESH_TOKEN=%s, EXPIRY_DATE=%s WHERE HOSTNAME=%s"
-        else:
-            print("Creating APP_INSTALLATIONS entry for %s" % installation.hostname)
-            sql = "INSERT INTO APP_INSTALLATIONS (API_URL, ACCESS_TOKEN, REFRESH_TOKEN, EXPIRY_DATE, HOSTNAME) VALUES(%s, %s, %s, %s, %s)"
-        with psycopg2.connect(self.database_url) as conn:
+        with self.pool.connection() as conn:
+            self._store_installation(conn, installation)
+
+    @timed(DB_QUERY_SECONDS, operation='installations.upsert')
+    def _store_installation(self, conn, installation):
+        self.cache.invalidate(installation.hostname)
+        LOGGER.info('Create/update APP_INSTALLATIONS entry', hostname=installation.hostname)
+        with conn.cursor() as curs:
+            execute_values(curs, self.UPSERT_SQL, [_installation_row(installation)])
+        # Visible to the next holder of the refresh lock before it is released
+        conn.commit()
+
+    @timed(DB_QUERY_SECONDS, operation='installations.bulk_upsert')
+    def create_or_update_installations(self, installations, page_size=BULK_PAGE_SIZE):
+        """Upsert many installations in batches within one transaction. Returns the number of rows written.
+        """
+        count = 0
+        with self.pool.connection() as conn:
             with conn.cursor() as curs:
-                curs.execute(sql, (installation.api_url, installation.access_token, installation.refresh_token, installation.expiry_date, installation.hostname))
-
-    def _find_installation(self, hostname):
-        with psycopg2.connect(self.database_url) as conn:
+                for batch in batched(installations, page_size):
+                    batch = last_by_key(batch, lambda installation: installation.hostname)
+                    for installation in batch:
+                        self.cache.invalidate(installation.hostname)
+                    execute_values(curs, self.UPSERT_SQL, [_installation_row(installation) for installation in batch], page_size=page_size)
+                    count += len(batch)
+        LOGGER.info('Created/updated APP_INSTALLATIONS entries', count=count)
+        return count
+
+    @timed(DB_QUERY_SECONDS, operation='installations.find_expiring')
+    def find_hostnames_expiring_within(self, horizon, limit=None):
+        now = datetime.now()
+        with self.pool.connection() as conn:
+            with conn.cursor() as curs:
+                curs.execute("""SELECT HOSTNAME FROM APP_INSTALLATIONS
+                                WHERE EXPIRY_DATE < %s AND (REFRESH_RETRY_AFTER IS NULL OR REFRESH_RETRY_AFTER <= %s)
+                                ORDER BY EXPIRY_DATE LIMIT %s""",
+                             (now + horizon, now, limit))
+                return [entry[0] for entry in curs.fetchall()]
+
+    @timed(DB_QUERY_SECONDS, operation='installations.record_refresh_failure')
+    def record_refresh_failure(self, hostname, backoff, max_backoff):
+        with self.pool.connection() as conn:
             with conn.cursor() as curs:
-                curs.execute("SELECT * FROM APP_INSTALLATIONS WHERE HOSTNAME=%s", (hostname,))
-                entry = curs.fetchone()
-                if entry:
-                    print("Found installation for hostname %s" % hostname)
-                    return Installation(api_url=entry[1],
-                                 access_token=entry[2],
-                                 refresh_token=entry[3],
-                                 expiry_date=entry[4])
+                curs.execute("""UPDATE APP_INSTALLATIONS SET
+                                    REFRESH_ATTEMPTS = REFRESH_ATTEMPTS + 1,
+                                    REFRESH_RETRY_AFTER = %s + least(%s * power(2, REFRESH_ATTEMPTS), %s) * interval '1 second'
+                                WHERE HOSTNAME=%s""",
+                             (datetime.now(), backoff, max_backoff, hostname))
+
+    def _refresh_lock(self, hostname):
+        # Finding and storing the installation reuse the connection holding
+        # the lock, so a refresh never needs a second pooled connection
+        return advisory_lock(self.pool, 'token-refresh:%s' % hostname, TOKEN_REFRESH_LOCK_TIMEOUT)
+
+    def _find_installation(self, hostname, session=None):
+        if session is not None:
+            return self._select_installation(session, hostname)
+        with self.pool.connection() as conn:
+            return self._select_installation(conn, hostname)
+
+    @timed(DB_QUERY_SECONDS, operation='installations.find')
+    def _select_installation(self, conn, hostname):
+        with conn.cursor() as curs:
+            curs.execute("SELECT * FROM APP_INSTALLATIONS WHERE HOSTNAME=%s", (hostname,))
+            entry = curs.fetchone()
+            if entry:
+                LOGGER.debug('Found installation', hostname=hostname)
+                return Installation(api_url=entry[1],
+                             access_token=entry[2],
+                             refresh_token=entry[3],
+                             expiry_date=entry[4])
         return None
+
+def _installation_row(installation):
+    return (installation.hostname, installation.api_url, installation.access_token, installation.refresh_token, installation.expiry_date)
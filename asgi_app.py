@@ -0,0 +1,538 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    asyncio serving mode of the payment app. Same routes and templates as
+    app.py, but handlers await outbound Beyond API calls instead of
+    blocking a worker, so one process can keep many approvals in flight.
+
+    Run with: hypercorn asgi_app:app, after `python migrations.py`
+
+    Database access reuses the pooled stores and runs on the default
+    executor, as lookups are short and mostly served from the installation
+    cache. So does recording to the payment ledger, which blocks while its
+    buffer is full.
+'''
+
+import asyncio
+import math
+import os
+import random
+import time
+from functools import partial
+from urllib.parse import urlencode, urlparse, unquote
+
+import httpx
+from quart import Quart, Response, render_template, request, abort, jsonify, g
+
+from allowed_hosts import HostAllowList
+from app_installations import PostgresAppInstallations
+from caches import TTLCache
+from http_cache import PrecomputedResponse, StaticAssets
+from shops import Shop, PostgresShops
+from payment_method_definitions import AUTO_INSTALLED_PAYMENT_METHOD_DEFINITIONS, payment_method_created
+from payment_ledger import PENDING, CANCELED, CAPTURED, PostgresPaymentLedger
+from payment_results import PAYMENT_RESULT_POLL_INTERVAL, PaymentResult, PostgresPaymentResults
+from provisioning import PostgresProvisionedPaymentMethods
+import beyond_async
+from circuit_breakers import HostUnavailable
+from load_shedding import LoadShedder
+from rate_limits import PostgresTokenBuckets, TokenBuckets
+import http_client_async
+import json_codec
+from payment_tokens import create_payment_token, read_payment_token, verify_payment_token
+from signers import sign, verify, verify_bearer_token
+import logs
+import metrics
+
+app = Quart(__name__)
+json_codec.init_app(app)
+
+APP_INSTALLATIONS = None
+SHOPS = None
+PROVISIONED_PAYMENT_METHODS = None
+PAYMENT_RESULTS = None
+PAYMENT_LEDGER = None
+CLIENT_SECRET = ''
+DEFAULT_HOSTNAME = ''
+LOGGER = logs.get_logger('asgi_app')
+CALLBACK_CONCURRENCY = int(os.environ.get('CALLBACK_CONCURRENCY', '4'))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+PAGE_CACHE_SIZE = int(os.environ.get('PAGE_CACHE_SIZE', '1024'))
+PAGE_CACHE_SECONDS = int(os.environ.get('PAGE_CACHE_SECONDS', '300'))
+SHOP_RATE_LIMIT = float(os.environ.get('SHOP_RATE_LIMIT', '10'))
+SHOP_RATE_LIMIT_BURST = int(os.environ.get('SHOP_RATE_LIMIT_BURST', '20'))
+SHOP_RATE_LIMIT_SHARED = os.environ.get('SHOP_RATE_LIMIT_SHARED', '').lower() == 'true'
+# Unlike threaded workers, one event loop takes any number of requests
+SHED_MAX_IN_FLIGHT = int(os.environ.get('SHED_MAX_IN_FLIGHT', '256'))
+SHED_MAX_QUEUE_SECONDS = float(os.environ.get('SHED_MAX_QUEUE_SECONDS', '10'))
+SHED_RETRY_AFTER = int(os.environ.get('SHED_RETRY_AFTER', '1'))
+
+PAGE_CACHE = TTLCache(maxsize=PAGE_CACHE_SIZE, ttl=PAGE_CACHE_SECONDS)
+STATIC_ASSETS = None
+HOST_ALLOW_LIST = HostAllowList()
+LOAD_SHEDDER = LoadShedder(SHED_MAX_IN_FLIGHT, SHED_MAX_QUEUE_SECONDS)
+SHOP_RATE_LIMITS = None
+
+MERCHANT_ACCOUNT_STATUS = PrecomputedResponse.json({
+    'ready' : True,
+    'details' : {
+        'primaryEmail' : 'example@b.c'
+    }
+})
+CAPTURE_RESULTS = dict((state, PrecomputedResponse.json({'paymentStatus' : state})) for state in (CAPTURED, CANCELED))
+NOT_FOUND = PrecomputedResponse.html('<h1>404 File Not Found! :(</h1>', status=404)
+
+REQUEST_SECONDS = metrics.histogram('http_request_duration_seconds', 'Duration of requests per route', ['route', 'method', 'status'])
+REQUESTS_SHED = metrics.counter('http_requests_shed_total', 'Requests turned away before doing any work', ['route', 'reason'])
+
+async def run_blocking(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(None, partial(fn, *args, **kwargs))
+
+@app.before_request
+async def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+async def observe_request(response):
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.observe(time.perf_counter() - started, route=route, method=request.method, status=response.status_code)
+    return response
+
+@app.route('/metrics')
+async def metrics_endpoint():
+    if METRICS_TOKEN and not verify_bearer_token(request.headers.get('Authorization', ''), METRICS_TOKEN):
+        return Response('Forbidden', status=403)
+    return Response(await run_blocking(metrics.exposition), mimetype='text/plain; version=0.0.4')
+
+@app.url_defaults
+def hashed_static_urls(endpoint, values):
+    if endpoint == 'static' and STATIC_ASSETS is not None:
+        values['filename'] = STATIC_ASSETS.url_filename(values['filename'])
+
+@app.endpoint('static')
+async def static_file(filename):
+    asset = STATIC_ASSETS.get(filename)
+    if asset is None:
+        abort(404)
+    return precomputed(asset)
+
+def precomputed(response):
+    body, status, headers = response.parts(request.headers)
+    return Response(body, status=status, headers=headers)
+
+async def render_cached(template_name, **context):
+    '''See app.render_cached
+    '''
+    key = (request.script_root, template_name, tuple(sorted(context.items())))
+    page = PAGE_CACHE.get(key)
+    if page is None:
+        page = await render_template(template_name, **context)
+        PAGE_CACHE.set(key, page)
+    return page
+
+@app.route('/')
+async def root():
+    if DEFAULT_HOSTNAME != '':
+        return await render_cached('index.html', installed=True, hostname=DEFAULT_HOSTNAME)
+    return await render_cached('index.html', installed=False)
+
+@app.route('/<hostname>')
+async def root_hostname(hostname):
+    return await render_cached('index.html', installed=True, hostname=hostname)
+
+@app.route('/callback')
+async def callback():
+    args = request.args
+    return_url = args.get('return_url')
+    access_token_url = args.get('access_token_url')
+    api_url = args.get('api_url')
+    code = args.get('code')
+    signature = unquote(args.get('signature'))
+
+    installation = await run_blocking(APP_INSTALLATIONS.install_from_auth_code, api_url, code, access_token_url, signature)
+
+    calls = asyncio.Semaphore(CALLBACK_CONCURRENCY)
+    results = await asyncio.gather(
+        _bounded(calls, _get_and_store_shop_id(installation)),
+        *[_bounded(calls, beyond_async.create_payment_method(installation, pmd_name))
+          for pmd_name in AUTO_INSTALLED_PAYMENT_METHOD_DEFINITIONS],
+        return_exceptions=True)
+    shop_id_error = _error_of(results[0])
+
+    created_payment_methods = []
+    for pmd_name, status in zip(AUTO_INSTALLED_PAYMENT_METHOD_DEFINITIONS, results[1:]):
+        error = _error_of(status)
+        created_payment_methods.append({
+            'status_code': None if error else status,
+            'payment_method_definition_name': pmd_name,
+            'error': error
+        })
+        if error:
+            LOGGER.warning('Creating payment method failed', payment_method_definition=pmd_name, hostname=installation.hostname, error=error)
+        else:
+            LOGGER.info('Created payment method', payment_method_definition=pmd_name, hostname=installation.hostname, status=status)
+
+    await run_blocking(PROVISIONED_PAYMENT_METHODS.record, installation.hostname,
+                       [created['payment_method_definition_name'] for created in created_payment_methods
+                        if payment_method_created(created['status_code'])])
+
+    return await render_template('callback_result.html',
+                                 return_url=return_url,
+                                 created_payment_methods=created_payment_methods,
+                                 shop_id_error=shop_id_error)
+
+async def _bounded(semaphore, coroutine):
+    async with semaphore:
+        return await coroutine
+
+def _error_of(result):
+    if isinstance(result, Exception):
+        LOGGER.error('Install callback step failed', exc_info=result)
+        return str(result) or result.__class__.__name__
+    return None
+
+async def _get_and_store_shop_id(installation):
+    shop_id = await beyond_async.get_shop_id(installation)
+    await run_blocking(SHOPS.create_or_update_shop, Shop(shop_id, installation.hostname))
+
+@app.route('/merchants/<shop_id>')
+async def merchant_account_status(shop_id):
+    return precomputed(MERCHANT_ACCOUNT_STATUS)
+
+@app.route('/payments', methods=['POST'])
+async def create_payment():
+    payload = await request.get_json(force=True, silent=True) or {}
+    if payload.get('paymentId'):
+        await run_blocking(PAYMENT_LEDGER.record, payload['paymentId'], PENDING, payload.get('shopId'))
+    return jsonify({
+        'paymentNote': 'Please transfer the money using the reference %s to the account %s' % (generate_id(), generate_id()),
+    })
+
+@app.route('/embedded-payments', methods=['POST'])
+async def create_embedded_payment():
+    app_hostname = urlparse(request.url_root).hostname
+
+    payload = await request.get_json(force=True)
+    shop = payload.get('shop', {}).get('name', '')
+    shop_id = payload.get('shopId', '')
+    payment_id = payload.get('paymentId', '')
+    signature = sign('%s:%s' % (shop_id, payment_id), CLIENT_SECRET)
+
+    params = {
+        'paymentId': payment_id,
+        'signature': signature,
+        'shop': shop,
+        'shopId': shop_id
+    }
+    known_shop = await run_blocking(SHOPS.get_shop, shop_id)
+    if known_shop:
+        params['token'] = create_payment_token(shop_id, known_shop.hostname, payment_id, CLIENT_SECRET)
+    await run_blocking(PAYMENT_LEDGER.record, payment_id, PENDING, shop_id)
+    embeddedApprovalUri = 'https://%s/embedded-payment-approval?%s' % (app_hostname, urlencode(params))
+    return jsonify({
+        'embeddedApprovalUri': embeddedApprovalUri
+    })
+
+@app.route('/embedded-payment-approval')
+async def embedded_payment_approval():
+    args = request.args
+    payment_id = unquote(args.get('paymentId', ''))
+    signature = unquote(args.get('signature', ''))
+    shop = unquote(args.get('shop', ''))
+    shop_id = unquote(args.get('shopId', ''))
+    token = unquote(args.get('token', ''))
+    approve_uri = '/payments/%s/approve' % payment_id
+    cancel_uri = '/payments/%s/cancel' % payment_id
+
+    if token:
+        payment_token = read_payment_token(token, CLIENT_SECRET)
+        if payment_token is not None and (payment_token.payment_id, payment_token.shop_id) != (payment_id, shop_id):
+            # The page would show another payment or shop than the form approves
+            return Response('Bad Request', status=400)
+        valid = payment_token is not None
+    else:
+        valid = _validate_signature(signature, shop_id, payment_id)
+    if valid:
+        return await render_template('embedded_payment_approval.html',
+                                     state='PENDING',
+                                     signature=signature,
+                                     token=token,
+                                     shop=shop,
+                                     shop_id=shop_id,
+                                     approve_uri=approve_uri,
+                                     cancel_uri=cancel_uri)
+    return await render_cached('embedded_payment_approval.html', state='ERROR')
+
+def _validate_signature(signature_to_validate, shop_id, payment_id):
+    return verify('%s:%s' % (shop_id, payment_id), signature_to_validate, CLIENT_SECRET)
+
+@app.route('/payments/<payment_id>/approve', methods=['POST'])
+async def approve_payment(payment_id):
+    return await _complete_payment(payment_id, 'approve', beyond_async.approve_payment, 'APPROVED')
+
+@app.route('/payments/<payment_id>/cancel', methods=['POST'])
+async def cancel_payment(payment_id):
+    return await _complete_payment(payment_id, 'cancel', beyond_async.cancel_payment, 'CANCELED')
+
+async def _complete_payment(payment_id, action, call, state):
+    '''See app._complete_payment
+    '''
+    find_installation = await _authorize(payment_id)
+    if find_installation is None:
+        return await render_cached('embedded_payment_approval.html', state='ERROR')
+
+    result = PAYMENT_RESULTS.cached(payment_id, action)
+    if result is None:
+        installation = await find_installation()
+        result = await _idempotent(payment_id, action, partial(_complete, installation, payment_id, action, call, state))
+    return await render_template('embedded_payment_approval.html',
+                                 state=result.state,
+                                 return_uri=result.return_uri)
+
+async def _complete(installation, payment_id, action, call, state):
+    if installation is None:
+        return PaymentResult(payment_id, action, 'ERROR', completed=False)
+    try:
+        return_uri = await call(installation, payment_id)
+    except HostUnavailable as e:
+        LOGGER.warning('Failing fast', payment_id=payment_id, action=action, hostname=e.hostname, reason=e.reason)
+        return PaymentResult(payment_id, action, 'ERROR', completed=False)
+    except httpx.HTTPError as e:
+        LOGGER.warning('Calling Beyond failed', payment_id=payment_id, action=action, error=str(e))
+        return PaymentResult(payment_id, action, 'ERROR', completed=False)
+    if return_uri is not None:
+        await run_blocking(PAYMENT_LEDGER.record, payment_id, state)
+    return PaymentResult(payment_id, action, state, return_uri, completed=return_uri is not None)
+
+_payment_calls = {}
+
+async def _idempotent(payment_id, action, complete):
+    '''asyncio counterpart of PAYMENT_RESULTS.complete. Holds neither a
+    connection nor an executor thread while awaiting the Beyond call.
+    '''
+    result = PAYMENT_RESULTS.cached(payment_id, action)
+    if result is not None:
+        return result
+    key = (payment_id, action)
+    call = _payment_calls.get(key)
+    if call is None:
+        call = _payment_calls[key] = asyncio.ensure_future(_complete_once(payment_id, action, complete))
+        call.add_done_callback(lambda _: _payment_calls.pop(key, None))
+    return await asyncio.shield(call)
+
+async def _complete_once(payment_id, action, complete):
+    claim = await run_blocking(PAYMENT_RESULTS.try_claim, payment_id, action)
+    while claim is None:
+        # Leased by another worker
+        await asyncio.sleep(PAYMENT_RESULT_POLL_INTERVAL)
+        claim = await run_blocking(PAYMENT_RESULTS.try_claim, payment_id, action)
+    try:
+        result = claim.result if claim.result is not None else await complete()
+    except BaseException:
+        await run_blocking(claim.release)
+        raise
+    await run_blocking(claim.finish, result)
+    return result
+
+async def _authorize(payment_id):
+    '''See app._authorize
+    '''
+    credentials = await _form_credentials(payment_id)
+    if credentials is None:
+        return None
+    shop_id, hostname = credentials
+    if hostname:
+        return lambda: get_installation(hostname)
+
+    async def find_installation():
+        shop = await run_blocking(SHOPS.get_shop, shop_id)
+        if shop is None:
+            return None
+        return await get_installation(shop.hostname)
+    return find_installation
+
+async def _form_credentials(payment_id):
+    '''See app._form_credentials
+    '''
+    if 'form_credentials' not in g:
+        g.form_credentials = None
+        form = await request.form
+        token = form.get('token', '')
+        if token:
+            payment_token = verify_payment_token(token, payment_id, CLIENT_SECRET)
+            if payment_token is not None:
+                g.form_credentials = (payment_token.shop_id, payment_token.hostname)
+        else:
+            shop_id = form.get('shop_id', '')
+            if _validate_signature(form.get('signature', ''), shop_id, payment_id):
+                g.form_credentials = (shop_id, None)
+    return g.form_credentials
+
+@app.route('/payments/<payment_id>/capture', methods=['POST'])
+async def capture_payment(payment_id):
+    payment = None
+    if PAYMENT_RESULTS.cached(payment_id, 'capture') is None:
+        payment = await run_blocking(PAYMENT_LEDGER.get_payment, payment_id)
+
+    async def complete():
+        if payment is not None and payment.state == CANCELED:
+            return PaymentResult(payment_id, 'capture', CANCELED)
+        await run_blocking(PAYMENT_LEDGER.record, payment_id, CAPTURED)
+        return PaymentResult(payment_id, 'capture', CAPTURED)
+    result = await _idempotent(payment_id, 'capture', complete)
+    return precomputed(CAPTURE_RESULTS[result.state])
+
+@app.route('/payments/<payment_id>')
+async def payment_status(payment_id):
+    payment = await run_blocking(PAYMENT_LEDGER.get_payment, payment_id)
+    if payment is None:
+        abort(404)
+    return jsonify({
+        'paymentId' : payment.payment_id,
+        'shopId' : payment.shop_id,
+        'paymentStatus' : payment.state,
+    })
+
+def generate_id():
+    return ''.join(random.choice('ABCDEFGHJKLMNPQRSTUVWXYZ23456789') for _ in range(8))
+
+@app.before_request
+async def limit_open_proxy_requests():
+    '''See app.limit_open_proxy_requests
+    '''
+    if not is_allowed_request():
+        LOGGER.warning('Someone is messing with us', url_root=request.url_root)
+        abort(403)
+
+def is_allowed_request():
+    return HOST_ALLOW_LIST.allows(request.host)
+
+async def _no_shop_id():
+    return None
+
+async def _json_shop_id():
+    return (await request.get_json(force=True, silent=True) or {}).get('shopId')
+
+async def _approval_rate_limit_key():
+    credentials = await _form_credentials(request.view_args['payment_id'])
+    if credentials is None:
+        return 'unverified:%s' % request.remote_addr
+    return credentials[0] or credentials[1]
+
+SHED_ROUTES = {
+    'callback': _no_shop_id,
+    'create_payment': _json_shop_id,
+    'create_embedded_payment': _json_shop_id,
+    'approve_payment': _approval_rate_limit_key,
+    'cancel_payment': _approval_rate_limit_key,
+    'capture_payment': _no_shop_id,
+    'payment_status': _no_shop_id,
+}
+
+@app.before_request
+async def shed_load():
+    '''See app.shed_load
+    '''
+    shop_id_of = SHED_ROUTES.get(request.endpoint)
+    if shop_id_of is None:
+        return None
+    reason = LOAD_SHEDDER.try_enter(request.headers.get('X-Request-Start'))
+    if reason is not None:
+        return _shed(reason, 503, SHED_RETRY_AFTER)
+    g.load_shedder_entered = True
+
+    shop_id = await shop_id_of()
+    if shop_id and SHOP_RATE_LIMITS is not None:
+        if SHOP_RATE_LIMIT_SHARED:
+            retry_after = await run_blocking(SHOP_RATE_LIMITS.try_acquire, str(shop_id))
+        else:
+            retry_after = SHOP_RATE_LIMITS.try_acquire(str(shop_id))
+        if retry_after > 0:
+            return _shed('rate_limited', 429, retry_after)
+    return None
+
+def _shed(reason, status, retry_after):
+    REQUESTS_SHED.inc(route=request.url_rule.rule, reason=reason)
+    LOGGER.warning('Shedding request', route=request.url_rule.rule, reason=reason)
+    return Response('Too Many Requests' if status == 429 else 'Service Unavailable', status=status,
+                    headers={'Retry-After': str(max(1, int(math.ceil(retry_after))))})
+
+@app.teardown_request
+async def leave_load_shedder(error):
+    if g.pop('load_shedder_entered', False):
+        LOAD_SHEDDER.leave()
+
+async def get_installation(hostname):
+    installation = await run_blocking(APP_INSTALLATIONS.get_installation, hostname)
+    if not installation:
+        raise ShopNotKnown(hostname)
+    return installation
+
+@app.errorhandler(404)
+async def page_not_found(e):
+    return precomputed(NOT_FOUND)
+
+class ShopNotKnown(Exception):
+    def __init__(self, hostname):
+        super()
+        self.hostname = hostname
+
+@app.errorhandler(ShopNotKnown)
+async def shop_not_known(e):
+    return await render_cached('index.html', installed=False, error_message='App not installed for the requested shop with hostname %s' % e.hostname)
+
+@app.errorhandler(Exception)
+async def all_exception_handler(error):
+    LOGGER.exception(error)
+    return 'Error', 500
+
+@app.before_serving
+async def init():
+    global APP_INSTALLATIONS
+    global SHOPS
+    global PROVISIONED_PAYMENT_METHODS
+    global PAYMENT_RESULTS
+    global PAYMENT_LEDGER
+    global STATIC_ASSETS
+    global SHOP_RATE_LIMITS
+    global DEFAULT_HOSTNAME
+    global CLIENT_SECRET
+
+    logs.setup()
+    metrics.setup()
+
+    STATIC_ASSETS = StaticAssets(app.static_folder)
+    metrics.register_cache('pages', PAGE_CACHE)
+
+    CLIENT_ID = os.environ.get('CLIENT_ID', '')
+    CLIENT_SECRET = os.environ.get('CLIENT_SECRET', '')
+
+    LOGGER.info('Initialize PostgresAppInstallations')
+    APP_INSTALLATIONS = PostgresAppInstallations(os.environ.get('DATABASE_URL'), CLIENT_ID, CLIENT_SECRET)
+    metrics.register_cache('installations', APP_INSTALLATIONS.cache)
+
+    LOGGER.info('Initialize PostgresShops')
+    SHOPS = PostgresShops(os.environ.get('DATABASE_URL'))
+
+    PROVISIONED_PAYMENT_METHODS = PostgresProvisionedPaymentMethods(os.environ.get('DATABASE_URL'))
+
+    PAYMENT_RESULTS = PostgresPaymentResults(os.environ.get('DATABASE_URL'))
+    metrics.register_cache('payment_results', PAYMENT_RESULTS.cache)
+
+    PAYMENT_LEDGER = PostgresPaymentLedger(os.environ.get('DATABASE_URL'))
+
+    if SHOP_RATE_LIMIT > 0 and SHOP_RATE_LIMIT_SHARED:
+        SHOP_RATE_LIMITS = PostgresTokenBuckets(os.environ.get('DATABASE_URL'), SHOP_RATE_LIMIT, SHOP_RATE_LIMIT_BURST)
+    elif SHOP_RATE_LIMIT > 0:
+        SHOP_RATE_LIMITS = TokenBuckets(SHOP_RATE_LIMIT, SHOP_RATE_LIMIT_BURST)
+
+@app.after_serving
+async def shutdown():
+    await run_blocking(PAYMENT_LEDGER.close)
+    await http_client_async.close()
+
+if __name__ == '__main__':
+    app.run()
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    End-to-end benchmark of the sync app (gunicorn 'app:create_app()') against a fake
+    Beyond API. Drives the whole merchant flow, one phase after another:
+
+        callback            install callback, i.e. token, shop id and payment methods
+        embedded_payment    POST /embedded-payments
+        approval_page       GET of the embedded approval URI
+        approve             POST of the approval form
+
+    and reports throughput, latency percentiles, and Postgres operations
+    and Beyond API calls per request, taken from the app's /metrics.
+
+    Compare to a stored baseline and fail on regressions:
+        DATABASE_URL=postgresql://... python -m benchmarks.e2e --baseline benchmarks/baseline.json
+    Record a new baseline:
+        DATABASE_URL=postgresql://... python -m benchmarks.e2e --save-baseline benchmarks/baseline.json
+'''
+
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from urllib.parse import urlencode, urlparse, parse_qs
+
+import requests
+
+from benchmarks.fake_beyond import FakeBeyond
+from benchmarks.load import free_port, print_table, run_load, start_server, stop_server
+import migrations
+from signers import sign
+
+CLIENT_ID = 'benchmark-client'
+CLIENT_SECRET = 'benchmark-secret'
+SHOP_ID = 'benchmark-shop'
+METRICS_FLUSH_INTERVAL = 0.1
+# All shops of the fake Beyond API share one host, so its bulkhead must not limit the load
+BULKHEAD_SIZE = '100000'
+# The load comes from one shop, so its rate limit must not limit it either
+SHOP_RATE_LIMIT = '0'
+
+PHASES = ['callback', 'embedded_payment', 'approval_page', 'approve']
+COLUMNS = ['phase', 'requests', 'errors', 'throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'db_queries', 'outbound_calls']
+
+SAMPLE = re.compile(r'^(?P<name>[a-z_]+)_count\{(?P<labels>[^}]*)\} (?P<value>\S+)$')
+
+def scrape(base_url):
+    """Totals of the duration histogram counts, per metric and operation label
+    """
+    # Let every worker write a fresh snapshot
+    time.sleep(METRICS_FLUSH_INTERVAL * 3)
+    counts = Counter()
+    for line in requests.get('%s/metrics' % base_url, timeout=10).text.splitlines():
+        match = SAMPLE.match(line)
+        if match:
+            operation = re.search(r'operation="([^"]*)"', match.group('labels'))
+            counts[(match.group('name'), operation.group(1) if operation else '')] += float(match.group('value'))
+    return counts
+
+def total(counts, name):
+    return sum(value for (metric, _), value in counts.items() if metric == name)
+
+class Flow(object):
+    """The merchant flow, keeping what a phase needs from the earlier ones
+    """
+    def __init__(self, base_url, fake_beyond):
+        self.base_url = base_url
+        self.fake_beyond = fake_beyond
+        self.approval_queries = {}
+        # Approve results are kept across runs, so every run uses new payments
+        self.run_id = uuid.uuid4().hex[:8]
+
+    def payment_id(self, i):
+        return 'payment-%s-%i' % (self.run_id, i)
+
+    def callback(self, session, i):
+        code = 'code-%i' % i
+        params = {
+            'api_url': self.fake_beyond.api_url,
+            'access_token_url': self.fake_beyond.token_url,
+            'code': code,
+            'signature': sign('%s:%s' % (code, self.fake_beyond.token_url), CLIENT_SECRET),
+            'return_url': 'https://shop.example.com/cockpit'
+        }
+        response = session.get('%s/callback?%s' % (self.base_url, urlencode(params)))
+        return response.status_code == 200 and b'went wrong' not in response.content
+
+    def embedded_payment(self, session, i):
+        response = session.post('%s/embedded-payments' % self.base_url,
+                                json={'shopId': SHOP_ID, 'paymentId': self.payment_id(i), 'shop': {'name': 'benchmark'}})
+        if response.status_code != 200:
+            return False
+        self.approval_queries[i] = urlparse(response.json()['embeddedApprovalUri']).query
+        return 'token' in parse_qs(self.approval_queries[i])
+
+    def approval_page(self, session, i):
+        response = session.get('%s/embedded-payment-approval?%s' % (self.base_url, self.approval_queries[i]))
+        return response.status_code == 200 and b'formaction' in response.content
+
+    def approve(self, session, i):
+        token = parse_qs(self.approval_queries[i])['token'][0]
+        response = session.post('%s/payments/%s/approve' % (self.base_url, self.payment_id(i)), data={'token': token})
+        return response.status_code == 200 and b'approved' in response.content
+
+def run(args):
+    migrations.migrate(os.environ['DATABASE_URL'])
+    fake_beyond = FakeBeyond(latency=args.latency, shop_id=SHOP_ID, error_rate=args.error_rate).start()
+    metrics_dir = tempfile.mkdtemp(prefix='payment-app-benchmark-metrics-')
+    port = free_port()
+    base_url = 'http://127.0.0.1:%i' % port
+    server = start_server(['gunicorn', '-c', 'gunicorn.conf.py', '-w', str(args.workers), '-k', 'gthread',
+                           '--threads', str(args.threads), '-b', '127.0.0.1:%i' % port, 'app:create_app()'], port,
+                          env={'CLIENT_ID': CLIENT_ID, 'CLIENT_SECRET': CLIENT_SECRET,
+                               'METRICS_DIR': metrics_dir, 'METRICS_FLUSH_INTERVAL': str(METRICS_FLUSH_INTERVAL),
+                               'SYSTEM_API_URL': fake_beyond.api_url, 'LOG_LEVEL': 'WARNING',
+                               'CIRCUIT_BULKHEAD_SIZE': BULKHEAD_SIZE, 'SHOP_RATE_LIMIT': SHOP_RATE_LIMIT})
+    flow = Flow(base_url, fake_beyond)
+    rows = []
+    try:
+        for phase in PHASES:
+            before = scrape(base_url)
+            fake_beyond.reset_calls()
+            result = run_load(getattr(flow, phase), args.requests, args.concurrency)
+            after = scrape(base_url)
+            result['phase'] = phase
+            result['db_queries'] = (total(after, 'db_query_duration_seconds') - total(before, 'db_query_duration_seconds')) / args.requests
+            result['outbound_calls'] = (total(after, 'outbound_request_duration_seconds') - total(before, 'outbound_request_duration_seconds')) / args.requests
+            result['fake_beyond_calls'] = dict(fake_beyond.reset_calls())
+            rows.append(result)
+    finally:
+        stop_server(server)
+        fake_beyond.stop()
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+    return rows
+
+def regressions(rows, baseline, tolerance, count_tolerance):
+    """Human readable descriptions of everything worse than the baseline
+    """
+    found = []
+    baseline_rows = dict((row['phase'], row) for row in baseline['phases'])
+    for row in rows:
+        expected = baseline_rows.get(row['phase'])
+        if expected is None:
+            continue
+        phase = row['phase']
+        if row['throughput_rps'] < expected['throughput_rps'] * (1 - tolerance):
+            found.append('%s: throughput %.1f/s, baseline %.1f/s' % (phase, row['throughput_rps'], expected['throughput_rps']))
+        # p99 of a few hundred requests is too noisy to compare
+        if row['p95_ms'] > expected['p95_ms'] * (1 + tolerance):
+            found.append('%s: p95 %.1fms, baseline %.1fms' % (phase, row['p95_ms'], expected['p95_ms']))
+        for column in ('db_queries', 'outbound_calls'):
+            if row[column] > expected[column] + count_tolerance:
+                found.append('%s: %.2f %s per request, baseline %.2f' % (phase, row[column], column, expected[column]))
+        if row['errors'] / row['requests'] > expected['errors'] / expected['requests'] + count_tolerance:
+            found.append('%s: %i errors in %i requests, baseline %i in %i' % (phase, row['errors'], row['requests'], expected['errors'], expected['requests']))
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=500, help='requests per phase')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=16, help='threads per worker')
+    parser.add_argument('--latency', type=float, default=0.02, help='fake Beyond API latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of fake Beyond API calls failing with 503')
+    parser.add_argument('--baseline', help='fail if results are worse than this baseline')
+    parser.add_argument('--save-baseline', help='write the results to this file')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed relative throughput and p95 latency regression')
+    parser.add_argument('--count-tolerance', type=float, default=0.05, help='allowed increase of queries, calls and errors per request')
+    args = parser.parse_args()
+
+    if 'DATABASE_URL' not in os.environ:
+        parser.error('DATABASE_URL must point to a Postgres database')
+
+    rows = run(args)
+    print_table(rows, COLUMNS)
+    for row in rows:
+        print('%s Beyond API calls: %s' % (row['phase'], ', '.join('%s=%i' % item for item in sorted(row['fake_beyond_calls'].items()))))
+
+    settings = dict((key, getattr(args, key)) for key in ('requests', 'concurrency', 'workers', 'threads', 'latency', 'error_rate'))
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'settings': settings, 'phases': rows}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('Saved baseline to %s' % args.save_baseline)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('settings') != settings:
+            print('Warning: baseline was recorded with %s' % baseline.get('settings'))
+        found = regressions(rows, baseline, args.tolerance, args.count_tolerance)
+        for regression in found:
+            print('REGRESSION %s' % regression)
+        if found:
+            sys.exit(1)
+        print('No regressions against %s' % args.baseline)
+
+if __name__ == '__main__':
+    main()
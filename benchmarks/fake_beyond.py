@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    Local stand-in for the Beyond API, answering the calls the payment app
+    makes after a configurable delay. A configurable fraction of the calls
+    fails with 503, and every call is counted per route.
+
+    Payment method definitions are preloaded from test/*.json and served
+    both on the system API and on the shop API. GET responses carry an ETag
+    and answer a matching If-None-Match with 304.
+
+    Run standalone with: python -m benchmarks.fake_beyond [port]
+'''
+
+import glob
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FAKE_BEYOND_LATENCY = float(os.environ.get('FAKE_BEYOND_LATENCY', '0.05'))
+FAKE_BEYOND_ERROR_RATE = float(os.environ.get('FAKE_BEYOND_ERROR_RATE', '0'))
+
+DEFINITIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test')
+
+def load_definitions(directory=DEFINITIONS_DIR):
+    definitions = {}
+    for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+        with open(path) as f:
+            definition = json.load(f)
+        definitions[definition['_id']] = definition
+    return definitions
+
+# Routes the fake answers, as (method, pattern, name). Names are used for the call counts.
+ROUTES = [
+    ('POST', re.compile(r'/oauth/token$'), 'token'),
+    ('GET', re.compile(r'/shop-id$'), 'shop_id'),
+    ('POST', re.compile(r'/payments/[^/]+/approve$'), 'approve_payment'),
+    ('POST', re.compile(r'/payments/[^/]+/cancel$'), 'cancel_payment'),
+    ('POST', re.compile(r'/payments/[^/]+/capture$'), 'capture_payment'),
+    ('GET', re.compile(r'/payment-method-definitions$'), 'get_payment_method_definitions'),
+    ('POST', re.compile(r'/payment-method-definitions$'), 'create_payment_method_definition'),
+    ('GET', re.compile(r'/payment-method-definitions/(?P<name>[^/]+)$'), 'get_payment_method_definition'),
+    ('PUT', re.compile(r'/payment-method-definitions/(?P<name>[^/]+)$'), 'update_payment_method_definition'),
+    ('POST', re.compile(r'/payment-method-definitions/(?P<name>[^/]+)/payment-method$'), 'create_payment_method'),
+]
+
+class FakeBeyondHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def _dispatch(self, method):
+        body = self._read_body()
+        path = self.path.split('?', 1)[0]
+        for route_method, pattern, name in ROUTES:
+            match = pattern.search(path)
+            if route_method == method and match:
+                self.server.count(name)
+                if self.server.error_rate and random.random() < self.server.error_rate:
+                    return self._reply(503, {'error': 'injected failure'})
+                return self._reply(*getattr(self, '_' + name)(body, **match.groupdict()))
+        self.server.count('unknown')
+        return self._reply(404, {})
+
+    def _token(self, body):
+        return 200, {
+            'access_token': 'fake-access-token',
+            'refresh_token': 'fake-refresh-token',
+            'expires_in': 3600
+        }
+
+    def _shop_id(self, body):
+        return 200, {'shopId': self.server.shop_id}
+
+    def _approve_payment(self, body):
+        return 200, {'returnUri': 'https://shop.example.com/checkout/return'}
+
+    _cancel_payment = _approve_payment
+
+    def _capture_payment(self, body):
+        return 200, {'paymentStatus': 'CAPTURED'}
+
+    def _get_payment_method_definitions(self, body):
+        return 200, {'_embedded': {'payment-method-definitions': self.server.list_definitions()}}
+
+    def _create_payment_method_definition(self, body):
+        definition = json.loads(body or b'{}')
+        if definition.get('_id') in self.server.definitions:
+            return 409, {'error': 'already exists'}
+        self.server.store_definition(definition.get('_id'), definition)
+        return 201, definition
+
+    def _get_payment_method_definition(self, body, name):
+        definition = self.server.definitions.get(name)
+        return (200, definition) if definition is not None else (404, {})
+
+    def _update_payment_method_definition(self, body, name):
+        definition = dict(json.loads(body or b'{}'), _id=name)
+        self.server.store_definition(name, definition)
+        return 200, definition
+
+    def _create_payment_method(self, body, name):
+        return (200, {}) if name in self.server.definitions else (404, {})
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _reply(self, status, payload):
+        time.sleep(self.server.latency)
+        body = json.dumps(payload, sort_keys=True).encode('utf-8')
+        etag = None
+        if self.command == 'GET' and status == 200:
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                status, body = 304, b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/hal+json')
+        self.send_header('Content-Length', str(len(body)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeBeyond(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, port=0, latency=FAKE_BEYOND_LATENCY, shop_id='fake-shop-id', error_rate=FAKE_BEYOND_ERROR_RATE, definitions=None):
+        super().__init__(('127.0.0.1', port), FakeBeyondHandler)
+        self.latency = latency
+        self.shop_id = shop_id
+        self.error_rate = error_rate
+        self.definitions = definitions if definitions is not None else load_definitions()
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def api_url(self):
+        return 'http://127.0.0.1:%i/api' % self.server_address[1]
+
+    @property
+    def token_url(self):
+        return '%s/oauth/token' % self.api_url
+
+    def count(self, name):
+        with self._lock:
+            self.calls[name] += 1
+
+    def reset_calls(self):
+        """Return the call counts so far and start counting from zero
+        """
+        with self._lock:
+            calls, self.calls = self.calls, Counter()
+        return calls
+
+    def list_definitions(self):
+        with self._lock:
+            return list(self.definitions.values())
+
+    def store_definition(self, name, definition):
+        with self._lock:
+            self.definitions[name] = definition
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='fake-beyond', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+if __name__ == '__main__':
+    server = FakeBeyond(int(sys.argv[1]) if len(sys.argv) > 1 else 8090)
+    print('Fake Beyond API on %s' % server.api_url)
+    server.serve_forever()
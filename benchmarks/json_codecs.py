@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    Micro-benchmark of the available json_codec codecs: decoding and
+    encoding the HAL payloads in test/*.json (or the files given), and the
+    get_json plus jsonify round trip of an embedded payment in Flask.
+
+        python -m benchmarks.json_codecs
+'''
+
+import argparse
+import glob
+import os
+import timeit
+
+from flask import Flask, jsonify, request
+
+from benchmarks.load import ROOT, print_table
+import json_codec
+
+EMBEDDED_PAYMENT = {
+    'paymentId': 'e1f1e5fb-5ef2-4c4e-8b4e-3b0a2a1c8d3f',
+    'shopId': '0b7a4b1e-73c4-4d8e-9a4f-2f8e6c1d5a7b',
+    'shop': {'name': 'benchmark'}
+}
+
+def codecs():
+    available = [json_codec.StdlibCodec()]
+    if json_codec.orjson is not None:
+        available.append(json_codec.OrjsonCodec())
+    return available
+
+def microseconds(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+def flask_round_trip(codec):
+    app = Flask(__name__)
+    json_codec.init_app(app)
+    app.json.codec = codec
+    body = codec.dumps(EMBEDDED_PAYMENT)
+
+    def round_trip():
+        with app.test_request_context('/embedded-payments', method='POST', data=body, content_type='application/json'):
+            return jsonify(request.get_json(force=True)).get_data()
+    return round_trip
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=2000)
+    parser.add_argument('paths', nargs='*', help='JSON files, test/*.json by default')
+    args = parser.parse_args()
+
+    paths = args.paths or sorted(glob.glob(os.path.join(ROOT, 'test', '*.json')))
+    rows = []
+    round_trips = []
+    for codec in codecs():
+        for path in paths:
+            with open(path, 'rb') as f:
+                data = f.read()
+            payload = codec.loads(data)
+            rows.append({
+                'payload': os.path.basename(path),
+                'codec': codec.name,
+                'bytes': len(data),
+                'decode_us': microseconds(lambda: codec.loads(data), args.number),
+                'encode_us': microseconds(lambda: codec.dumps(payload), args.number)
+            })
+        round_trips.append({'codec': codec.name, 'get_json_jsonify_us': microseconds(flask_round_trip(codec), args.number)})
+    print_table(rows, ['payload', 'codec', 'bytes', 'decode_us', 'encode_us'])
+    print()
+    print_table(round_trips, ['codec', 'get_json_jsonify_us'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    Helpers to drive HTTP load against a locally started app and to
+    summarize the observed latencies.
+'''
+
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_server(command, port, env=None, timeout=30):
+    """Start a server process from the repository root and wait until it answers.
+    """
+    process = subprocess.Popen(command, cwd=ROOT, env=dict(os.environ, **(env or {})),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('%s exited with %i' % (' '.join(command), process.returncode))
+        try:
+            requests.get('http://127.0.0.1:%i/merchants/ping' % port, timeout=1)
+            return process
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    stop_server(process)
+    raise RuntimeError('%s did not come up within %is' % (' '.join(command), timeout))
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def run_load(send, total_requests, concurrency):
+    """Call send(session, i) total_requests times from concurrency threads.
+
+    send returns True on success. Returns throughput and latency statistics.
+    """
+    local = threading.local()
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def one(i):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        started = time.perf_counter()
+        try:
+            ok = send(local.session, i)
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if not ok:
+                errors[0] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(total_requests)))
+    duration = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': total_requests,
+        'errors': errors[0],
+        'duration_s': duration,
+        'throughput_rps': total_requests / duration if duration else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000
+    }
+
+def print_table(rows, columns):
+    print(' | '.join('%14s' % column for column in columns))
+    for row in rows:
+        print(' | '.join(('%14.1f' % row[column]) if isinstance(row[column], float) else ('%14s' % row[column])
+                         for column in columns))
+    sys.stdout.flush()
+
+def cpu_seconds(pid):
+    """CPU time used so far by a process and all its descendants, Linux only
+    """
+    ticks = os.sysconf('SC_CLK_TCK')
+    parents = {}
+    times = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                # The command name may contain spaces, the fields after it don't
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (IOError, IndexError):
+            continue
+        parents[int(entry)] = int(fields[1])
+        times[int(entry)] = (int(fields[11]) + int(fields[12])) / float(ticks)
+    tree = set([pid])
+    for _ in range(len(parents)):
+        grown = tree | set(child for child, parent in parents.items() if parent in tree)
+        if grown == tree:
+            break
+        tree = grown
+    return sum(times.get(member, 0.0) for member in tree)
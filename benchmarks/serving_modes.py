@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    Compare approve throughput of the sync (gunicorn app:app) and asyncio
+    (hypercorn asgi_app:app) serving modes against a fake Beyond API.
+
+    Needs a local Postgres:
+        DATABASE_URL=postgresql://... python -m benchmarks.serving_modes
+'''
+
+import argparse
+import os
+import uuid
+from datetime import datetime, timedelta
+
+from app_installations import Installation, PostgresAppInstallations
+from benchmarks.fake_beyond import FakeBeyond
+from benchmarks.load import free_port, print_table, run_load, start_server, stop_server
+import migrations
+from shops import PostgresShops, Shop
+from signers import sign
+
+CLIENT_SECRET = 'benchmark-secret'
+SHOP_ID = 'benchmark-shop'
+# All shops of the fake Beyond API share one host, so its bulkhead must not limit the load
+BULKHEAD_SIZE = '100000'
+# The load comes from one shop, so its rate limit must not limit it either
+SHOP_RATE_LIMIT = '0'
+
+def seed(database_url, api_url):
+    migrations.migrate(database_url)
+    installations = PostgresAppInstallations(database_url, 'benchmark-client', CLIENT_SECRET)
+    installation = Installation(api_url=api_url,
+                                access_token='benchmark-access-token',
+                                refresh_token='benchmark-refresh-token',
+                                expiry_date=datetime.now() + timedelta(hours=2))
+    installations.create_or_update_installation(installation)
+    shops = PostgresShops(database_url)
+    shops.create_or_update_shop(Shop(SHOP_ID, installation.hostname))
+
+def approve(port):
+    # Approve results are kept, so every run approves new payments
+    run_id = uuid.uuid4().hex[:8]
+    def send(session, i):
+        payment_id = 'payment-%s-%i' % (run_id, i)
+        response = session.post('http://127.0.0.1:%i/payments/%s/approve' % (port, payment_id),
+                                data={'shop_id': SHOP_ID, 'signature': sign('%s:%s' % (SHOP_ID, payment_id), CLIENT_SECRET)})
+        return response.status_code == 200 and b'approved' in response.content
+    return send
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=2, help='worker processes per server')
+    parser.add_argument('--latency', type=float, default=0.05, help='fake Beyond API latency in seconds')
+    args = parser.parse_args()
+
+    database_url = os.environ['DATABASE_URL']
+    fake_beyond = FakeBeyond(latency=args.latency).start()
+    seed(database_url, fake_beyond.api_url)
+
+    modes = [
+        ('sync', ['gunicorn', '-w', str(args.workers), '-b', '127.0.0.1:{port}', 'app:app']),
+        ('asyncio', ['hypercorn', '-w', str(args.workers), '-b', '127.0.0.1:{port}', 'asgi_app:app'])
+    ]
+    rows = []
+    try:
+        for mode, command in modes:
+            port = free_port()
+            server = start_server([part.format(port=port) for part in command], port,
+                                  env={'CLIENT_ID': 'benchmark-client', 'CLIENT_SECRET': CLIENT_SECRET,
+                                       'CIRCUIT_BULKHEAD_SIZE': BULKHEAD_SIZE, 'SHOP_RATE_LIMIT': SHOP_RATE_LIMIT})
+            try:
+                run_load(approve(port), args.concurrency, args.concurrency)  # warm up
+                result = run_load(approve(port), args.requests, args.concurrency)
+            finally:
+                stop_server(server)
+            result['mode'] = mode
+            rows.append(result)
+    finally:
+        fake_beyond.stop()
+
+    print_table(rows, ['mode', 'requests', 'errors', 'throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms'])
+
+if __name__ == '__main__':
+    main()
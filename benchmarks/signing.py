@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    Micro-benchmark of the per-request signing cost: the previous
+    hmac.new per call and == comparison versus the precomputed Signer.
+
+        python -m benchmarks.signing
+'''
+
+import argparse
+import base64
+import hashlib
+import hmac
+import timeit
+
+from benchmarks.load import print_table
+from signers import Signer, sign
+
+SECRET = 'ha2e25nfmvo1dgeqsncd3nqsoj'
+MESSAGE = 'e1f1e5fb-5ef2-4c4e-8b4e-3b0a2a1c8d3f:0b7a4b1e-73c4-4d8e-9a4f-2f8e6c1d5a7b'
+
+def sign_per_call(message, secret):
+    digest = hmac.new(secret.encode('utf-8'),
+                      msg=message.encode('utf-8'),
+                      digestmod=hashlib.sha1).digest()
+    return base64.b64encode(digest).decode('utf-8')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=200000)
+    args = parser.parse_args()
+
+    sha1 = Signer(SECRET)
+    sha256 = Signer(SECRET, digest='sha256')
+    signature = sha1.sign(MESSAGE)
+    batch = [MESSAGE] * 100
+
+    cases = [
+        ('sign, hmac.new per call', lambda: sign_per_call(MESSAGE, SECRET), 1),
+        ('sign, Signer sha1', lambda: sha1.sign(MESSAGE), 1),
+        ('signers.sign', lambda: sign(MESSAGE, SECRET), 1),
+        ('sign, Signer sha256', lambda: sha256.sign(MESSAGE), 1),
+        ('verify, hmac.new and ==', lambda: sign_per_call(MESSAGE, SECRET) == signature, 1),
+        ('verify, Signer', lambda: sha1.verify(MESSAGE, signature), 1),
+        ('sign_many, per message', lambda: sha1.sign_many(batch), len(batch))
+    ]
+    rows = []
+    for name, fn, messages in cases:
+        seconds = min(timeit.repeat(fn, number=args.number // messages, repeat=5))
+        rows.append({'case': name, 'ns_per_message': seconds / (args.number // messages * messages) * 1e9})
+    print_table(rows, ['case', 'ns_per_message'])
+
+if __name__ == '__main__':
+    main()
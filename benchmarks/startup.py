@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    Startup time of the sync app: how long importing app takes in a fresh
+    interpreter, and how long gunicorn 'app:create_app()' takes from launch
+    to answering its first request that reads from Postgres.
+
+    Needs a local Postgres:
+        DATABASE_URL=postgresql://... python -m benchmarks.startup
+'''
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import requests
+
+from benchmarks.load import ROOT, free_port, print_table, stop_server
+import migrations
+
+IMPORT_APP = 'import time; started = time.perf_counter(); import app; print(time.perf_counter() - started)'
+
+def import_seconds():
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_APP], cwd=ROOT, stderr=subprocess.DEVNULL)
+    return float(output.decode('utf-8').strip().splitlines()[-1])
+
+def first_request_seconds(workers, timeout=60):
+    port = free_port()
+    started = time.perf_counter()
+    process = subprocess.Popen(['gunicorn', '-c', 'gunicorn.conf.py', '-w', str(workers), '-b', '127.0.0.1:%i' % port, 'app:create_app()'],
+                               cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                # Unknown payments are looked up in Postgres and answered with 404
+                response = requests.get('http://127.0.0.1:%i/payments/startup-probe' % port, timeout=5)
+                if response.status_code == 404:
+                    return time.perf_counter() - started
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.01)
+        raise RuntimeError('gunicorn did not answer within %is' % timeout)
+    finally:
+        stop_server(process)
+
+def summarize(name, values):
+    return {
+        'measure': name,
+        'runs': len(values),
+        'median_ms': statistics.median(values) * 1000,
+        'max_ms': max(values) * 1000
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    if 'DATABASE_URL' not in os.environ:
+        parser.error('DATABASE_URL must point to a Postgres database')
+    migrations.migrate(os.environ['DATABASE_URL'])
+
+    rows = [
+        summarize('import app', [import_seconds() for _ in range(args.runs)]),
+        summarize('first request', [first_request_seconds(args.workers) for _ in range(args.runs)])
+    ]
+    print_table(rows, ['measure', 'runs', 'median_ms', 'max_ms'])
+
+if __name__ == '__main__':
+    main()
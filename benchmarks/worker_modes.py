@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    Compare gunicorn sync workers, one request per process at a time,
+    with the threaded high-concurrency mode configured in gunicorn.conf.py,
+    on approvals against a fake Beyond API.
+
+    Besides throughput it reports the CPU time the server used, and
+    requests per CPU second, i.e. what one fully used core serves.
+
+    Needs a local Postgres:
+        DATABASE_URL=postgresql://... python -m benchmarks.worker_modes
+'''
+
+import argparse
+import os
+
+from benchmarks.fake_beyond import FakeBeyond
+from benchmarks.load import cpu_seconds, free_port, print_table, run_load, start_server, stop_server
+from benchmarks.serving_modes import BULKHEAD_SIZE, CLIENT_SECRET, SHOP_RATE_LIMIT, approve, seed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=2, help='worker processes per server')
+    parser.add_argument('--latency', type=float, default=0.05, help='fake Beyond API latency in seconds')
+    args = parser.parse_args()
+
+    database_url = os.environ['DATABASE_URL']
+    fake_beyond = FakeBeyond(latency=args.latency).start()
+    seed(database_url, fake_beyond.api_url)
+
+    modes = [
+        ('sync', ['-k', 'sync', '--threads', '1']),
+        ('gthread', [])
+    ]
+    rows = []
+    try:
+        for mode, options in modes:
+            port = free_port()
+            server = start_server(['gunicorn', '-c', 'gunicorn.conf.py', '-w', str(args.workers)] + options +
+                                  ['-b', '127.0.0.1:%i' % port, 'app:create_app()'], port,
+                                  env={'CLIENT_ID': 'benchmark-client', 'CLIENT_SECRET': CLIENT_SECRET,
+                                       'CIRCUIT_BULKHEAD_SIZE': BULKHEAD_SIZE, 'SHOP_RATE_LIMIT': SHOP_RATE_LIMIT,
+                                       'LOG_LEVEL': 'WARNING'})
+            try:
+                run_load(approve(port), args.concurrency, args.concurrency)  # warm up
+                cpu_before = cpu_seconds(server.pid)
+                result = run_load(approve(port), args.requests, args.concurrency)
+                result['cpu_s'] = cpu_seconds(server.pid) - cpu_before
+            finally:
+                stop_server(server)
+            result['mode'] = mode
+            result['rps_per_core'] = result['requests'] / result['cpu_s'] if result['cpu_s'] else 0.0
+            rows.append(result)
+    finally:
+        fake_beyond.stop()
+
+    print_table(rows, ['mode', 'requests', 'errors', 'throughput_rps', 'cpu_s', 'rps_per_core', 'p50_ms', 'p99_ms'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    asyncio versions of the Beyond API calls made from request handlers.
+    Same behaviour as their namesakes in payments, shops and
+    payment_method_definitions.
+'''
+
+from http_client import json_body
+import http_client_async
+
+async def approve_payment(installation, payment_id):
+    response = await http_client_async.post('%s/payments/%s/approve' % (installation.api_url, payment_id),
+                                            access_token=installation.access_token, operation='approve_payment',
+                                            circuit=installation.hostname)
+    return json_body(response).get('returnUri', None)
+
+async def cancel_payment(installation, payment_id):
+    response = await http_client_async.post('%s/payments/%s/cancel' % (installation.api_url, payment_id),
+                                            access_token=installation.access_token, operation='cancel_payment',
+                                            circuit=installation.hostname)
+    return json_body(response).get('returnUri', None)
+
+async def get_shop_id(installation):
+    response = await http_client_async.get('%s/shop-id' % installation.api_url,
+                                           access_token=installation.access_token, operation='get_shop_id',
+                                           circuit=installation.hostname)
+    return json_body(response).get('shopId', None)
+
+async def create_payment_method(installation, payment_method_definition_name):
+    response = await http_client_async.post('%s/payment-method-definitions/%s/payment-method' % (installation.api_url, payment_method_definition_name),
+                                            access_token=installation.access_token, operation='create_payment_method')
+    return response.status_code
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    Per host circuit breakers and bulkheads for outbound calls, so a slow or
+    failing shop API can't tie up every worker.
+
+    A breaker opens when, among the last CIRCUIT_WINDOW calls to a host,
+    the share of failures (errors and 5xx) or of calls slower than
+    CIRCUIT_SLOW_CALL_SECONDS reaches its threshold. While open, calls fail
+    fast with HostUnavailable. After CIRCUIT_OPEN_SECONDS a few probe calls
+    are let through, and the breaker closes again if they succeed.
+
+    A bulkhead caps the calls in flight to one host. Calls beyond the cap
+    fail fast instead of queueing.
+'''
+
+import os
+import threading
+import time
+from collections import deque
+
+import logs
+from metrics import counter
+
+CIRCUIT_WINDOW = int(os.environ.get('CIRCUIT_WINDOW', '20'))
+# Calls in the window before the breaker may open
+CIRCUIT_MIN_CALLS = int(os.environ.get('CIRCUIT_MIN_CALLS', '10'))
+CIRCUIT_FAILURE_RATE = float(os.environ.get('CIRCUIT_FAILURE_RATE', '0.5'))
+CIRCUIT_SLOW_CALL_SECONDS = float(os.environ.get('CIRCUIT_SLOW_CALL_SECONDS', '5'))
+CIRCUIT_SLOW_CALL_RATE = float(os.environ.get('CIRCUIT_SLOW_CALL_RATE', '0.5'))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get('CIRCUIT_OPEN_SECONDS', '30'))
+CIRCUIT_HALF_OPEN_PROBES = int(os.environ.get('CIRCUIT_HALF_OPEN_PROBES', '1'))
+# Maximum number of calls in flight to one host, per process
+CIRCUIT_BULKHEAD_SIZE = int(os.environ.get('CIRCUIT_BULKHEAD_SIZE', '8'))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+LOGGER = logs.get_logger('circuit_breakers')
+CIRCUIT_TRANSITIONS = counter('circuit_breaker_transitions_total', 'Circuit breaker state changes', ['state'])
+CIRCUIT_REJECTIONS = counter('circuit_breaker_rejections_total', 'Outbound calls failed fast', ['reason'])
+
+class HostUnavailable(Exception):
+    def __init__(self, hostname, reason):
+        super().__init__('%s unavailable: %s' % (hostname, reason))
+        self.hostname = hostname
+        self.reason = reason
+
+class CircuitBreaker(object):
+    def __init__(self, hostname='',
+                 window=CIRCUIT_WINDOW,
+                 min_calls=CIRCUIT_MIN_CALLS,
+                 failure_rate=CIRCUIT_FAILURE_RATE,
+                 slow_call_seconds=CIRCUIT_SLOW_CALL_SECONDS,
+                 slow_call_rate=CIRCUIT_SLOW_CALL_RATE,
+                 open_seconds=CIRCUIT_OPEN_SECONDS,
+                 half_open_probes=CIRCUIT_HALF_OPEN_PROBES,
+                 clock=time.monotonic):
+        self.hostname = hostname
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.state = CLOSED
+        self._clock = clock
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """The state the call was admitted in, or None if it must fail fast.
+        Pass it to record when the call is done.
+        """
+        with self._lock:
+            if self.state == OPEN:
+                if self._clock() - self._opened_at < self.open_seconds:
+                    return None
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self._probes >= self.half_open_probes:
+                    return None
+                self._probes += 1
+            return self.state
+
+    def record(self, admitted, failed, seconds):
+        bad = failed or seconds >= self.slow_call_seconds
+        with self._lock:
+            if admitted == HALF_OPEN:
+                self._probes -= 1
+                if self.state == HALF_OPEN and bad:
+                    self._open()
+                elif self.state == HALF_OPEN:
+                    self._transition(CLOSED)
+                return
+            if self.state != CLOSED:
+                # Started before the breaker opened
+                return
+            self._outcomes.append((failed, seconds >= self.slow_call_seconds))
+            if len(self._outcomes) >= self.min_calls and (
+                    self._rate(0) >= self.failure_rate or self._rate(1) >= self.slow_call_rate):
+                self._open()
+
+    def _rate(self, index):
+        return sum(1 for outcome in self._outcomes if outcome[index]) / float(len(self._outcomes))
+
+    def _open(self):
+        self._opened_at = self._clock()
+        self._transition(OPEN)
+
+    def _transition(self, state):
+        self.state = state
+        self._outcomes.clear()
+        CIRCUIT_TRANSITIONS.inc(state=state)
+        LOGGER.warning('Circuit breaker changed state', hostname=self.hostname, state=state)
+
+class Bulkhead(object):
+    def __init__(self, size=CIRCUIT_BULKHEAD_SIZE):
+        self.size = size
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        with self._lock:
+            if self.in_flight >= self.size:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+class CircuitBreakers(object):
+    """A breaker and a bulkhead per hostname. Never block, so they can be
+    used from threads and from the event loop alike.
+    """
+    def __init__(self, breaker_factory=CircuitBreaker, bulkhead_size=CIRCUIT_BULKHEAD_SIZE):
+        self.breaker_factory = breaker_factory
+        self.bulkhead_size = bulkhead_size
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, hostname):
+        """Admit a call to hostname or raise HostUnavailable. Always release an admitted call.
+        """
+        breaker, bulkhead = self._host(hostname)
+        if not bulkhead.try_acquire():
+            CIRCUIT_REJECTIONS.inc(reason='bulkhead_full')
+            raise HostUnavailable(hostname, 'too many calls in flight')
+        admitted = breaker.allow()
+        if admitted is None:
+            bulkhead.release()
+            CIRCUIT_REJECTIONS.inc(reason='circuit_open')
+            raise HostUnavailable(hostname, 'circuit open')
+        return admitted
+
+    def release(self, hostname, admitted, failed, seconds):
+        breaker, bulkhead = self._host(hostname)
+        bulkhead.release()
+        breaker.record(admitted, failed, seconds)
+
+    def call(self, hostname, fn):
+        """fn() returning a response, guarded by the breaker and bulkhead of hostname
+        """
+        admitted = self.acquire(hostname)
+        started = time.perf_counter()
+        failed = True
+        try:
+            response = fn()
+            failed = response.status_code >= 500
+            return response
+        finally:
+            self.release(hostname, admitted, failed, time.perf_counter() - started)
+
+    def state(self, hostname):
+        return self._host(hostname)[0].state
+
+    def _host(self, hostname):
+        with self._lock:
+            host = self._hosts.get(hostname)
+            if host is None:
+                host = self._hosts[hostname] = (self.breaker_factory(hostname), Bulkhead(self.bulkhead_size))
+            return host
+
+BREAKERS = CircuitBreakers()
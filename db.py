@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    Shared, per-process Postgres connection pools.
+'''
+
+import hashlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+from itertools import islice
+
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_INERROR
+from psycopg2 import pool as pg_pool
+
+POOL_MIN_SIZE = int(os.environ.get('DATABASE_POOL_MIN_SIZE', '1'))
+# Connections per process, gunicorn.conf.py sizes it for its workers
+POOL_MAX_SIZE = int(os.environ.get('DATABASE_POOL_MAX_SIZE', '10'))
+# Seconds to wait for a free connection before giving up
+POOL_TIMEOUT = float(os.environ.get('DATABASE_POOL_TIMEOUT', '5'))
+# Connections idle for longer than this are pinged before being handed out
+POOL_HEALTH_CHECK_INTERVAL = float(os.environ.get('DATABASE_POOL_HEALTH_CHECK_INTERVAL', '30'))
+# Rows per statement for bulk writes
+BULK_PAGE_SIZE = int(os.environ.get('DATABASE_BULK_PAGE_SIZE', '500'))
+
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool(object):
+    """Thread-safe pool of psycopg2 connections to one database.
+
+    The underlying pool is created lazily and re-created after a fork, so a
+    pool touched in the gunicorn master never leaks sockets into workers.
+    """
+    def __init__(self, database_url,
+                 min_size=POOL_MIN_SIZE,
+                 max_size=POOL_MAX_SIZE,
+                 timeout=POOL_TIMEOUT,
+                 health_check_interval=POOL_HEALTH_CHECK_INTERVAL):
+        self.database_url = database_url
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._lock = threading.Lock()
+        self._pool = None
+        self._slots = None
+        self._last_used = {}
+        self._pid = None
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of the with block.
+
+        Like ``with psycopg2.connect(...)``, the transaction is committed when
+        the block succeeds and rolled back when it raises.
+        """
+        pool, slots = self._current_pool()
+        if not slots.acquire(timeout=self.timeout):
+            raise PoolTimeout('No database connection available within %.1fs' % self.timeout)
+        conn = None
+        discard = False
+        try:
+            conn = self._checkout(pool)
+            with conn:
+                yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        finally:
+            if conn is not None:
+                self._checkin(pool, conn, discard or bool(conn.closed))
+            slots.release()
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.closeall()
+            self._forget()
+
+    def reset(self):
+        """Drop the pool without closing its connections.
+
+        Meant for freshly forked workers: the sockets belong to the parent
+        and closing them here would break the parent's sessions.
+        """
+        with self._lock:
+            self._forget()
+
+    def _forget(self):
+        self._pool = None
+        self._slots = None
+        self._last_used = {}
+        self._pid = None
+
+    def _current_pool(self):
+        pid = os.getpid()
+        with self._lock:
+            if self._pool is None or self._pid != pid:
+                self._pool = pg_pool.ThreadedConnectionPool(self.min_size, self.max_size, self.database_url)
+                self._slots = threading.BoundedSemaphore(self.max_size)
+                self._last_used = {}
+                self._pid = pid
+            return self._pool, self._slots
+
+    def _checkout(self, pool):
+        conn = pool.getconn()
+        if conn.closed or not self._is_healthy(conn):
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+        return conn
+
+    def _checkin(self, pool, conn, discard):
+        if discard:
+            self._last_used.pop(id(conn), None)
+        else:
+            self._last_used[id(conn)] = time.monotonic()
+        pool.putconn(conn, close=discard)
+
+    def _is_healthy(self, conn):
+        last_used = self._last_used.get(id(conn))
+        if last_used is not None and time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as curs:
+                curs.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+def get_pool(database_url):
+    """Return the process-wide pool for the given database, creating it on first use.
+    """
+    with _POOLS_LOCK:
+        pool = _POOLS.get(database_url)
+        if pool is None:
+            pool = ConnectionPool(database_url)
+            _POOLS[database_url] = pool
+        return pool
+
+def reset_pools():
+    """Worker lifecycle hook: call right after fork.
+    """
+    with _POOLS_LOCK:
+        for pool in _POOLS.values():
+            pool.reset()
+
+def close_pools():
+    """Worker lifecycle hook: call on worker exit.
+    """
+    with _POOLS_LOCK:
+        for pool in _POOLS.values():
+            pool.close()
+
+def batched(iterable, size=BULK_PAGE_SIZE):
+    """Yield lists of at most size items from iterable.
+    """
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+def last_by_key(rows, key):
+    """Keep the last row per key, as one INSERT ... ON CONFLICT must not touch a row twice.
+    """
+    return list({key(row): row for row in rows}.values())
+
+def advisory_lock_key(name):
+    """Map a name onto the signed 64 bit key space of pg_advisory_lock.
+    """
+    digest = hashlib.sha1(name.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], byteorder='big', signed=True)
+
+@contextmanager
+def advisory_lock(pool, name, timeout):
+    """Hold a Postgres advisory lock for the duration of the with block.
+
+    Session level, so it survives the commit of the enclosing transaction
+    and is held until explicitly released. timeout is a Postgres interval
+    like '30s'. Yields the connection holding the lock.
+    """
+    key = advisory_lock_key(name)
+    with pool.connection() as conn:
+        with conn.cursor() as curs:
+            curs.execute("SET lock_timeout = %s", (timeout,))
+            curs.execute("SELECT pg_advisory_lock(%s)", (key,))
+            curs.execute("RESET lock_timeout")
+        conn.commit()
+        try:
+            yield conn
+        finally:
+            # A failed statement aborts the transaction, the lock outlives a rollback
+            if conn.get_transaction_status() == TRANSACTION_STATUS_INERROR:
+                conn.rollback()
+            with conn.cursor() as curs:
+                curs.execute("SELECT pg_advisory_unlock(%s)", (key,))
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    Gunicorn settings and worker lifecycle hooks.
+
+    Requests mostly wait on Postgres and the Beyond API, so by default every
+    worker process serves GUNICORN_THREADS requests at once (gthread),
+    keeps client connections alive and the app is loaded once in the
+    master before forking:
+
+        WEB_CONCURRENCY          worker processes, one per core by default
+        GUNICORN_WORKER_CLASS    gthread, sync, or gevent (needs gevent and psycogreen)
+        GUNICORN_THREADS         threads per gthread worker
+        GUNICORN_KEEPALIVE       seconds to keep idle client connections open
+        GUNICORN_PRELOAD         load the app in the master, true or false, not with gevent
+        DATABASE_MAX_CONNECTIONS Postgres connections all workers may open together
+
+    Unless DATABASE_POOL_MAX_SIZE is set, each worker's pool gets a
+    connection per request it serves at once, within its share of
+    DATABASE_MAX_CONNECTIONS. Requests beyond that wait for a connection.
+'''
+
+import multiprocessing
+import os
+import tempfile
+
+# One snapshot directory per master, so workers of earlier runs don't count
+os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'payment-app-metrics-%i' % os.getpid()))
+
+workers = int(os.environ.get('WEB_CONCURRENCY', str(multiprocessing.cpu_count())))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', '16'))
+# Concurrent connections per gevent worker
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', '256'))
+
+# Below Postgres' default max_connections of 100, leaving room for the
+# release step, jobs and maintenance sessions
+DATABASE_MAX_CONNECTIONS = int(os.environ.get('DATABASE_MAX_CONNECTIONS', '80'))
+# Read by db on import, so set before the app is loaded
+_worker_concurrency = {'gthread': threads, 'gevent': worker_connections}.get(worker_class, 1)
+os.environ.setdefault('DATABASE_POOL_MAX_SIZE', str(max(1, min(_worker_concurrency, DATABASE_MAX_CONNECTIONS // workers))))
+
+import db
+import logs
+import metrics
+import payment_ledger
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', '5'))
+# gevent must patch the standard library before the app is imported
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'false' if worker_class == 'gevent' else 'true').lower() == 'true'
+
+def on_starting(server):
+    metrics.clear_snapshots()
+
+def post_fork(server, worker):
+    if server.cfg.worker_class_str == 'gevent':
+        # psycopg2 would otherwise block every greenlet of the worker
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    # Connections opened in the master (e.g. with --preload) must not be shared
+    db.reset_pools()
+    # The log writer thread does not survive the fork
+    logs.setup()
+    metrics.setup()
+
+def worker_exit(server, worker):
+    # Buffered payment state changes need the pools, so they go first
+    payment_ledger.close_ledgers()
+    db.close_pools()
+    logs.shutdown()
+    metrics.flush()
+
+def on_exit(server):
+    metrics.clear_snapshots()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    Responses that cost next to nothing to serve: constant payloads
+    serialized once, and static files loaded once and served under content
+    hashed names with long-lived caching and precompressed variants.
+
+    Framework independent: both apps turn the (body, status, headers) of
+    PrecomputedResponse.parts into their own Response.
+'''
+
+import copy
+import gzip
+import hashlib
+import mimetypes
+import os
+
+import json_codec
+
+try:
+    import brotli
+except ImportError:
+    # Optional, only gzip variants without it
+    brotli = None
+
+# Hashed static URLs change with their content, so they may be cached for good
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# Unhashed static URLs and constant payloads are revalidated with their ETag
+REVALIDATE = 'no-cache'
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'image/svg+xml')
+
+class PrecomputedResponse(object):
+    """A body built once, with its ETag and, if compress is set, its gzip
+    and brotli variants where they are smaller.
+    """
+    def __init__(self, body, content_type, status=200, cache_control=REVALIDATE, compress=False):
+        self.content_type = content_type
+        self.status = status
+        self.cache_control = cache_control
+        self.bodies = {'identity': body}
+        if compress:
+            self.bodies.update(_compressed(body))
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.etags = dict((encoding, '"%s"' % digest if encoding == 'identity' else '"%s-%s"' % (digest, encoding))
+                          for encoding in self.bodies)
+        self._headers = self._build_headers()
+
+    @classmethod
+    def json(cls, payload, **kwargs):
+        return cls(json_codec.dumps(payload), 'application/json', **kwargs)
+
+    @classmethod
+    def html(cls, html, **kwargs):
+        return cls(html.encode('utf-8'), 'text/html; charset=utf-8', **kwargs)
+
+    def with_cache_control(self, cache_control):
+        """The same bodies, served with other caching headers
+        """
+        response = copy.copy(self)
+        response.cache_control = cache_control
+        response._headers = response._build_headers()
+        return response
+
+    def parts(self, request_headers):
+        """(body, status, headers) answering a request with the given headers,
+        headers as a list of (name, value). Conditional requests are answered with 304 if the ETag still matches.
+        """
+        encoding = 'identity'
+        if len(self.bodies) > 1:
+            encoding = choose_encoding(request_headers.get('Accept-Encoding', ''), self.bodies)
+        headers = self._headers[encoding]
+        if self.status == 200 and etag_matches(request_headers.get('If-None-Match', ''), self.etags[encoding]):
+            return b'', 304, headers
+        return self.bodies[encoding], self.status, headers
+
+    def _build_headers(self):
+        # Built once per encoding, parts only picks them
+        headers = {}
+        for encoding in self.bodies:
+            headers[encoding] = [('Content-Type', self.content_type)]
+            if len(self.bodies) > 1:
+                headers[encoding].append(('Vary', 'Accept-Encoding'))
+            if encoding != 'identity':
+                headers[encoding].append(('Content-Encoding', encoding))
+            if self.status == 200:
+                headers[encoding].append(('ETag', self.etags[encoding]))
+                if self.cache_control:
+                    headers[encoding].append(('Cache-Control', self.cache_control))
+        return headers
+
+class StaticAssets(object):
+    """The files of a static folder, read once. Each one is served under its
+    own name, revalidated on every use, and under a name carrying a hash of
+    its content, e.g. bootstrap.min.0123456789ab.css, cached for good.
+    """
+    def __init__(self, directory):
+        self._hashed_filenames = {}
+        self._responses = {}
+        for root, _, filenames in os.walk(directory):
+            for name in filenames:
+                path = os.path.join(root, name)
+                filename = os.path.relpath(path, directory).replace(os.sep, '/')
+                with open(path, 'rb') as f:
+                    self._add(filename, f.read())
+
+    def _add(self, filename, body):
+        base, extension = os.path.splitext(filename)
+        hashed_filename = '%s.%s%s' % (base, hashlib.sha256(body).hexdigest()[:12], extension)
+        content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        if content_type.startswith('text/'):
+            content_type += '; charset=utf-8'
+        response = PrecomputedResponse(body, content_type, compress=content_type.startswith(COMPRESSIBLE_TYPES))
+        self._responses[filename] = response
+        self._responses[hashed_filename] = response.with_cache_control(IMMUTABLE)
+        self._hashed_filenames[filename] = hashed_filename
+
+    def url_filename(self, filename):
+        """The content hashed name to link filename with
+        """
+        return self._hashed_filenames.get(filename, filename)
+
+    def get(self, filename):
+        """The PrecomputedResponse of a plain or hashed filename, None if unknown
+        """
+        return self._responses.get(filename)
+
+def _compressed(body):
+    variants = {'gzip': gzip.compress(body, 9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(body)
+    return dict((encoding, compressed) for encoding, compressed in variants.items() if len(compressed) < len(body))
+
+def choose_encoding(accept_encoding, available):
+    """The smallest of the available encodings the client accepts, identity if none.
+    """
+    accepted = set()
+    for coding in accept_encoding.split(','):
+        name, _, parameters = coding.partition(';')
+        parameters = parameters.replace(' ', '')
+        if parameters.startswith('q='):
+            try:
+                if float(parameters[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    candidates = [encoding for encoding in available
+                  if encoding != 'identity' and (encoding in accepted or '*' in accepted)]
+    if not candidates:
+        return 'identity'
+    return min(candidates, key=lambda encoding: len(available[encoding]))
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # Weak comparison, as required for If-None-Match
+    return any(_opaque_tag(candidate) == etag for candidate in if_none_match.split(','))
+
+def _opaque_tag(etag):
+    etag = etag.strip()
+    return etag[2:] if etag.startswith('W/') else etag
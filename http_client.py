@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    Shared HTTP client for outbound calls to the Beyond APIs, with
+    keep-alive connection pools, timeouts and bounded retries.
+'''
+
+import os
+import threading
+import time
+from functools import lru_cache
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from circuit_breakers import BREAKERS
+import json_codec
+from metrics import OUTBOUND_REQUEST_SECONDS
+
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '3.05'))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '10'))
+# Number of hosts to keep connection pools for, and connections kept per host
+HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', '100'))
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', '10'))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', '2'))
+HTTP_BACKOFF_FACTOR = float(os.environ.get('HTTP_BACKOFF_FACTOR', '0.2'))
+
+HAL_JSON = 'application/hal+json'
+
+_lock = threading.Lock()
+_session = None
+_session_pid = None
+
+def _retry():
+    # Idempotent methods are retried on connection, read and 502/503/504
+    # errors. Others like POST only when the connection could not be made
+    # in the first place, i.e. the request never reached the server.
+    options = dict(total=HTTP_MAX_RETRIES,
+                   connect=HTTP_MAX_RETRIES,
+                   read=HTTP_MAX_RETRIES,
+                   status=HTTP_MAX_RETRIES,
+                   backoff_factor=HTTP_BACKOFF_FACTOR,
+                   status_forcelist=(502, 503, 504),
+                   raise_on_status=False)
+    try:
+        return Retry(allowed_methods=Retry.DEFAULT_ALLOWED_METHODS, **options)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=Retry.DEFAULT_METHOD_WHITELIST, **options)
+
+def session():
+    """Return the process-wide session, creating it on first use and after a fork.
+    """
+    global _session
+    global _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _lock:
+            if _session is None or _session_pid != pid:
+                new_session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS,
+                                      pool_maxsize=HTTP_POOL_MAXSIZE,
+                                      max_retries=_retry())
+                new_session.mount('https://', adapter)
+                new_session.mount('http://', adapter)
+                _session = new_session
+                _session_pid = pid
+    return _session
+
+@lru_cache(maxsize=1024)
+def hal_headers(access_token=None, content_type=None):
+    """Common headers for HAL requests, built once per token.
+
+    The returned dict is shared, don't modify it.
+    """
+    headers = {'Accept': HAL_JSON}
+    if access_token is not None:
+        headers['Authorization'] = 'Bearer %s' % access_token
+    if content_type is not None:
+        headers['Content-Type'] = content_type
+    return headers
+
+def request(method, url, access_token=None, timeout=None, operation='other', circuit=None, **kwargs):
+    """Send a request through the shared session.
+
+    Passing an access_token adds the HAL Accept and bearer Authorization
+    headers. The duration is recorded per operation name. With circuit set
+    to a hostname, the call goes through that host's circuit breaker and
+    bulkhead and may raise circuit_breakers.HostUnavailable.
+    """
+    kwargs = encode_json(access_token, kwargs)
+    if timeout is None:
+        timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        if circuit is None:
+            response = session().request(method, url, timeout=timeout, **kwargs)
+        else:
+            response = BREAKERS.call(circuit, lambda: session().request(method, url, timeout=timeout, **kwargs))
+        status = response.status_code
+        return response
+    finally:
+        OUTBOUND_REQUEST_SECONDS.observe(time.perf_counter() - started, operation=operation, status=status)
+
+def encode_json(access_token, kwargs, body='data'):
+    """Request kwargs with a json payload serialized by json_codec into
+    kwargs[body], and the HAL headers merged into the given headers
+    """
+    content_type = None
+    if 'json' in kwargs:
+        kwargs[body] = json_codec.dumps(kwargs.pop('json'))
+        content_type = 'application/json'
+    headers = None
+    if access_token is not None:
+        headers = hal_headers(access_token, content_type)
+    elif content_type is not None:
+        headers = {'Content-Type': content_type}
+    if kwargs.get('headers'):
+        # Merged into a copy, the caller's headers win over the defaults
+        headers = dict(headers or {}, **kwargs['headers'])
+    if headers is not None:
+        kwargs['headers'] = headers
+    return kwargs
+
+def json_body(response):
+    """The JSON body of a response, decoded by json_codec
+    """
+    return json_codec.loads(response.content)
+
+def get(url, access_token=None, **kwargs):
+    return request('GET', url, access_token=access_token, **kwargs)
+
+def post(url, access_token=None, **kwargs):
+    return request('POST', url, access_token=access_token, **kwargs)
+
+def put(url, access_token=None, **kwargs):
+    return request('PUT', url, access_token=access_token, **kwargs)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    asyncio counterpart of http_client for the ASGI serving mode.
+'''
+
+import asyncio
+import time
+
+import httpx
+
+from http_client import HTTP_BACKOFF_FACTOR, HTTP_CONNECT_TIMEOUT, HTTP_MAX_RETRIES, \
+    HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE, HTTP_READ_TIMEOUT, encode_json
+from circuit_breakers import BREAKERS
+from metrics import OUTBOUND_REQUEST_SECONDS
+
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE'])
+RETRY_STATUS_CODES = frozenset([502, 503, 504])
+
+_clients = {}
+
+def client():
+    """Return the AsyncClient of the running event loop, creating it on first use.
+    """
+    loop = asyncio.get_running_loop()
+    async_client = _clients.get(loop)
+    if async_client is None:
+        async_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=HTTP_POOL_CONNECTIONS * HTTP_POOL_MAXSIZE,
+                                max_keepalive_connections=HTTP_POOL_CONNECTIONS),
+            # Retries connection failures only, for all methods
+            transport=httpx.AsyncHTTPTransport(retries=HTTP_MAX_RETRIES))
+        _clients[loop] = async_client
+    return async_client
+
+async def close():
+    async_client = _clients.pop(asyncio.get_running_loop(), None)
+    if async_client is not None:
+        await async_client.aclose()
+
+async def request(method, url, access_token=None, operation='other', circuit=None, **kwargs):
+    """Send a request through the shared client, see http_client.request.
+    """
+    admitted = BREAKERS.acquire(circuit) if circuit is not None else None
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        response = await _request_with_retries(method, url, access_token, **kwargs)
+        status = response.status_code
+        return response
+    finally:
+        elapsed = time.perf_counter() - started
+        if circuit is not None:
+            BREAKERS.release(circuit, admitted, status == 'error' or status >= 500, elapsed)
+        OUTBOUND_REQUEST_SECONDS.observe(elapsed, operation=operation, status=status)
+
+async def _request_with_retries(method, url, access_token, **kwargs):
+    kwargs = encode_json(access_token, kwargs, body='content')
+    retries = HTTP_MAX_RETRIES if method in IDEMPOTENT_METHODS else 0
+    attempt = 0
+    while True:
+        try:
+            response = await client().request(method, url, **kwargs)
+            if response.status_code not in RETRY_STATUS_CODES or attempt >= retries:
+                return response
+        except httpx.TransportError:
+            if attempt >= retries:
+                raise
+        await asyncio.sleep(HTTP_BACKOFF_FACTOR * (2 ** attempt))
+        attempt += 1
+
+async def get(url, access_token=None, **kwargs):
+    return await request('GET', url, access_token=access_token, **kwargs)
+
+async def post(url, access_token=None, **kwargs):
+    return await request('POST', url, access_token=access_token, **kwargs)
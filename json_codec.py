@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    JSON encoding and decoding for requests, responses and outbound calls.
+    Uses orjson when it is installed and the standard library otherwise,
+    JSON_CODEC=json forces the standard library.
+
+    Both produce the same JSON, except that orjson writes non-ASCII
+    characters as UTF-8 instead of escaping them. What orjson rejects, like
+    integers beyond 64 bit or non-string keys, goes through the standard
+    library.
+'''
+
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class StdlibCodec(object):
+    name = 'json'
+
+    def dumps(self, obj, default=None, sort_keys=False, indent=None):
+        separators = (',', ': ') if indent else (',', ':')
+        return json.dumps(obj, default=default, sort_keys=sort_keys, indent=indent, separators=separators).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data)
+
+class OrjsonCodec(object):
+    name = 'orjson'
+
+    def __init__(self):
+        self._fallback = StdlibCodec()
+
+    def dumps(self, obj, default=None, sort_keys=False, indent=None):
+        # Datetimes go to default like with the standard library, e.g. Flask's HTTP dates
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(obj, default=default, option=option)
+        except TypeError:
+            return self._fallback.dumps(obj, default, sort_keys, indent)
+
+    def loads(self, data):
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            # Raises the standard library's error if it is invalid JSON after all
+            return self._fallback.loads(data)
+
+def codec(name=os.environ.get('JSON_CODEC', 'orjson')):
+    if name == 'orjson' and orjson is not None:
+        return OrjsonCodec()
+    return StdlibCodec()
+
+CODEC = codec()
+
+def dumps(obj, default=None, sort_keys=False, indent=None):
+    """Compact JSON as UTF-8 bytes, indented by 2 if indent is set
+    """
+    return CODEC.dumps(obj, default, sort_keys, indent)
+
+def loads(data):
+    """Python objects from JSON in str or UTF-8 bytes
+    """
+    return CODEC.loads(data)
+
+class CodecJSONProviderMixin(object):
+    """dumps and loads of a Flask or Quart DefaultJSONProvider, through codec
+    for the arguments jsonify and get_json use.
+    """
+    codec = CODEC
+
+    def dumps(self, obj, **kwargs):
+        indent = kwargs.get('indent')
+        compact = kwargs.get('separators') == (',', ':') and indent is None
+        if set(kwargs) - set(['indent', 'separators']) or not (compact or indent == 2):
+            return super().dumps(obj, **kwargs)
+        return self.codec.dumps(obj, default=self.default, sort_keys=self.sort_keys, indent=indent).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return self.codec.loads(s)
+
+def init_app(app):
+    """Route the JSON of a Flask or Quart app through CODEC
+    """
+    provider_class = getattr(app, 'json_provider_class', None)
+    if provider_class is not None:
+        app.json = type('CodecJSONProvider', (CodecJSONProviderMixin, provider_class), {})(app)
+    else:
+        # Flask < 2.2
+        app.json_encoder, app.json_decoder = _flask_json_classes()
+
+def _flask_json_classes():
+    from flask.json import JSONDecoder, JSONEncoder
+
+    class CodecJSONEncoder(JSONEncoder):
+        def encode(self, obj):
+            compact = self.indent is None and self.item_separator == ',' and self.key_separator == ':'
+            if self.skipkeys or not (compact or self.indent == 2):
+                return super().encode(obj)
+            return dumps(obj, default=self.default, sort_keys=self.sort_keys, indent=self.indent).decode('utf-8')
+
+    class CodecJSONDecoder(JSONDecoder):
+        def decode(self, s):
+            return loads(s)
+
+    return CodecJSONEncoder, CodecJSONDecoder
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    Turns requests away while the process is overloaded, before they do
+    any database or Beyond API work, so those already admitted still
+    finish in time.
+
+    A process is overloaded when SHED_MAX_IN_FLIGHT requests are already
+    being served, or when a request waited longer than
+    SHED_MAX_QUEUE_SECONDS in front of the app. The wait is taken from the
+    X-Request-Start header the Heroku router and nginx set.
+'''
+
+import threading
+import time
+
+class LoadShedder(object):
+    """Counts the requests in flight. 0 or less disables a limit.
+    """
+    def __init__(self, max_in_flight, max_queue_seconds, clock=time.time):
+        self.max_in_flight = max_in_flight
+        self.max_queue_seconds = max_queue_seconds
+        self.in_flight = 0
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    def try_enter(self, request_start=None):
+        """The reason to shed the request, or None if it was admitted.
+        Admitted requests must leave.
+        """
+        if self.max_queue_seconds > 0 and request_start:
+            started = parse_request_start(request_start)
+            if started is not None and self._clock() - started > self.max_queue_seconds:
+                return 'queue_time'
+        with self._lock:
+            if 0 < self.max_in_flight <= self.in_flight:
+                return 'in_flight'
+            self.in_flight += 1
+        return None
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+def parse_request_start(value):
+    """Seconds since the epoch from an X-Request-Start header in
+    milliseconds (Heroku), or t=<seconds or microseconds> (nginx)
+    """
+    value = value.strip()
+    if value.startswith('t='):
+        value = value[2:]
+    try:
+        started = float(value)
+    except ValueError:
+        return None
+    # Scale by magnitude: seconds are about 1e9 today
+    if started > 1e14:
+        return started / 1e6
+    if started > 1e11:
+        return started / 1e3
+    return started
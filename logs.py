@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    Structured, non-blocking logging. Request threads only put records on
+    a bounded queue; a background thread formats them as JSON lines and
+    writes them to stdout.
+
+    LOG_LEVEL            default level, e.g. INFO
+    LOG_LEVELS           per category levels, e.g. installations=WARNING,app.signatures=DEBUG
+    LOG_SAMPLE_RATES     fraction of records below WARNING to keep per category, e.g. app.requests=0.1
+    LOG_QUEUE_SIZE       records buffered before new ones are dropped
+'''
+
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_LEVELS = os.environ.get('LOG_LEVELS', '')
+LOG_SAMPLE_RATES = os.environ.get('LOG_SAMPLE_RATES', '')
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+
+REDACTED = '[REDACTED]'
+# Field names whose values never end up in the logs
+SENSITIVE_FIELDS = re.compile(r'(^|_)(token|signature|secret|password|authorization)$|^code$', re.IGNORECASE)
+# Secrets embedded in free text: bearer tokens, JWTs and key=value pairs
+SENSITIVE_TEXT = re.compile(r'(?i)(bearer\s+)[^\s\'",]+'
+                            r'|eyJ[\w-]+\.[\w-]+\.[\w-]+'
+                            r'|(\b(?:access_token|refresh_token|token|signature|secret|code)[\'"]?\s*[:=]\s*[\'"]?)[^\s\'",&}]+')
+
+def redact(text):
+    return SENSITIVE_TEXT.sub(lambda match: (match.group(1) or match.group(2) or '') + REDACTED, text)
+
+def redact_fields(fields):
+    return dict((key, REDACTED if SENSITIVE_FIELDS.search(key) else value) for key, value in fields.items())
+
+class StructuredLogger(logging.LoggerAdapter):
+    """Logger taking structured fields as keyword arguments:
+
+        LOGGER.info('Approved payment', payment_id=payment_id)
+    """
+    def process(self, msg, kwargs):
+        fields = dict((key, kwargs.pop(key)) for key in list(kwargs)
+                      if key not in ('exc_info', 'stack_info', 'stacklevel', 'extra'))
+        kwargs['extra'] = {'fields': fields}
+        return msg, kwargs
+
+def get_logger(category):
+    return StructuredLogger(logging.getLogger(category), {})
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + '.%03dZ' % record.msecs,
+            'level': record.levelname,
+            'category': record.name,
+            'msg': redact(record.getMessage())
+        }
+        entry.update(redact_fields(getattr(record, 'fields', {})))
+        if record.exc_info:
+            entry['exc'] = redact(self.formatException(record.exc_info))
+        return json.dumps(entry, default=str)
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a fraction of the records below WARNING, per category.
+    """
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(record.name)
+        return rate is None or random.random() < rate
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Drops records instead of blocking the caller when the queue is full.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The queue stays in process, so only merge the message arguments
+        # here and leave formatting to the listener thread.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+_lock = threading.Lock()
+_handler = None
+_listener = None
+_pid = None
+
+def setup():
+    """Install the queue handler on the root logger and start the writer
+    thread. Safe to call repeatedly, restarts the thread after a fork.
+    """
+    global _handler
+    global _listener
+    global _pid
+    with _lock:
+        if _listener is not None and _pid == os.getpid():
+            return
+        root = logging.getLogger()
+        if _handler is not None:
+            root.removeHandler(_handler)
+
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        _handler = NonBlockingQueueHandler(log_queue)
+        _handler.addFilter(SamplingFilter(_parse_mapping(LOG_SAMPLE_RATES, float)))
+        root.addHandler(_handler)
+        root.setLevel(LOG_LEVEL)
+        for category, level in _parse_mapping(LOG_LEVELS, str.upper).items():
+            logging.getLogger(category).setLevel(level)
+
+        stream = logging.StreamHandler(sys.stdout)
+        stream.setFormatter(JsonFormatter())
+        _listener = QueueListener(log_queue, stream)
+        _listener.start()
+        _pid = os.getpid()
+
+def shutdown():
+    """Flush queued records and stop the writer thread.
+    """
+    global _listener
+    with _lock:
+        if _listener is not None and _pid == os.getpid():
+            _listener.stop()
+        _listener = None
+
+def dropped_records():
+    return _handler.dropped if _handler is not None else 0
+
+def _parse_mapping(setting, convert):
+    mapping = {}
+    for item in setting.split(','):
+        if '=' in item:
+            key, value = item.split('=', 1)
+            mapping[key.strip()] = convert(value.strip())
+    return mapping
+
+atexit.register(shutdown)
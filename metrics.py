@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    Lightweight counters and latency histograms, exposed in the Prometheus
+    text format.
+
+    Every process keeps its own registry. With METRICS_DIR set, each
+    process also writes a snapshot to METRICS_DIR/<pid>.json every
+    METRICS_FLUSH_INTERVAL seconds, and a scrape sums up the snapshots of
+    all processes, so the numbers are correct across gunicorn workers.
+'''
+
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class _Metric(object):
+    def __init__(self, name, help, labelnames):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(labelname, '')) for labelname in self.labelnames)
+
+    def snapshot(self):
+        with self._lock:
+            samples = [[list(key), self._copy(value)] for key, value in self._values.items()]
+        return {'type': self.type, 'help': self.help, 'labelnames': list(self.labelnames), 'samples': samples}
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, total, **labels):
+        """For collectors mirroring a count that is kept elsewhere, e.g. cache hits
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = total
+
+    def _copy(self, value):
+        return value
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # Per bucket (non-cumulative) counts, the last one is +Inf, then sum and count
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot['buckets'] = list(self.buckets)
+        return snapshot
+
+    def _copy(self, value):
+        return [list(value[0]), value[1], value[2]]
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def register_collector(self, collector):
+        """collector() is called before every snapshot to update mirrored metrics
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def snapshot(self):
+        with self._lock:
+            collectors = list(self._collectors)
+            metrics = list(self._metrics.values())
+        for collector in collectors:
+            collector()
+        return dict((metric.name, metric.snapshot()) for metric in metrics)
+
+REGISTRY = Registry()
+
+def counter(name, help, labelnames=()):
+    return REGISTRY.register(Counter(name, help, labelnames))
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labelnames, buckets))
+
+def register_collector(collector):
+    REGISTRY.register_collector(collector)
+
+def timed(histogram, **labels):
+    """Decorator observing the duration of every call
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Metrics shared by several modules
+
+DB_QUERY_SECONDS = histogram('db_query_duration_seconds', 'Duration of Postgres operations', ['operation'])
+OUTBOUND_REQUEST_SECONDS = histogram('outbound_request_duration_seconds', 'Duration of calls to the Beyond APIs', ['operation', 'status'])
+TOKEN_REFRESHES = counter('token_refreshes_total', 'Access tokens obtained for existing installations', ['grant_type'])
+CACHE_LOOKUPS = counter('cache_lookups_total', 'In-process cache lookups', ['cache', 'result'])
+
+def register_cache(name, cache):
+    """Mirror hits and misses of a caches.TTLCache
+    """
+    def collect():
+        CACHE_LOOKUPS.set_total(cache.hits, cache=name, result='hit')
+        CACHE_LOOKUPS.set_total(cache.misses, cache=name, result='miss')
+    register_collector(collect)
+
+# Aggregation across processes
+
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+_flush_lock = threading.Lock()
+
+def setup():
+    """Start writing snapshots to METRICS_DIR, if set. Call in every worker.
+    """
+    global _flusher_pid
+    if not METRICS_DIR:
+        return
+    with _flusher_lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    threading.Thread(target=_flush_forever, name='metrics-flusher', daemon=True).start()
+
+def _flush_forever():
+    pid = os.getpid()
+    while _flusher_pid == pid:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        flush()
+
+def flush():
+    if not METRICS_DIR:
+        return
+    path = os.path.join(METRICS_DIR, '%i.json' % os.getpid())
+    # The flusher thread and scrapes write the same temporary file
+    with _flush_lock:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(REGISTRY.snapshot(), f)
+        os.replace(path + '.tmp', path)
+
+def clear_snapshots():
+    """Remove snapshots of earlier runs. Call once per deploy, before workers start.
+    """
+    if not METRICS_DIR or not os.path.isdir(METRICS_DIR):
+        return
+    for name in os.listdir(METRICS_DIR):
+        if name.endswith('.json'):
+            os.remove(os.path.join(METRICS_DIR, name))
+
+def collect():
+    """Snapshots of all processes, or only of this one without METRICS_DIR
+    """
+    if not METRICS_DIR:
+        return [REGISTRY.snapshot()]
+    flush()
+    snapshots = []
+    for name in os.listdir(METRICS_DIR):
+        if name.endswith('.json'):
+            try:
+                with open(os.path.join(METRICS_DIR, name)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                pass
+    return snapshots
+
+def merge(snapshots):
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.setdefault(name, dict(metric, samples={}))
+            for labelvalues, value in metric['samples']:
+                key = tuple(labelvalues)
+                current = target['samples'].get(key)
+                if metric['type'] == 'histogram':
+                    if current is None:
+                        current = target['samples'][key] = [[0] * len(value[0]), 0.0, 0]
+                    current[0] = [a + b for a, b in zip(current[0], value[0])]
+                    current[1] += value[1]
+                    current[2] += value[2]
+                else:
+                    target['samples'][key] = (current or 0) + value
+    return merged
+
+def render(merged):
+    lines = []
+    for name in sorted(merged):
+        metric = merged[name]
+        lines.append('# HELP %s %s' % (name, metric['help']))
+        lines.append('# TYPE %s %s' % (name, metric['type']))
+        labelnames = metric['labelnames']
+        for key in sorted(metric['samples']):
+            value = metric['samples'][key]
+            labels = list(zip(labelnames, key))
+            if metric['type'] == 'histogram':
+                cumulative = 0
+                bounds = [_format_number(bound) for bound in metric['buckets']] + ['+Inf']
+                for bound, count in zip(bounds, value[0]):
+                    cumulative += count
+                    lines.append('%s_bucket%s %i' % (name, _labels(labels + [('le', bound)]), cumulative))
+                lines.append('%s_sum%s %s' % (name, _labels(labels), _format_number(value[1])))
+                lines.append('%s_count%s %i' % (name, _labels(labels), value[2]))
+            else:
+                lines.append('%s%s %s' % (name, _labels(labels), _format_number(value)))
+    return '\n'.join(lines) + '\n'
+
+def exposition():
+    return render(merge(collect()))
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (labelname, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for labelname, value in labels)
+
+def _format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
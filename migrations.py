@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    Versioned database schema. Applied once per deploy, before the new
+    code serves requests (see the release step in the Procfile), instead
+    of by every worker on startup:
+
+        DATABASE_URL=... python migrations.py
+
+    Applied versions are recorded in SCHEMA_MIGRATIONS. Concurrent runs
+    wait for each other on an advisory lock, and every migration runs in
+    its own transaction. Append new migrations to MIGRATIONS, never change
+    applied ones.
+'''
+
+import argparse
+import os
+
+from db import advisory_lock, get_pool
+import logs
+
+# Longest time a run waits for another one to finish
+MIGRATION_LOCK_TIMEOUT = os.environ.get('MIGRATION_LOCK_TIMEOUT', '5min')
+
+LOGGER = logs.get_logger('migrations')
+
+# (version, description, statements). The first ones use IF NOT EXISTS, as
+# databases set up before migrations existed already have these tables.
+MIGRATIONS = [
+    (1, 'Create APP_INSTALLATIONS', [
+        """CREATE TABLE IF NOT EXISTS APP_INSTALLATIONS (
+             HOSTNAME varchar(255) UNIQUE NOT NULL,
+             API_URL varchar(255) NOT NULL,
+             ACCESS_TOKEN varchar(4096) NOT NULL,
+             REFRESH_TOKEN varchar(4096) NOT NULL,
+             EXPIRY_DATE timestamp NOT NULL
+           )""",
+    ]),
+    (2, 'Create SHOPS', [
+        """CREATE TABLE IF NOT EXISTS SHOPS (
+             ID varchar(255) UNIQUE NOT NULL,
+             HOSTNAME varchar(255) NOT NULL
+           )""",
+    ]),
+    (3, 'Index installations by expiry date', [
+        "CREATE INDEX IF NOT EXISTS APP_INSTALLATIONS_EXPIRY_DATE_IDX ON APP_INSTALLATIONS (EXPIRY_DATE)",
+    ]),
+    (4, 'Create PROVISIONED_PAYMENT_METHODS', [
+        """CREATE TABLE IF NOT EXISTS PROVISIONED_PAYMENT_METHODS (
+             HOSTNAME varchar(255) NOT NULL,
+             PAYMENT_METHOD_DEFINITION varchar(255) NOT NULL,
+             CREATED_AT timestamp NOT NULL DEFAULT now(),
+             PRIMARY KEY (HOSTNAME, PAYMENT_METHOD_DEFINITION)
+           )""",
+    ]),
+    (5, 'Create PAYMENT_RESULTS', [
+        """CREATE TABLE IF NOT EXISTS PAYMENT_RESULTS (
+             PAYMENT_ID varchar(255) NOT NULL,
+             ACTION varchar(32) NOT NULL,
+             STATE varchar(32) NOT NULL,
+             RETURN_URI varchar(4096),
+             EXPIRES_AT timestamp NOT NULL,
+             PRIMARY KEY (PAYMENT_ID, ACTION)
+           )""",
+    ]),
+    (6, 'Create PAYMENTS', [
+        """CREATE TABLE IF NOT EXISTS PAYMENTS (
+             PAYMENT_ID varchar(255) PRIMARY KEY,
+             SHOP_ID varchar(255),
+             STATE varchar(32) NOT NULL,
+             CREATED_AT timestamp NOT NULL,
+             UPDATED_AT timestamp NOT NULL
+           )""",
+    ]),
+    (7, 'Create RATE_LIMIT_BUCKETS', [
+        """CREATE TABLE RATE_LIMIT_BUCKETS (
+             KEY varchar(255) PRIMARY KEY,
+             TOKENS double precision NOT NULL,
+             UPDATED_AT timestamp NOT NULL
+           )""",
+    ]),
+    (8, 'Add PAYMENT_RESULTS.LEASE_ID', [
+        "ALTER TABLE PAYMENT_RESULTS ADD COLUMN LEASE_ID varchar(64)",
+    ]),
+    (9, 'Create PROVISIONING_FAILURES', [
+        """CREATE TABLE PROVISIONING_FAILURES (
+             HOSTNAME varchar(255) PRIMARY KEY,
+             ATTEMPTS integer NOT NULL,
+             RETRY_AFTER timestamp NOT NULL
+           )""",
+    ]),
+    (10, 'Add APP_INSTALLATIONS refresh failure columns', [
+        """ALTER TABLE APP_INSTALLATIONS
+             ADD COLUMN REFRESH_ATTEMPTS integer NOT NULL DEFAULT 0,
+             ADD COLUMN REFRESH_RETRY_AFTER timestamp""",
+    ]),
+]
+
+def latest_version():
+    return MIGRATIONS[-1][0]
+
+def migrate(database_url, migrations=MIGRATIONS):
+    """Apply the migrations not applied yet, in order. Returns their versions.
+    """
+    pool = get_pool(database_url)
+    applied = []
+    with advisory_lock(pool, 'schema-migrations', MIGRATION_LOCK_TIMEOUT) as conn:
+        with conn.cursor() as curs:
+            curs.execute("""CREATE TABLE IF NOT EXISTS SCHEMA_MIGRATIONS (
+                              VERSION integer PRIMARY KEY,
+                              DESCRIPTION varchar(255) NOT NULL,
+                              APPLIED_AT timestamp NOT NULL DEFAULT now()
+                            )""")
+            curs.execute("SELECT VERSION FROM SCHEMA_MIGRATIONS")
+            done = set(row[0] for row in curs.fetchall())
+        conn.commit()
+        for version, description, statements in migrations:
+            if version in done:
+                continue
+            with conn.cursor() as curs:
+                for statement in statements:
+                    curs.execute(statement)
+                curs.execute("INSERT INTO SCHEMA_MIGRATIONS (VERSION, DESCRIPTION) VALUES (%s, %s)", (version, description))
+            conn.commit()
+            LOGGER.info('Applied migration', version=version, description=description)
+            applied.append(version)
+    return applied
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args()
+
+    logs.setup()
+    applied = migrate(os.environ.get('DATABASE_URL'))
+    print('Applied %i migrations, schema is at version %i' % (len(applied), latest_version()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    Ledger of the payments the app has seen and their latest state:
+    PENDING when created, then APPROVED, CANCELED or CAPTURED.
+
+    Recording is write-behind. Request threads only append the change to an
+    in-process buffer; a background thread writes it to the PAYMENTS table
+    in batches, every PAYMENT_LEDGER_FLUSH_INTERVAL seconds or as soon as
+    PAYMENT_LEDGER_BATCH_SIZE changes are waiting. Lookups see the buffered
+    changes of their own process, and the buffer is flushed on shutdown.
+
+    PAYMENT_LEDGER_BATCH_SIZE           changes per write
+    PAYMENT_LEDGER_FLUSH_INTERVAL       seconds a change waits at most before it is written
+    PAYMENT_LEDGER_QUEUE_SIZE           buffered changes before recording blocks
+    PAYMENT_LEDGER_RECORD_TIMEOUT       seconds recording blocks at most, then the change is dropped
+    PAYMENT_LEDGER_SHUTDOWN_ATTEMPTS    writes of the buffer tried on shutdown
+'''
+
+import atexit
+import os
+import threading
+import time
+from datetime import datetime
+
+from psycopg2.extras import execute_values
+
+from db import get_pool, last_by_key
+import logs
+from metrics import DB_QUERY_SECONDS, counter, timed
+
+PAYMENT_LEDGER_BATCH_SIZE = int(os.environ.get('PAYMENT_LEDGER_BATCH_SIZE', '500'))
+PAYMENT_LEDGER_FLUSH_INTERVAL = float(os.environ.get('PAYMENT_LEDGER_FLUSH_INTERVAL', '1'))
+PAYMENT_LEDGER_QUEUE_SIZE = int(os.environ.get('PAYMENT_LEDGER_QUEUE_SIZE', '10000'))
+PAYMENT_LEDGER_RECORD_TIMEOUT = float(os.environ.get('PAYMENT_LEDGER_RECORD_TIMEOUT', '5'))
+PAYMENT_LEDGER_SHUTDOWN_ATTEMPTS = int(os.environ.get('PAYMENT_LEDGER_SHUTDOWN_ATTEMPTS', '3'))
+
+PENDING = 'PENDING'
+APPROVED = 'APPROVED'
+CANCELED = 'CANCELED'
+CAPTURED = 'CAPTURED'
+
+LOGGER = logs.get_logger('payment_ledger')
+PAYMENT_LEDGER_WRITES = counter('payment_ledger_writes_total', 'Payment state changes written by the ledger', ['result'])
+
+class Payment(object):
+    def __init__(self, payment_id, state, shop_id=None, updated_at=None):
+        self.payment_id = payment_id
+        self.state = state
+        self.shop_id = shop_id
+        self.updated_at = updated_at or datetime.now()
+
+class PaymentLedger(object):
+    """Keeps the payments in memory, PostgresPaymentLedger stores them.
+    """
+    def __init__(self, batch_size=PAYMENT_LEDGER_BATCH_SIZE,
+                 flush_interval=PAYMENT_LEDGER_FLUSH_INTERVAL,
+                 queue_size=PAYMENT_LEDGER_QUEUE_SIZE,
+                 record_timeout=PAYMENT_LEDGER_RECORD_TIMEOUT):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.record_timeout = record_timeout
+        self.payments = {}
+        self._changed = threading.Condition()
+        self._buffer = []
+        self._unwritten = {}
+        self._writing = 0
+        self._writer = None
+        self._pid = None
+        self._stopping = False
+        _register(self)
+
+    def record(self, payment_id, state, shop_id=None):
+        """Queue a state change. Only blocks while the buffer is full, and
+        drops the change if the buffer stays full for record_timeout seconds.
+        """
+        payment = Payment(payment_id, state, shop_id)
+        deadline = time.monotonic() + self.record_timeout
+        with self._changed:
+            self._ensure_writer()
+            while len(self._buffer) >= self.queue_size and self._writer_alive():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    # The writer can't keep up or can't reach the database,
+                    # a lost change beats a request stuck without limit
+                    PAYMENT_LEDGER_WRITES.inc(result='dropped')
+                    LOGGER.error('Payment state change dropped, buffer full', payment_id=payment_id, state=state)
+                    return payment
+                self._changed.wait(min(remaining, self.flush_interval))
+            self._buffer.append(payment)
+            previous = self._unwritten.get(payment_id)
+            if previous is not None and payment.shop_id is None:
+                payment.shop_id = previous.shop_id
+            self._unwritten[payment_id] = payment
+            if len(self._buffer) >= self.batch_size:
+                self._changed.notify_all()
+        return payment
+
+    def get_payment(self, payment_id):
+        with self._changed:
+            payment = self._unwritten.get(payment_id)
+        if payment is not None:
+            return payment
+        return self._read(payment_id)
+
+    def flush(self, timeout=None):
+        """Wait until everything recorded so far is written. Returns False on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._changed:
+            if self._forked():
+                return True
+            if not self._writer_alive():
+                self._write_buffered()
+                return not self._buffer
+            self._changed.notify_all()
+            while self._buffer or self._writing:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._changed.wait(remaining)
+        return True
+
+    def close(self):
+        """Write the buffered changes and stop the writer thread.
+        """
+        with self._changed:
+            if self._forked():
+                return
+            self._stopping = True
+            self._changed.notify_all()
+            writer = self._writer if self._writer_alive() else None
+        if writer is not None:
+            writer.join()
+        with self._changed:
+            for attempt in range(PAYMENT_LEDGER_SHUTDOWN_ATTEMPTS):
+                if self._write_buffered():
+                    break
+                self._changed.wait(self.flush_interval)
+            if self._buffer:
+                LOGGER.error('Payment state changes lost on shutdown', count=len(self._buffer))
+            self._writer = None
+            self._stopping = False
+
+    def _ensure_writer(self):
+        if self._writer_alive():
+            return
+        if self._forked():
+            # Changes buffered before a fork belong to the parent
+            self._buffer = []
+            self._unwritten = {}
+            self._writing = 0
+        self._pid = os.getpid()
+        self._writer = threading.Thread(target=self._run, name='payment-ledger', daemon=True)
+        self._writer.start()
+
+    def _forked(self):
+        return self._pid is not None and self._pid != os.getpid()
+
+    def _writer_alive(self):
+        return self._writer is not None and self._pid == os.getpid() and self._writer.is_alive()
+
+    def _run(self):
+        with self._changed:
+            while not self._stopping:
+                if len(self._buffer) < self.batch_size:
+                    self._changed.wait(self.flush_interval)
+                if self._buffer and not self._write_buffered() and not self._stopping:
+                    # Keep the changes and try again after the interval
+                    self._changed.wait(self.flush_interval)
+
+    def _write_buffered(self):
+        """Write the buffer in batches, called holding the condition. Returns False on failure.
+        """
+        while self._buffer:
+            batch = self._buffer[:self.batch_size]
+            self._writing = len(batch)
+            self._changed.release()
+            try:
+                self._write(last_by_key(batch, lambda payment: payment.payment_id))
+                error = None
+            except Exception as e:
+                error = e
+            finally:
+                self._changed.acquire()
+                self._writing = 0
+            if error is not None:
+                PAYMENT_LEDGER_WRITES.inc(len(batch), result='failed')
+                LOGGER.error('Writing payment state changes failed', count=len(batch), exc_info=error)
+                self._changed.notify_all()
+                return False
+            PAYMENT_LEDGER_WRITES.inc(len(batch), result='written')
+            del self._buffer[:len(batch)]
+            for payment in batch:
+                if self._unwritten.get(payment.payment_id) is payment:
+                    del self._unwritten[payment.payment_id]
+            self._changed.notify_all()
+        return True
+
+    def _write(self, payments):
+        for payment in payments:
+            stored = self.payments.get(payment.payment_id)
+            if stored is None or stored.updated_at <= payment.updated_at:
+                if stored is not None and payment.shop_id is None:
+                    payment.shop_id = stored.shop_id
+                self.payments[payment.payment_id] = payment
+
+    def _read(self, payment_id):
+        return self.payments.get(payment_id)
+
+class PostgresPaymentLedger(PaymentLedger):
+    def __init__(self, database_url, pool=None, **kwargs):
+        self.database_url = database_url
+        self.pool = pool or get_pool(database_url)
+        super().__init__(**kwargs)
+
+    # Batches from different workers may arrive out of order, the latest change wins
+    UPSERT_SQL = """INSERT INTO PAYMENTS (PAYMENT_ID, SHOP_ID, STATE, CREATED_AT, UPDATED_AT) VALUES %s
+                    ON CONFLICT (PAYMENT_ID) DO UPDATE SET
+                        SHOP_ID=COALESCE(EXCLUDED.SHOP_ID, PAYMENTS.SHOP_ID),
+                        STATE=EXCLUDED.STATE,
+                        UPDATED_AT=EXCLUDED.UPDATED_AT
+                    WHERE PAYMENTS.UPDATED_AT <= EXCLUDED.UPDATED_AT"""
+
+    @timed(DB_QUERY_SECONDS, operation='payments.write_batch')
+    def _write(self, payments):
+        with self.pool.connection() as conn:
+            with conn.cursor() as curs:
+                execute_values(curs, self.UPSERT_SQL,
+                               [(payment.payment_id, payment.shop_id, payment.state, payment.updated_at, payment.updated_at) for payment in payments],
+                               page_size=len(payments))
+
+    @timed(DB_QUERY_SECONDS, operation='payments.get')
+    def _read(self, payment_id):
+        with self.pool.connection() as conn:
+            with conn.cursor() as curs:
+                curs.execute("SELECT SHOP_ID, STATE, UPDATED_AT FROM PAYMENTS WHERE PAYMENT_ID=%s", (payment_id,))
+                entry = curs.fetchone()
+                if entry:
+                    return Payment(payment_id, entry[1], entry[0], entry[2])
+        return None
+
+_LEDGERS = []
+_LEDGERS_LOCK = threading.Lock()
+
+def _register(ledger):
+    with _LEDGERS_LOCK:
+        _LEDGERS.append(ledger)
+
+def close_ledgers():
+    """Worker lifecycle hook: call on worker exit, before the pools are closed.
+    """
+    with _LEDGERS_LOCK:
+        ledgers = list(_LEDGERS)
+    for ledger in ledgers:
+        ledger.close()
+
+atexit.register(close_ledgers)
@@ -1,62 +1,174 @@
 # -*- coding: utf-8 -*-
 
-import json
-import requests
+import hashlib
+import os
+import time
 
-SYSTEM_API_URL = "https://system.beyondshop.cloud/api"
+import http_client
+from caches import TTLCache
+import json_codec
+from singleflight import SingleFlight
+
+SYSTEM_API_URL = os.environ.get("SYSTEM_API_URL", "https://system.beyondshop.cloud/api")
 
 PAYMENT_METHOD_DEFINITION_ID = ""
 
+# Payment methods created for every shop that installs the app
+AUTO_INSTALLED_PAYMENT_METHOD_DEFINITIONS = [
+    'beautiful-test-payment-embedded',
+    'beautiful-test-payment-embedded-selection',
+    'beautiful-test-payment-capture-on-demand'
+]
+
+# System tokens are reused until this many seconds before they expire
+SYSTEM_TOKEN_EXPIRY_MARGIN = float(os.environ.get("SYSTEM_TOKEN_EXPIRY_MARGIN", "60"))
+# Definitions are served from memory for the TTL, then revalidated with
+# If-None-Match as long as they are younger than the max age
+PAYMENT_METHOD_DEFINITION_CACHE_TTL = float(os.environ.get("PAYMENT_METHOD_DEFINITION_CACHE_TTL", "300"))
+PAYMENT_METHOD_DEFINITION_CACHE_MAX_AGE = float(os.environ.get("PAYMENT_METHOD_DEFINITION_CACHE_MAX_AGE", "86400"))
+
+_system_tokens = TTLCache(maxsize=16, ttl=86400)
+_definitions = TTLCache(maxsize=1024, ttl=PAYMENT_METHOD_DEFINITION_CACHE_MAX_AGE)
+_fetches = SingleFlight()
+
+class PaymentMethodDefinitionCatalog(object):
+    """Payment method definitions, looked up by _id or name.
+    """
+    def __init__(self, definitions, etag=None):
+        self.definitions = definitions
+        self.etag = etag
+        self._index = {}
+        for definition in definitions:
+            self._index.setdefault(definition.get("name"), definition)
+        for definition in definitions:
+            self._index[definition.get("_id")] = definition
+
+    def get(self, key, default=None):
+        return self._index.get(key, default)
+
+    def __getitem__(self, key):
+        return self._index[key]
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self.definitions)
+
+    def __len__(self):
+        return len(self.definitions)
+
+class _Cached(object):
+    def __init__(self, value, etag, ttl):
+        self.value = value
+        self.etag = etag
+        self.fresh_until = time.monotonic() + ttl
+
 def read_json_file(file_path):
     data = {}
-    with open(file_path) as f:
-        data = json.load(f)
+    with open(file_path, 'rb') as f:
+        data = json_codec.loads(f.read())
     return data
 
 def system_token(client_id, client_secret):
-    return requests.post('%s/oauth/token' % SYSTEM_API_URL, auth=(client_id, client_secret), data={"grant_type": "client_credentials"}) \
-        .json() \
-        .get("access_token", "")
+    """Access token for the system API, reused until shortly before it expires
+    """
+    key = (SYSTEM_API_URL, client_id, hashlib.sha256(client_secret.encode("utf-8")).hexdigest())
+    token = _system_tokens.get(key)
+    if token is None:
+        token = _fetches.do(key, _fetch_system_token, key, client_id, client_secret)
+    return token
+
+def _fetch_system_token(key, client_id, client_secret):
+    token_response = http_client.json_body(
+        http_client.post('%s/oauth/token' % SYSTEM_API_URL, auth=(client_id, client_secret), data={"grant_type": "client_credentials"}, operation='system_token'))
+    token = token_response.get("access_token", "")
+    if token and token_response.get("expires_in"):
+        _system_tokens.set(key, token, ttl=token_response["expires_in"] - SYSTEM_TOKEN_EXPIRY_MARGIN)
+    return token
 
 def get_payment_method_definitions(system_token):
-    payment_method_definitions = \
-        requests.get('%s/payment-method-definitions' % SYSTEM_API_URL, \
-                 headers={
-                     "Accept": "application/hal+json",
-                     "Authorization": "Bearer %s" % system_token
-                 }).json().get("_embedded", {}).get("payment-method-definitions", [])
+    return list(get_payment_method_definition_catalog(system_token))
+
+def get_payment_method_definition_catalog(system_token):
+    """All payment method definitions of the system API, cached
+    """
+    return _get_cached('%s/payment-method-definitions' % SYSTEM_API_URL, system_token, 'get_payment_method_definitions',
+                       lambda payload, etag: PaymentMethodDefinitionCatalog(payload.get("_embedded", {}).get("payment-method-definitions", []), etag))
 
-    return payment_method_definitions
+def invalidate_payment_method_definitions():
+    _definitions.clear()
 
 def create_payment_method_definition(system_token, file_path):
     payment_method_definition_create_payload = read_json_file(file_path)
 
     created_payment_method_definition = \
-        requests.post('%s/payment-method-definitions' % SYSTEM_API_URL, \
-            headers= {
-                "Accept": "application/hal+json",
-                "Content-Type": "application/json",
-                "Authorization": "Bearer %s" % system_token
-            }, \
-            json=payment_method_definition_create_payload).json()
+        http_client.json_body(http_client.post('%s/payment-method-definitions' % SYSTEM_API_URL, \
+            access_token=system_token, operation='create_payment_method_definition', \
+            json=payment_method_definition_create_payload))
+    invalidate_payment_method_definitions()
     return created_payment_method_definition
 
+def update_payment_method_definition(system_token, payment_method_definition):
+    """Replace a registered definition, create_payment_method_definition
+    only creates new ones
+    """
+    updated_payment_method_definition = \
+        http_client.json_body(http_client.put('%s/payment-method-definitions/%s' % (SYSTEM_API_URL, payment_method_definition["_id"]), \
+            access_token=system_token, operation='update_payment_method_definition', \
+            json=payment_method_definition))
+    invalidate_payment_method_definitions()
+    return updated_payment_method_definition
 
 def get_payment_method_definition(installation, payment_method_definition_name):
-    payment_method_definition = \
-        requests.get('%s/payment-method-definitions/%s' % (installation.api_url, payment_method_definition_name), \
-                 headers={
-                     "Accept": "application/hal+json",
-                     "Authorization": "Bearer %s" % installation.access_token
-                 }).json()
+    return _get_cached('%s/payment-method-definitions/%s' % (installation.api_url, payment_method_definition_name),
+                       installation.access_token, 'get_payment_method_definition', lambda payload, etag: payload)
 
-    return payment_method_definition
+def _get_cached(url, access_token, operation, parse):
+    """GET a rarely changing resource, serving it from memory while fresh and
+    revalidating it with its ETag afterwards. Only 200 and 304 responses are cached.
+    """
+    cached = _definitions.get(url)
+    if cached is not None and time.monotonic() < cached.fresh_until:
+        return cached.value
+    return _fetches.do(url, _fetch, url, access_token, operation, parse, cached)
+
+def _fetch(url, access_token, operation, parse, cached):
+    headers = http_client.hal_headers(access_token)
+    if cached is not None and cached.etag:
+        headers = dict(headers, **{"If-None-Match": cached.etag})
+    response = http_client.get(url, headers=headers, operation=operation)
+    if response.status_code == 304 and cached is not None:
+        value, etag = cached.value, cached.etag
+    else:
+        etag = response.headers.get("ETag")
+        value = parse(http_client.json_body(response), etag)
+        if response.status_code != 200:
+            return value
+    _definitions.set(url, _Cached(value, etag, PAYMENT_METHOD_DEFINITION_CACHE_TTL))
+    return value
+
+def payment_method_created(status_code):
+    return status_code is not None and 200 <= status_code < 300
+
+def payment_method_exists(status_code):
+    """Beyond answers 409 Conflict when the shop already has a payment method of the definition
+    """
+    return status_code == 409
 
 def create_payment_method(installation, payment_method_definition_name):
-     return requests.post('%s/payment-method-definitions/%s/payment-method' % (installation.api_url, payment_method_definition_name), \
-            headers= {
-                "Accept": "application/hal+json",
-                "Authorization": "Bearer %s" % installation.access_token
-            }).status_code
+     return http_client.post('%s/payment-method-definitions/%s/payment-method' % (installation.api_url, payment_method_definition_name), \
+            access_token=installation.access_token, operation='create_payment_method').status_code
+
+def get_payment_method_definitions_in_use(installation):
+    """Names of the definitions the shop already has payment methods of
+    """
+    response = http_client.get('%s/payment-methods' % installation.api_url,
+                               access_token=installation.access_token, operation='get_payment_methods')
+    response.raise_for_status()
+    payment_methods = http_client.json_body(response).get('_embedded', {}).get('payment-methods', [])
+    return set(payment_method['_links']['payment-method-definition']['href'].rstrip('/').rsplit('/', 1)[-1]
+               for payment_method in payment_methods
+               if 'payment-method-definition' in payment_method.get('_links', {}))
 
 
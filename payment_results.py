@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    Idempotency of approve, cancel and capture. The outcome of an action
+    on a payment is kept for PAYMENT_RESULT_TTL seconds, so repeated
+    requests (double clicks, retries) get the same answer without calling
+    Beyond again, and concurrent duplicates wait for the first one.
+
+    Across processes the first request leases the payment and action for
+    PAYMENT_RESULT_LEASE seconds. No connection is held while it calls
+    Beyond, duplicates poll until the result is stored or the lease ends.
+'''
+
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from caches import TTLCache
+from db import get_pool
+import logs
+from metrics import DB_QUERY_SECONDS, counter, timed
+from singleflight import SingleFlight
+
+PAYMENT_RESULT_TTL = float(os.environ.get('PAYMENT_RESULT_TTL', '3600'))
+PAYMENT_RESULT_CACHE_SIZE = int(os.environ.get('PAYMENT_RESULT_CACHE_SIZE', '10000'))
+# Seconds a worker may take to complete a payment before another worker takes it over
+PAYMENT_RESULT_LEASE = float(os.environ.get('PAYMENT_RESULT_LEASE', '30'))
+# Seconds between two looks at a payment leased by another worker
+PAYMENT_RESULT_POLL_INTERVAL = float(os.environ.get('PAYMENT_RESULT_POLL_INTERVAL', '0.1'))
+# Seconds between two deletions of expired results, per process
+PAYMENT_RESULT_PURGE_INTERVAL = float(os.environ.get('PAYMENT_RESULT_PURGE_INTERVAL', '300'))
+
+LOGGER = logs.get_logger('payment_results')
+# STATE of a leased payment whose result is not known yet
+IN_PROGRESS = 'IN_PROGRESS'
+PAYMENT_RESULT_LOOKUPS = counter('payment_result_lookups_total', 'Approve, cancel and capture requests by where their result came from', ['action', 'source'])
+
+class PaymentResult(object):
+    """completed is False if Beyond did not confirm the action, such results are not kept
+    """
+    def __init__(self, payment_id, action, state, return_uri=None, completed=True):
+        self.payment_id = payment_id
+        self.action = action
+        self.state = state
+        self.return_uri = return_uri
+        self.completed = completed
+
+class PaymentResultClaim(object):
+    """Either the earlier result, or a lease to complete the action.
+    lease_id is None if the claim holds no lease.
+    """
+    def __init__(self, payment_results, lease_id, payment_id, action, result):
+        self.payment_results = payment_results
+        self.payment_id = payment_id
+        self.action = action
+        self.result = result
+        self.lease_id = lease_id
+
+    def finish(self, result):
+        """Keep the result if it is new and completed, otherwise give up the lease
+        """
+        if result.completed and result is not self.result:
+            self.payment_results._store(result)
+        else:
+            self.release()
+        if result.completed:
+            self.payment_results.cache.set((self.payment_id, self.action), result)
+
+    def release(self):
+        if self.lease_id is not None:
+            self.payment_results._release(self.payment_id, self.action, self.lease_id)
+
+class PaymentResults(object):
+    def __init__(self, ttl=PAYMENT_RESULT_TTL, cache=None, lease=PAYMENT_RESULT_LEASE):
+        self.ttl = ttl
+        self.lease = lease
+        self.cache = cache if cache is not None else TTLCache(maxsize=PAYMENT_RESULT_CACHE_SIZE, ttl=ttl)
+        self.calls = SingleFlight()
+        self.results = {}
+        self.leases = {}
+        self.leases_lock = threading.Lock()
+
+    def complete(self, payment_id, action, fn):
+        """Result of an earlier completion of the action, or of fn(), which
+        returns a PaymentResult. Uncompleted results and exceptions are not kept.
+        """
+        key = (payment_id, action)
+        result = self.cache.get(key)
+        if result is not None:
+            PAYMENT_RESULT_LOOKUPS.inc(action=action, source='cache')
+            return result
+        return self.calls.do(key, self._complete, payment_id, action, fn)
+
+    def cached(self, payment_id, action):
+        """Result kept in this process, never does I/O
+        """
+        return self.cache.get((payment_id, action))
+
+    def try_claim(self, payment_id, action):
+        """Claim with the earlier result or a new lease, None while another
+        worker holds the lease. Always finish or release the returned claim.
+
+        For callers that can't block a thread while waiting, like the
+        asyncio app. Others use complete.
+        """
+        lease_id = uuid.uuid4().hex
+        result, leased = self._lease(payment_id, action, lease_id)
+        if result is None and not leased:
+            return None
+        PAYMENT_RESULT_LOOKUPS.inc(action=action, source='call' if result is None else 'store')
+        return PaymentResultClaim(self, lease_id if leased else None, payment_id, action, result)
+
+    def claim(self, payment_id, action):
+        """Like try_claim, but waits for the lease of another worker to end
+        """
+        claim = self.try_claim(payment_id, action)
+        while claim is None:
+            time.sleep(PAYMENT_RESULT_POLL_INTERVAL)
+            claim = self.try_claim(payment_id, action)
+        return claim
+
+    def _complete(self, payment_id, action, fn):
+        claim = self.claim(payment_id, action)
+        try:
+            result = claim.result if claim.result is not None else fn()
+        except BaseException:
+            claim.release()
+            raise
+        claim.finish(result)
+        return result
+
+    def _lease(self, payment_id, action, lease_id):
+        """(result, False) if the action was completed, (None, True) if
+        leased to lease_id and (None, False) if leased to another worker
+        """
+        key = (payment_id, action)
+        with self.leases_lock:
+            result = self.find(payment_id, action)
+            if result is not None:
+                return result, False
+            entry = self.leases.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                return None, False
+            self.leases[key] = (lease_id, time.monotonic() + self.lease)
+            return None, True
+
+    def _release(self, payment_id, action, lease_id):
+        with self.leases_lock:
+            entry = self.leases.get((payment_id, action))
+            if entry is not None and entry[0] == lease_id:
+                del self.leases[(payment_id, action)]
+
+    def find(self, payment_id, action):
+        entry = self.results.get((payment_id, action))
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+        return None
+
+    def _store(self, result):
+        with self.leases_lock:
+            self.results[(result.payment_id, result.action)] = (result, time.monotonic() + self.ttl)
+            self.leases.pop((result.payment_id, result.action), None)
+
+class PostgresPaymentResults(PaymentResults):
+    """Payment results shared by all processes through Postgres. A lease is
+    a row in state IN_PROGRESS, which EXPIRES_AT when the lease ends.
+    """
+    def __init__(self, database_url, ttl=PAYMENT_RESULT_TTL, pool=None, cache=None, lease=PAYMENT_RESULT_LEASE):
+        super().__init__(ttl, cache, lease)
+        self.database_url = database_url
+        self.pool = pool or get_pool(database_url)
+        self._purged_at = time.monotonic()
+
+    @timed(DB_QUERY_SECONDS, operation='payment_results.lease')
+    def _lease(self, payment_id, action, lease_id):
+        now = datetime.now()
+        with self.pool.connection() as conn, conn.cursor() as curs:
+            # Takes over rows whose lease or result expired
+            curs.execute("""INSERT INTO PAYMENT_RESULTS (PAYMENT_ID, ACTION, STATE, RETURN_URI, EXPIRES_AT, LEASE_ID) VALUES (%s, %s, %s, NULL, %s, %s)
+                            ON CONFLICT (PAYMENT_ID, ACTION) DO UPDATE SET
+                                STATE=EXCLUDED.STATE, RETURN_URI=NULL, EXPIRES_AT=EXCLUDED.EXPIRES_AT, LEASE_ID=EXCLUDED.LEASE_ID
+                            WHERE PAYMENT_RESULTS.EXPIRES_AT <= %s
+                            RETURNING LEASE_ID""",
+                         (payment_id, action, IN_PROGRESS, now + timedelta(seconds=self.lease), lease_id, now))
+            leased = curs.fetchone() is not None
+            entry = None
+            if not leased:
+                curs.execute("SELECT STATE, RETURN_URI FROM PAYMENT_RESULTS WHERE PAYMENT_ID=%s AND ACTION=%s AND STATE <> %s",
+                             (payment_id, action, IN_PROGRESS))
+                entry = curs.fetchone()
+        if entry:
+            return PaymentResult(payment_id, action, entry[0], entry[1]), False
+        return None, leased
+
+    @timed(DB_QUERY_SECONDS, operation='payment_results.release')
+    def _release(self, payment_id, action, lease_id):
+        with self.pool.connection() as conn, conn.cursor() as curs:
+            curs.execute("DELETE FROM PAYMENT_RESULTS WHERE PAYMENT_ID=%s AND ACTION=%s AND LEASE_ID=%s",
+                         (payment_id, action, lease_id))
+
+    @timed(DB_QUERY_SECONDS, operation='payment_results.find')
+    def find(self, payment_id, action):
+        with self.pool.connection() as conn, conn.cursor() as curs:
+            curs.execute("SELECT STATE, RETURN_URI FROM PAYMENT_RESULTS WHERE PAYMENT_ID=%s AND ACTION=%s AND STATE <> %s AND EXPIRES_AT > %s",
+                         (payment_id, action, IN_PROGRESS, datetime.now()))
+            entry = curs.fetchone()
+        if entry:
+            return PaymentResult(payment_id, action, entry[0], entry[1])
+        return None
+
+    @timed(DB_QUERY_SECONDS, operation='payment_results.store')
+    def _store(self, result):
+        with self.pool.connection() as conn, conn.cursor() as curs:
+            curs.execute("""INSERT INTO PAYMENT_RESULTS (PAYMENT_ID, ACTION, STATE, RETURN_URI, EXPIRES_AT, LEASE_ID) VALUES (%s, %s, %s, %s, %s, NULL)
+                            ON CONFLICT (PAYMENT_ID, ACTION) DO UPDATE SET
+                                STATE=EXCLUDED.STATE, RETURN_URI=EXCLUDED.RETURN_URI, EXPIRES_AT=EXCLUDED.EXPIRES_AT, LEASE_ID=NULL""",
+                         (result.payment_id, result.action, result.state, result.return_uri,
+                          datetime.now() + timedelta(seconds=self.ttl)))
+            if time.monotonic() - self._purged_at > PAYMENT_RESULT_PURGE_INTERVAL:
+                self._purged_at = time.monotonic()
+                curs.execute("DELETE FROM PAYMENT_RESULTS WHERE EXPIRES_AT < %s", (datetime.now(),))
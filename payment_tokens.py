@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    Signed, self-contained tokens handed out with embedded payments, so
+    approve/cancel can be authorized and routed without a database lookup.
+'''
+
+import os
+import time
+
+from signers import sign_token, verify_token
+
+EMBEDDED_PAYMENT_TOKEN_TTL = int(os.environ.get('EMBEDDED_PAYMENT_TOKEN_TTL', '3600'))
+
+class PaymentToken(object):
+    def __init__(self, shop_id, hostname, payment_id):
+        self.shop_id = shop_id
+        self.hostname = hostname
+        self.payment_id = payment_id
+
+def create_payment_token(shop_id, hostname, payment_id, secret, ttl=EMBEDDED_PAYMENT_TOKEN_TTL):
+    return sign_token({
+        'sid': shop_id,
+        'h': hostname,
+        'pid': payment_id,
+        'exp': int(time.time()) + ttl
+    }, secret)
+
+def verify_payment_token(token, payment_id, secret):
+    """Return the PaymentToken if token is valid, unexpired and issued for payment_id, else None.
+    """
+    payment_token = read_payment_token(token, secret)
+    if payment_token is None or payment_token.payment_id != payment_id:
+        return None
+    return payment_token
+
+def read_payment_token(token, secret):
+    """Return the PaymentToken if token is valid and unexpired, whichever payment it was issued for, else None.
+    """
+    claims = verify_token(token, secret)
+    if claims is None or not claims.get('pid') or not claims.get('h'):
+        return None
+    return PaymentToken(claims.get('sid'), claims['h'], claims['pid'])
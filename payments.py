@@ -1,21 +1,15 @@
 # -*- coding: utf-8 -*-
 
-import requests
+import http_client
 
 def approve_payment(installation, payment_id):
     return \
-        requests.post('%s/payments/%s/approve' % (installation.api_url, payment_id), \
-                 headers={
-                     "Accept": "application/hal+json",
-                     "Authorization": "Bearer %s" % installation.access_token
-                 }).json() \
+        http_client.json_body(http_client.post('%s/payments/%s/approve' % (installation.api_url, payment_id), \
+                 access_token=installation.access_token, operation='approve_payment', circuit=installation.hostname)) \
         .get('returnUri', None)
 
 def cancel_payment(installation, payment_id):
     return \
-        requests.post('%s/payments/%s/cancel' % (installation.api_url, payment_id), \
-                 headers={
-                     "Accept": "application/hal+json",
-                     "Authorization": "Bearer %s" % installation.access_token
-                 }).json() \
+        http_client.json_body(http_client.post('%s/payments/%s/cancel' % (installation.api_url, payment_id), \
+                 access_token=installation.access_token, operation='cancel_payment', circuit=installation.hostname)) \
         .get('returnUri', None)
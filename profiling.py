@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    On-demand profiling of live workers. Disabled unless PROFILER_TOKEN is
+    set; every call then needs an 'Authorization: Bearer <PROFILER_TOKEN>'
+    header.
+
+    POST /_profiler/requests?route=/payments/<payment_id>/approve&count=20&seconds=60
+        cProfile the next matching requests, one .prof file per request
+    POST /_profiler/stacks?seconds=10&interval=0.005
+        sample the stacks of all threads, written as collapsed stacks
+        (input for flamegraph.pl or speedscope)
+    GET /_profiler
+        current state and output files
+
+    Output goes to PROFILER_DIR. A request reaches a single worker, so
+    repeat it to arm more workers; the response names the worker's pid.
+    While nothing is armed, requests don't pass through any profiler code.
+'''
+
+import cProfile
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from flask import Response, jsonify, request
+from werkzeug.routing import Map, Rule
+
+from signers import verify_bearer_token
+
+PROFILER_TOKEN = os.environ.get('PROFILER_TOKEN', '')
+PROFILER_DIR = os.environ.get('PROFILER_DIR', os.path.join(tempfile.gettempdir(), 'payment-app-profiles'))
+# Upper bounds for a single arming
+PROFILER_MAX_REQUESTS = 1000
+PROFILER_MAX_SECONDS = 600
+
+class RequestProfiler(object):
+    """WSGI middleware profiling requests to one route, swapped in only while armed.
+    """
+    def __init__(self, app, route, count, seconds):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self.route = route
+        self.remaining = count
+        self.deadline = time.monotonic() + seconds
+        self.written = []
+        self._urls = Map([Rule(route, endpoint='profiled')]).bind('')
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        if time.monotonic() > self.deadline:
+            self.disarm()
+            return self.wsgi_app(environ, start_response)
+        if not self._matches(environ) or not self._claim():
+            return self.wsgi_app(environ, start_response)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(self.wsgi_app, environ, start_response)
+        finally:
+            path = os.path.join(PROFILER_DIR, 'request-%i-%i-%i.prof' % (os.getpid(), time.time() * 1000, len(self.written)))
+            profile.dump_stats(path)
+            self.written.append(path)
+
+    def disarm(self):
+        if self.app.wsgi_app is self:
+            self.app.wsgi_app = self.wsgi_app
+
+    def _matches(self, environ):
+        try:
+            self._urls.match(environ.get('PATH_INFO', ''), method=environ.get('REQUEST_METHOD'))
+            return True
+        except Exception:
+            return False
+
+    def _claim(self):
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.disarm()
+            return True
+
+class StackSampler(object):
+    """Samples the stacks of all other threads at a fixed interval.
+    """
+    def __init__(self, seconds, interval):
+        self.seconds = seconds
+        self.interval = interval
+        self.samples = Counter()
+        self.path = os.path.join(PROFILER_DIR, 'stacks-%i-%i.folded' % (os.getpid(), time.time() * 1000))
+        self.thread = threading.Thread(target=self.run, name='stack-sampler', daemon=True)
+
+    def run(self):
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + self.seconds
+        while time.monotonic() < deadline:
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    self.samples[self._collapse(names.get(thread_id, str(thread_id)), frame)] += 1
+            time.sleep(self.interval)
+        with open(self.path, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write('%s %i\n' % (stack, count))
+
+    def _collapse(self, thread_name, frame):
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append('%s (%s)' % (code.co_name, os.path.basename(code.co_filename)))
+            frame = frame.f_back
+        frames.append(thread_name.replace(' ', '_'))
+        return ';'.join(reversed(frames)).replace(' ', '_')
+
+_lock = threading.Lock()
+_request_profiler = None
+_stack_sampler = None
+
+def init_app(app):
+    if not PROFILER_TOKEN:
+        return
+
+    @app.route('/_profiler', methods=['GET'])
+    def profiler_status():
+        return _authorized(_status)
+
+    @app.route('/_profiler/requests', methods=['POST'])
+    def profile_requests():
+        return _authorized(lambda: _arm_requests(app))
+
+    @app.route('/_profiler/stacks', methods=['POST'])
+    def sample_stacks():
+        return _authorized(_start_stack_sampler)
+
+def _authorized(action):
+    if not verify_bearer_token(request.headers.get('Authorization', ''), PROFILER_TOKEN):
+        return Response('Forbidden', status=403)
+    return action()
+
+def _arm_requests(app):
+    global _request_profiler
+    route = request.args.get('route', '')
+    count = min(int(request.args.get('count', '10')), PROFILER_MAX_REQUESTS)
+    seconds = min(float(request.args.get('seconds', '60')), PROFILER_MAX_SECONDS)
+    if not route.startswith('/'):
+        return Response('route must be a URL rule like /payments/<payment_id>/approve', status=400)
+    os.makedirs(PROFILER_DIR, exist_ok=True)
+    with _lock:
+        if _request_profiler is not None:
+            _request_profiler.disarm()
+        _request_profiler = RequestProfiler(app, route, count, seconds)
+        app.wsgi_app = _request_profiler
+    return _status()
+
+def _start_stack_sampler():
+    global _stack_sampler
+    seconds = min(float(request.args.get('seconds', '10')), PROFILER_MAX_SECONDS)
+    interval = max(float(request.args.get('interval', '0.005')), 0.001)
+    os.makedirs(PROFILER_DIR, exist_ok=True)
+    with _lock:
+        if _stack_sampler is not None and _stack_sampler.thread.is_alive():
+            return Response('Stack sampling already running', status=409)
+        _stack_sampler = StackSampler(seconds, interval)
+        _stack_sampler.thread.start()
+    return _status()
+
+def _status():
+    status = {'pid': os.getpid(), 'directory': PROFILER_DIR}
+    if _request_profiler is not None:
+        status['requests'] = {
+            'route': _request_profiler.route,
+            'remaining': max(_request_profiler.remaining, 0),
+            'armed': _request_profiler.app.wsgi_app is _request_profiler,
+            'files': _request_profiler.written
+        }
+    if _stack_sampler is not None:
+        status['stacks'] = {
+            'running': _stack_sampler.thread.is_alive(),
+            'file': _stack_sampler.path
+        }
+    return jsonify(status)
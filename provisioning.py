@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    Record of the payment methods created for each installed shop, so
+    payment methods can be provisioned for shops installed before their
+    definition was added. Shops whose provisioning failed are skipped for
+    PROVISIONING_RETRY_BACKOFF seconds, doubling with every further failure.
+'''
+
+import os
+import threading
+import time
+from datetime import datetime
+
+from psycopg2.extras import execute_values
+
+from db import BULK_PAGE_SIZE, batched, get_pool
+import logs
+from metrics import DB_QUERY_SECONDS, timed
+
+# Seconds a shop is skipped after its provisioning failed
+PROVISIONING_RETRY_BACKOFF = float(os.environ.get('PROVISIONING_RETRY_BACKOFF', '300'))
+# Longest a shop that keeps failing is skipped, in seconds
+PROVISIONING_MAX_RETRY_BACKOFF = float(os.environ.get('PROVISIONING_MAX_RETRY_BACKOFF', '86400'))
+
+LOGGER = logs.get_logger('provisioning')
+
+class ProvisionedPaymentMethods(object):
+    def __init__(self, app_installations, retry_backoff=PROVISIONING_RETRY_BACKOFF, max_retry_backoff=PROVISIONING_MAX_RETRY_BACKOFF):
+        self.app_installations = app_installations
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self.provisioned = set()
+        self.failures = {}
+        self._lock = threading.Lock()
+
+    def record(self, hostname, payment_method_definition_names):
+        return self.record_many((hostname, name) for name in payment_method_definition_names)
+
+    def record_many(self, pairs):
+        """Record (hostname, payment method definition name) pairs. Returns the number of pairs.
+        """
+        pairs = list(pairs)
+        with self._lock:
+            self.provisioned.update(pairs)
+        return len(pairs)
+
+    def record_failure(self, hostname):
+        """Skip the shop in iter_missing until its backoff ends
+        """
+        with self._lock:
+            attempts = self.failures.get(hostname, (0, None))[0] + 1
+            self.failures[hostname] = (attempts, time.monotonic() + self._backoff(attempts))
+
+    def forget_failures(self, hostnames):
+        with self._lock:
+            for hostname in hostnames:
+                self.failures.pop(hostname, None)
+
+    def _backoff(self, attempts):
+        return min(self.retry_backoff * 2 ** (attempts - 1), self.max_retry_backoff)
+
+    def iter_missing(self, payment_method_definition_names, batch_size=BULK_PAGE_SIZE):
+        """Yield (hostname, missing definition names) for every installation
+        lacking one of the definitions and not backing off, ordered by hostname
+        """
+        for hostname in self.app_installations.hostnames():
+            with self._lock:
+                missing = [name for name in payment_method_definition_names if (hostname, name) not in self.provisioned]
+                failure = self.failures.get(hostname)
+            if failure is not None and failure[1] > time.monotonic():
+                continue
+            if missing:
+                yield hostname, missing
+
+class PostgresProvisionedPaymentMethods(ProvisionedPaymentMethods):
+    def __init__(self, database_url, pool=None, retry_backoff=PROVISIONING_RETRY_BACKOFF, max_retry_backoff=PROVISIONING_MAX_RETRY_BACKOFF):
+        self.database_url = database_url
+        self.pool = pool or get_pool(database_url)
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+
+    INSERT_SQL = """INSERT INTO PROVISIONED_PAYMENT_METHODS (HOSTNAME, PAYMENT_METHOD_DEFINITION) VALUES %s
+                    ON CONFLICT DO NOTHING"""
+
+    @timed(DB_QUERY_SECONDS, operation='provisioning.record')
+    def record_many(self, pairs, page_size=BULK_PAGE_SIZE):
+        count = 0
+        with self.pool.connection() as conn:
+            with conn.cursor() as curs:
+                for batch in batched(pairs, page_size):
+                    execute_values(curs, self.INSERT_SQL, batch, page_size=page_size)
+                    count += len(batch)
+        return count
+
+    FAILURE_SQL = """INSERT INTO PROVISIONING_FAILURES (HOSTNAME, ATTEMPTS, RETRY_AFTER) VALUES (%(hostname)s, 1, %(now)s + %(backoff)s * interval '1 second')
+                     ON CONFLICT (HOSTNAME) DO UPDATE SET
+                         ATTEMPTS = PROVISIONING_FAILURES.ATTEMPTS + 1,
+                         RETRY_AFTER = %(now)s + least(%(backoff)s * power(2, PROVISIONING_FAILURES.ATTEMPTS), %(max_backoff)s) * interval '1 second'"""
+
+    @timed(DB_QUERY_SECONDS, operation='provisioning.record_failure')
+    def record_failure(self, hostname):
+        with self.pool.connection() as conn:
+            with conn.cursor() as curs:
+                curs.execute(self.FAILURE_SQL, {'hostname': hostname, 'now': datetime.now(),
+                                                'backoff': self._backoff(1), 'max_backoff': self.max_retry_backoff})
+
+    @timed(DB_QUERY_SECONDS, operation='provisioning.forget_failures')
+    def forget_failures(self, hostnames):
+        hostnames = list(hostnames)
+        if not hostnames:
+            return
+        with self.pool.connection() as conn:
+            with conn.cursor() as curs:
+                curs.execute("DELETE FROM PROVISIONING_FAILURES WHERE HOSTNAME = ANY(%s)", (hostnames,))
+
+    MISSING_SQL = """SELECT HOSTNAME, MISSING FROM (
+                         SELECT I.HOSTNAME, ARRAY(
+                             SELECT D.NAME FROM unnest(%s::varchar[]) WITH ORDINALITY AS D(NAME, POSITION)
+                             WHERE NOT EXISTS (SELECT 1 FROM PROVISIONED_PAYMENT_METHODS P
+                                               WHERE P.HOSTNAME = I.HOSTNAME AND P.PAYMENT_METHOD_DEFINITION = D.NAME)
+                             ORDER BY D.POSITION) AS MISSING
+                         FROM APP_INSTALLATIONS I WHERE I.HOSTNAME > %s
+                         AND NOT EXISTS (SELECT 1 FROM PROVISIONING_FAILURES F
+                                         WHERE F.HOSTNAME = I.HOSTNAME AND F.RETRY_AFTER > %s)) AS PENDING
+                     WHERE cardinality(MISSING) > 0
+                     ORDER BY HOSTNAME LIMIT %s"""
+
+    def iter_missing(self, payment_method_definition_names, batch_size=BULK_PAGE_SIZE):
+        # Read batch by batch, each on a briefly borrowed connection, so
+        # memory stays flat and callers working through a batch hold none
+        names = list(payment_method_definition_names)
+        after = ''
+        while True:
+            batch = self._missing_after(names, after, batch_size)
+            for hostname, missing in batch:
+                yield hostname, missing
+            if len(batch) < batch_size:
+                return
+            after = batch[-1][0]
+
+    @timed(DB_QUERY_SECONDS, operation='provisioning.find_missing')
+    def _missing_after(self, names, after, limit):
+        with self.pool.connection() as conn:
+            with conn.cursor() as curs:
+                curs.execute(self.MISSING_SQL, (names, after, datetime.now(), limit))
+                return curs.fetchall()
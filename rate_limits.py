@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    Client side rate limits for outbound calls, and token buckets limiting
+    the requests of each shop.
+'''
+
+import threading
+import time
+from collections import OrderedDict
+
+from db import get_pool
+from metrics import DB_QUERY_SECONDS, timed
+
+class RateLimiter(object):
+    """Spaces out calls to at most rate per second, across threads.
+    """
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._clock = clock
+        self._sleep = sleep
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = self._clock()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            self._sleep(wait)
+
+class KeyedRateLimiter(object):
+    """One RateLimiter per key, e.g. per host.
+    """
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self._clock = clock
+        self._sleep = sleep
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        with self._lock:
+            limiter = self._limiters.get(key)
+            if limiter is None:
+                limiter = self._limiters[key] = RateLimiter(self.rate, self._clock, self._sleep)
+        limiter.acquire()
+
+    def forget(self, key):
+        """Drop the limiter of a key that won't be used again
+        """
+        with self._lock:
+            self._limiters.pop(key, None)
+
+class TokenBucket(object):
+    """Admits bursts of up to burst calls, refilled at rate per second. Never blocks.
+    """
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self._clock = clock
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """0 if the call is admitted, else the seconds until it would be
+        """
+        with self._lock:
+            now = self._clock()
+            self.tokens = min(self.burst, self.tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+class TokenBuckets(object):
+    """One TokenBucket per key, e.g. per shop, in this process. Keys come
+    from requests, so only the maxsize most recently used ones are kept.
+    """
+    def __init__(self, rate, burst, maxsize=10000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, key):
+        """0 if a call for key is admitted, else the seconds until it would be
+        """
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst, self._clock)
+                if len(self._buckets) > self.maxsize:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+        return bucket.try_acquire()
+
+class PostgresTokenBuckets(TokenBuckets):
+    """Token buckets shared by all processes, at the cost of a query per call
+    """
+    def __init__(self, database_url, rate, burst, pool=None):
+        super().__init__(rate, burst)
+        self.pool = pool or get_pool(database_url)
+
+    @timed(DB_QUERY_SECONDS, operation='rate_limits.try_acquire')
+    def try_acquire(self, key):
+        with self.pool.connection() as conn:
+            with conn.cursor() as curs:
+                # Refill and take a token in one round trip. The row lock
+                # serializes concurrent calls for the same key.
+                curs.execute("""INSERT INTO RATE_LIMIT_BUCKETS (KEY, TOKENS, UPDATED_AT)
+                                VALUES (%(key)s, %(burst)s, clock_timestamp())
+                                ON CONFLICT (KEY) DO NOTHING;
+                                UPDATE RATE_LIMIT_BUCKETS SET
+                                  TOKENS = bucket.TOKENS - CASE WHEN bucket.TOKENS >= 1 THEN 1 ELSE 0 END,
+                                  UPDATED_AT = bucket.NOW
+                                FROM (SELECT KEY, clock_timestamp() AS NOW,
+                                             LEAST(%(burst)s, TOKENS + EXTRACT(EPOCH FROM clock_timestamp() - UPDATED_AT) * %(rate)s) AS TOKENS
+                                      FROM RATE_LIMIT_BUCKETS WHERE KEY = %(key)s FOR UPDATE) bucket
+                                WHERE RATE_LIMIT_BUCKETS.KEY = bucket.KEY
+                                RETURNING bucket.TOKENS""", {'key': key, 'rate': self.rate, 'burst': self.burst})
+                tokens = float(curs.fetchone()[0])
+        if tokens >= 1:
+            return 0.0
+        return (1 - tokens) / self.rate
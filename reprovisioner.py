@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    Job creating the auto installed payment methods for shops that don't
+    have them yet, e.g. after a definition was added to
+    AUTO_INSTALLED_PAYMENT_METHOD_DEFINITIONS.
+
+    Installations lacking a payment method are read from Postgres in
+    batches and provisioned concurrently, with a rate limit per shop host.
+    The job has its own connection pool with one connection per thread,
+    which a thread holds while it refreshes an expired token. Created
+    payment methods are recorded every REPROVISION_CHECKPOINT_SIZE
+    successes and when the job ends, so an interrupted run resumes where it
+    stopped.
+
+    Payment methods a shop already has in Beyond, e.g. from installing the
+    app before they were recorded, are recorded without creating them
+    again. Shops that fail are backed off, see provisioning.
+
+    Run with `python reprovisioner.py`, see --help.
+'''
+
+import argparse
+import os
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from app_installations import PostgresAppInstallations
+from db import ConnectionPool
+from payment_method_definitions import AUTO_INSTALLED_PAYMENT_METHOD_DEFINITIONS, create_payment_method, get_payment_method_definitions_in_use, \
+    payment_method_created, payment_method_exists
+from provisioning import PostgresProvisionedPaymentMethods
+from rate_limits import KeyedRateLimiter
+import logs
+import metrics
+
+# Threads provisioning shops, each one needs a database connection
+REPROVISION_CONCURRENCY = int(os.environ.get('REPROVISION_CONCURRENCY', '16'))
+# Maximum number of Beyond API calls per second to a single shop
+REPROVISION_HOST_RATE_LIMIT = float(os.environ.get('REPROVISION_HOST_RATE_LIMIT', '5'))
+# Created payment methods recorded per write
+REPROVISION_CHECKPOINT_SIZE = int(os.environ.get('REPROVISION_CHECKPOINT_SIZE', '200'))
+
+LOGGER = logs.get_logger('reprovisioner')
+PROVISIONED = metrics.counter('payment_methods_provisioned_total', 'Payment methods created, found existing or failed by the reprovisioner', ['result'])
+
+class Reprovisioner(object):
+    def __init__(self, app_installations, provisioned_payment_methods,
+                 payment_method_definition_names=AUTO_INSTALLED_PAYMENT_METHOD_DEFINITIONS,
+                 concurrency=REPROVISION_CONCURRENCY,
+                 host_rate_limit=REPROVISION_HOST_RATE_LIMIT,
+                 checkpoint_size=REPROVISION_CHECKPOINT_SIZE):
+        self.app_installations = app_installations
+        self.provisioned_payment_methods = provisioned_payment_methods
+        self.payment_method_definition_names = list(payment_method_definition_names)
+        self.concurrency = concurrency
+        self.checkpoint_size = checkpoint_size
+        self.host_limits = KeyedRateLimiter(host_rate_limit)
+        self.summary = Counter()
+        self._provisioned = []
+        self._succeeded = []
+        self._lock = threading.Lock()
+
+    def pending(self):
+        """Number of shops lacking at least one payment method
+        """
+        return sum(1 for _ in self.provisioned_payment_methods.iter_missing(self.payment_method_definition_names))
+
+    def run(self):
+        """Provision all missing payment methods. Returns the summary counts.
+        """
+        # At most this many shops are queued ahead of the threads, so memory
+        # stays flat no matter how many installations there are
+        slots = threading.BoundedSemaphore(self.concurrency * 2)
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                for hostname, missing in self.provisioned_payment_methods.iter_missing(self.payment_method_definition_names):
+                    slots.acquire()
+                    executor.submit(self._provision, hostname, missing).add_done_callback(lambda _: slots.release())
+        finally:
+            self._checkpoint(force=True)
+        LOGGER.info('Reprovisioning finished', **self.summary)
+        return self.summary
+
+    def _provision(self, hostname, missing):
+        failed = True
+        try:
+            installation = self.app_installations.get_installation(hostname)
+            if installation is None:
+                failed = False
+                self._count('shops_skipped')
+                return
+            self.host_limits.acquire(hostname)
+            in_use = get_payment_method_definitions_in_use(installation)
+            failed = False
+            for name in missing:
+                if name in in_use:
+                    self._record(hostname, name, 'existing')
+                    continue
+                self.host_limits.acquire(hostname)
+                status = create_payment_method(installation, name)
+                if payment_method_created(status):
+                    self._record(hostname, name, 'created')
+                elif payment_method_exists(status):
+                    self._record(hostname, name, 'existing')
+                else:
+                    LOGGER.warning('Creating payment method failed', hostname=hostname, payment_method_definition=name, status=status)
+                    self._count('failed')
+                    failed = True
+            self._count('shops')
+            if not failed:
+                with self._lock:
+                    self._succeeded.append(hostname)
+        except Exception:
+            LOGGER.exception('Provisioning shop failed', hostname=hostname)
+            self._count('shops_failed')
+        finally:
+            self.host_limits.forget(hostname)
+            if failed:
+                self.provisioned_payment_methods.record_failure(hostname)
+            self._checkpoint()
+
+    def _record(self, hostname, name, result):
+        with self._lock:
+            self._provisioned.append((hostname, name))
+        self._count(result)
+
+    def _count(self, key):
+        with self._lock:
+            self.summary[key] += 1
+        if key in ('created', 'existing', 'failed'):
+            PROVISIONED.inc(result=key)
+
+    def _checkpoint(self, force=False):
+        with self._lock:
+            if not self._provisioned or (len(self._provisioned) < self.checkpoint_size and not force):
+                return
+            provisioned, self._provisioned = self._provisioned, []
+            succeeded, self._succeeded = self._succeeded, []
+        self.provisioned_payment_methods.record_many(provisioned)
+        self.provisioned_payment_methods.forget_failures(succeeded)
+        LOGGER.info('Recorded provisioned payment methods', count=len(provisioned), shops=self.summary['shops'])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--definitions', default=','.join(AUTO_INSTALLED_PAYMENT_METHOD_DEFINITIONS),
+                        help='comma separated payment method definition names')
+    parser.add_argument('--concurrency', type=int, default=REPROVISION_CONCURRENCY)
+    parser.add_argument('--host-rate-limit', type=float, default=REPROVISION_HOST_RATE_LIMIT, help='calls per second and shop')
+    parser.add_argument('--dry-run', action='store_true', help='only count the shops lacking payment methods')
+    args = parser.parse_args()
+
+    logs.setup()
+    database_url = os.environ.get('DATABASE_URL')
+    # One connection per thread and one for reading the missing shops
+    pool = ConnectionPool(database_url, max_size=args.concurrency + 1)
+    app_installations = PostgresAppInstallations(database_url, os.environ.get('CLIENT_ID', ''), os.environ.get('CLIENT_SECRET', ''), pool=pool)
+    provisioned_payment_methods = PostgresProvisionedPaymentMethods(database_url, pool=pool)
+    reprovisioner = Reprovisioner(app_installations, provisioned_payment_methods,
+                                  [name.strip() for name in args.definitions.split(',') if name.strip()],
+                                  concurrency=args.concurrency,
+                                  host_rate_limit=args.host_rate_limit)
+    if args.dry_run:
+        print('%i shops lack payment methods' % reprovisioner.pending())
+    else:
+        print(dict(reprovisioner.run()))
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,13 @@
 # -*- coding: utf-8 -*-
 
-import psycopg2
-import requests
+from psycopg2.extras import execute_values
+
+from db import BULK_PAGE_SIZE, batched, get_pool, last_by_key
+import http_client
+import logs
+from metrics import DB_QUERY_SECONDS, timed
+
+LOGGER = logs.get_logger('shops')
 
 class Shop(object):
     def __init__(self, id, hostname):
@@ -9,36 +15,56 @@ class Shop(object):
         self.hostname = hostname
 
 class Shops(object):
+    """Keeps the shops in memory, PostgresShops stores them.
+    """
     def __init__(self):
-        pass
+        self.shops = {}
+
+    def create_or_update_shop(self, shop):
+        self.shops[shop.id] = shop
+
+    def create_or_update_shops(self, shops):
+        count = 0
+        for shop in shops:
+            self.create_or_update_shop(shop)
+            count += 1
+        return count
+
     def get_shop(self, id):
-        return None
+        return self.shops.get(id)
 
 class PostgresShops(Shops):
-    def __init__(self, database_url):
+    def __init__(self, database_url, pool=None):
         self.database_url = database_url
+        self.pool = pool or get_pool(database_url)
 
-    def create_schema(self):
-        with psycopg2.connect(self.database_url) as conn:
-            with conn.cursor() as curs:
-                curs.execute("""CREATE TABLE IF NOT EXISTS SHOPS (
-                              ID varchar(255) UNIQUE NOT NULL,
-                              HOSTNAME varchar(255) NOT NULL
-                            )""")
+    UPSERT_SQL = """INSERT INTO SHOPS (ID, HOSTNAME) VALUES %s
+                    ON CONFLICT (ID) DO UPDATE SET HOSTNAME=EXCLUDED.HOSTNAME"""
 
+    @timed(DB_QUERY_SECONDS, operation='shops.upsert')
     def create_or_update_shop(self, shop):
-        print("Create/update shop %s (%s)" % (shop.hostname, shop.id))
-        sql = ''
-        if self.get_shop(shop.id):
-            sql = "UPDATE SHOPS SET HOSTNAME = %s WHERE ID=%s"
-        else:
-            sql = "INSERT INTO SHOPS (HOSTNAME, ID) VALUES(%s, %s)"
-        with psycopg2.connect(self.database_url) as conn:
+        LOGGER.info('Create/update shop', hostname=shop.hostname, shop_id=shop.id)
+        with self.pool.connection() as conn:
+            with conn.cursor() as curs:
+                execute_values(curs, self.UPSERT_SQL, [(shop.id, shop.hostname)])
+
+    @timed(DB_QUERY_SECONDS, operation='shops.bulk_upsert')
+    def create_or_update_shops(self, shops, page_size=BULK_PAGE_SIZE):
+        """Upsert many shops in batches within one transaction. Returns the number of rows written.
+        """
+        count = 0
+        with self.pool.connection() as conn:
             with conn.cursor() as curs:
-                curs.execute(sql, (shop.hostname, shop.id))
+                for batch in batched(shops, page_size):
+                    batch = last_by_key(batch, lambda shop: shop.id)
+                    execute_values(curs, self.UPSERT_SQL, [(shop.id, shop.hostname) for shop in batch], page_size=page_size)
+                    count += len(batch)
+        LOGGER.info('Created/updated shops', count=count)
+        return count
 
+    @timed(DB_QUERY_SECONDS, operation='shops.get')
     def get_shop(self, id):
-        with psycopg2.connect(self.database_url) as conn:
+        with self.pool.connection() as conn:
             with conn.cursor() as curs:
                 curs.execute("SELECT * FROM SHOPS WHERE ID=%s", (id,))
                 entry = curs.fetchone()
@@ -49,9 +75,6 @@ class PostgresShops(Shops):
 
 def get_shop_id(installation):
     return \
-        requests.get('%s/shop-id' % installation.api_url, \
-                 headers={
-                     "Accept": "application/hal+json",
-                     "Authorization": "Bearer %s" % installation.access_token
-                 }).json() \
+        http_client.json_body(http_client.get('%s/shop-id' % installation.api_url, \
+                 access_token=installation.access_token, operation='get_shop_id', circuit=installation.hostname)) \
         .get('shopId', None)
@@ -9,9 +9,102 @@ Description:
 import base64
 import hashlib
 import hmac
+import time
+from functools import lru_cache
+
+import json_codec
+
+_TRANS_36 = bytes((x ^ 0x36) for x in range(256))
+_TRANS_5C = bytes((x ^ 0x5C) for x in range(256))
+
+class Signer(object):
+    """HMAC signer for one secret.
+
+    The inner and outer hash states of the HMAC (RFC 2104) are keyed once
+    and copied per message, which skips hashing the padded key on every
+    call.
+    """
+    def __init__(self, secret, digest='sha1'):
+        self.digest_name = digest
+        key = secret.encode('utf-8')
+        block_size = hashlib.new(digest).block_size
+        if len(key) > block_size:
+            key = hashlib.new(digest, key).digest()
+        key = key.ljust(block_size, b'\0')
+        self._inner = hashlib.new(digest, key.translate(_TRANS_36))
+        self._outer = hashlib.new(digest, key.translate(_TRANS_5C))
+
+    def digest(self, message):
+        inner = self._inner.copy()
+        inner.update(message.encode('utf-8') if isinstance(message, str) else message)
+        outer = self._outer.copy()
+        outer.update(inner.digest())
+        return outer.digest()
+
+    def sign(self, message):
+        return base64.b64encode(self.digest(message)).decode('utf-8')
+
+    def verify(self, message, signature):
+        """Constant-time check of a base64 signature
+        """
+        if not isinstance(signature, str):
+            return False
+        return hmac.compare_digest(self.sign(message).encode('utf-8'), signature.encode('utf-8'))
+
+    def sign_many(self, messages):
+        return [self.sign(message) for message in messages]
+
+    def verify_many(self, messages_and_signatures):
+        return [self.verify(message, signature) for message, signature in messages_and_signatures]
+
+@lru_cache(maxsize=64)
+def signer(secret, digest='sha1'):
+    """Shared Signer per secret and digest
+    """
+    return Signer(secret, digest)
 
 def sign(message, secret):
-    digest = hmac.new(secret.encode('utf-8'),
-                      msg=message.encode('utf-8'),
-                      digestmod=hashlib.sha1).digest()
-    return base64.b64encode(digest).decode('utf-8')
+    return signer(secret).sign(message)
+
+def verify(message, signature, secret):
+    return signer(secret).verify(message, signature)
+
+def sign_token(claims, secret):
+    """Encode claims into a compact, URL-safe token: base64(json).base64(hmac)
+    """
+    payload = _b64encode(json_codec.dumps(claims, sort_keys=True))
+    return '%s.%s' % (payload, _token_signature(payload, secret))
+
+def verify_token(token, secret, now=None):
+    """Return the claims of a token signed with secret, or None if the
+    signature does not match or the expiry claim 'exp' lies in the past.
+    """
+    payload, _, signature = (token or '').partition('.')
+    # As bytes, compare_digest raises on str with non-ASCII characters
+    expected = _token_signature(payload, secret).encode('utf-8')
+    if not payload or not hmac.compare_digest(signature.encode('utf-8'), expected):
+        return None
+    try:
+        claims = json_codec.loads(_b64decode(payload))
+    except ValueError:
+        return None
+    if not isinstance(claims, dict):
+        return None
+    if claims.get('exp', 0) < (time.time() if now is None else now):
+        return None
+    return claims
+
+def _token_signature(payload, secret):
+    return _b64encode(signer(secret, 'sha256').digest(payload))
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+def verify_bearer_token(authorization, expected_token):
+    """Constant-time check of an 'Authorization: Bearer <token>' header value
+    """
+    scheme, _, token = (authorization or '').partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(token.encode('utf-8'), expected_token.encode('utf-8'))
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    Bring the registered payment method definitions in line with the JSON
+    files, e.g. test/*.json. Fetches the remote catalog once, compares each
+    file with its registered definition and only creates or updates the
+    ones that differ, in parallel and under a rate limit.
+
+    New definitions are created like on install, with a POST of the file to
+    /payment-method-definitions. That call only creates, so a registered
+    definition that differs is replaced with a PUT to its own URL,
+    /payment-method-definitions/<_id>.
+
+    Run with:
+        CLIENT_ID=... CLIENT_SECRET=... python sync_payment_method_definitions.py --dry-run test/*.json
+'''
+
+import argparse
+import glob
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from payment_method_definitions import read_json_file, system_token, get_payment_method_definition_catalog, \
+    create_payment_method_definition, update_payment_method_definition
+from rate_limits import RateLimiter
+import json_codec
+
+SYNC_CONCURRENCY = int(os.environ.get('SYNC_CONCURRENCY', '4'))
+# Maximum number of create and update calls per second
+SYNC_RATE_LIMIT = float(os.environ.get('SYNC_RATE_LIMIT', '5'))
+
+# Attributes the API adds on its own, never part of a diff
+SERVER_MANAGED_ATTRIBUTES = ('_links', '_embedded')
+
+CREATE = 'create'
+UPDATE = 'update'
+UNCHANGED = 'unchanged'
+
+class Change(object):
+    def __init__(self, path, definition, action, changed_attributes=()):
+        self.path = path
+        self.definition = definition
+        self.action = action
+        self.changed_attributes = list(changed_attributes)
+        self.error = None
+
+    @property
+    def definition_id(self):
+        return self.definition.get('_id')
+
+def normalize(definition):
+    """The definition without server managed attributes, in a canonical form
+    """
+    return json_codec.loads(json_codec.dumps(dict((key, value) for key, value in definition.items()
+                                                  if key not in SERVER_MANAGED_ATTRIBUTES), sort_keys=True))
+
+def diff(local, remote):
+    """Top level attributes that were added, removed or changed
+    """
+    local = normalize(local)
+    remote = normalize(remote)
+    return sorted(key for key in set(local) | set(remote) if local.get(key) != remote.get(key))
+
+def plan(paths, catalog):
+    changes = []
+    for path in paths:
+        definition = read_json_file(path)
+        remote = catalog.get(definition.get('_id'))
+        if remote is None:
+            changes.append(Change(path, definition, CREATE))
+            continue
+        changed_attributes = diff(definition, remote)
+        changes.append(Change(path, definition, UPDATE if changed_attributes else UNCHANGED, changed_attributes))
+    return changes
+
+def apply(changes, token, concurrency=SYNC_CONCURRENCY, rate_limit=SYNC_RATE_LIMIT):
+    limiter = RateLimiter(rate_limit)
+
+    def push(change):
+        limiter.acquire()
+        try:
+            if change.action == CREATE:
+                result = create_payment_method_definition(token, change.path)
+            else:
+                result = update_payment_method_definition(token, change.definition)
+            if result.get('_id') != change.definition_id:
+                change.error = 'unexpected response %s' % json_codec.dumps(result).decode('utf-8')[:200]
+        except Exception as error:
+            change.error = str(error) or error.__class__.__name__
+
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        list(executor.map(push, [change for change in changes if change.action != UNCHANGED]))
+    return changes
+
+def report(changes, remote_only, dry_run, out=sys.stdout):
+    for change in changes:
+        status = 'FAILED: %s' % change.error if change.error else ('would %s' % change.action if dry_run and change.action != UNCHANGED else change.action)
+        details = ' (%s)' % ', '.join(change.changed_attributes) if change.changed_attributes else ''
+        out.write('%-45s %s%s\n' % (change.definition_id, status, details))
+    for definition_id in remote_only:
+        out.write('%-45s only registered remotely\n' % definition_id)
+
+    counts = dict((action, sum(1 for change in changes if change.action == action and not change.error))
+                  for action in (CREATE, UPDATE, UNCHANGED))
+    failed = sum(1 for change in changes if change.error)
+    out.write('%s%i created, %i updated, %i unchanged, %i failed, %i only registered remotely\n' % (
+        'Dry run: ' if dry_run else '', counts[CREATE], counts[UPDATE], counts[UNCHANGED], failed, len(remote_only)))
+    return failed
+
+def sync(paths, client_id, client_secret, dry_run=False, concurrency=SYNC_CONCURRENCY, rate_limit=SYNC_RATE_LIMIT, out=sys.stdout):
+    """Returns the number of failed pushes
+    """
+    token = system_token(client_id, client_secret)
+    catalog = get_payment_method_definition_catalog(token)
+    changes = plan(paths, catalog)
+    if not dry_run:
+        apply(changes, token, concurrency, rate_limit)
+    local_ids = set(change.definition_id for change in changes)
+    remote_only = sorted(definition.get('_id') for definition in catalog if definition.get('_id') not in local_ids)
+    return report(changes, remote_only, dry_run, out)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='*', help='definition files, test/*.json by default')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would change')
+    parser.add_argument('--concurrency', type=int, default=SYNC_CONCURRENCY)
+    parser.add_argument('--rate-limit', type=float, default=SYNC_RATE_LIMIT, help='create and update calls per second')
+    args = parser.parse_args()
+
+    paths = args.paths or sorted(glob.glob('test/*.json'))
+    failed = sync(paths, os.environ.get('CLIENT_ID', ''), os.environ.get('CLIENT_SECRET', ''),
+                  dry_run=args.dry_run, concurrency=args.concurrency, rate_limit=args.rate_limit)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
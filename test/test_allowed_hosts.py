@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from allowed_hosts import HostAllowList
+
+def test_hosts_match_exactly_or_by_domain():
+    # given
+    allow_list = HostAllowList('*.herokuapp.com, localhost:8080, 127.0.0.1')
+
+    # then
+    assert allow_list.allows('payment-app.herokuapp.com')
+    assert allow_list.allows('Payment-App.HerokuApp.com:443')
+    assert allow_list.allows('localhost:8080')
+    assert allow_list.allows('127.0.0.1:5000')
+    assert not allow_list.allows('herokuapp.com')
+    assert not allow_list.allows('payment-app.herokuapp.com.example.com')
+    assert not allow_list.allows('localhost:9090')
+    assert not allow_list.allows('example.com')
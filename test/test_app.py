@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+import requests
+
+import app
+import http_client
+from app_installations import AppInstallations, Installation
+from payment_ledger import PaymentLedger
+from payment_results import PaymentResults
+from payment_tokens import create_payment_token
+from provisioning import ProvisionedPaymentMethods
+from rate_limits import TokenBuckets
+from shops import Shop, Shops
+from signers import sign
+
+CLIENT_SECRET = 'client-secret'
+HOSTNAME = 'shop.example.com'
+TOKEN_URL = 'https://%s/api/oauth/token' % HOSTNAME
+
+@pytest.fixture
+def client(monkeypatch):
+    installations = AppInstallations('client-id', CLIENT_SECRET)
+    monkeypatch.setattr(app, '_initialized', True)
+    monkeypatch.setattr(app, 'APP_INSTALLATIONS', installations)
+    monkeypatch.setattr(app, 'SHOPS', Shops())
+    monkeypatch.setattr(app, 'PROVISIONED_PAYMENT_METHODS', ProvisionedPaymentMethods(installations))
+    monkeypatch.setattr(app, 'CALLBACK_CONCURRENCY', len(app.AUTO_INSTALLED_PAYMENT_METHOD_DEFINITIONS) + 1)
+    # The token exchange
+    monkeypatch.setattr(http_client, 'post', lambda **kwargs: None)
+    monkeypatch.setattr(http_client, 'json_body', lambda response: {'access_token': 'access-token', 'expires_in': 3600})
+    return app.app.test_client()
+
+def _callback(client):
+    response = client.get('/callback', base_url='http://localhost:8080', query_string={
+        'return_url': 'https://%s/cockpit' % HOSTNAME,
+        'access_token_url': TOKEN_URL,
+        'api_url': 'https://%s/api' % HOSTNAME,
+        'code': 'auth-code',
+        'signature': sign('auth-code:%s' % TOKEN_URL, CLIENT_SECRET)
+    })
+    return response.status_code, response.get_data(as_text=True)
+
+def test_callback_looks_up_the_shop_while_creating_payment_methods(client, monkeypatch):
+    # given
+    all_started = threading.Barrier(len(app.AUTO_INSTALLED_PAYMENT_METHOD_DEFINITIONS) + 1, timeout=5)
+
+    def get_shop_id(installation):
+        all_started.wait()
+        return 'shop-1'
+
+    def create_payment_method(installation, name):
+        all_started.wait()
+        return 200
+    monkeypatch.setattr(app, 'get_shop_id', get_shop_id)
+    monkeypatch.setattr(app, 'create_payment_method', create_payment_method)
+
+    # when
+    status, body = _callback(client)
+
+    # then
+    assert status == 200
+    assert body.count('was automatically created for your shop') == len(app.AUTO_INSTALLED_PAYMENT_METHOD_DEFINITIONS)
+    assert 'Something went wrong when looking up your shop' not in body
+    assert app.SHOPS.get_shop('shop-1').hostname == HOSTNAME
+
+def test_callback_reports_a_failed_shop_lookup(client, monkeypatch):
+    # given
+    def get_shop_id(installation):
+        raise RuntimeError('shop lookup failed')
+    monkeypatch.setattr(app, 'get_shop_id', get_shop_id)
+    monkeypatch.setattr(app, 'create_payment_method', lambda installation, name: 200)
+
+    # when
+    status, body = _callback(client)
+
+    # then
+    assert status == 200
+    assert "Payments can't be approved until you reinstall the app" in body
+    assert body.count('was automatically created for your shop') == len(app.AUTO_INSTALLED_PAYMENT_METHOD_DEFINITIONS)
+    assert app.APP_INSTALLATIONS.get_installation(HOSTNAME).access_token == 'access-token'
+
+@pytest.fixture
+def approvals(client, monkeypatch):
+    """The client, with shop-1 installed and approvals handled in memory
+    """
+    ledger = PaymentLedger()
+    monkeypatch.setattr(app, 'CLIENT_SECRET', CLIENT_SECRET)
+    monkeypatch.setattr(app, 'PAYMENT_RESULTS', PaymentResults())
+    monkeypatch.setattr(app, 'PAYMENT_LEDGER', ledger)
+    app.APP_INSTALLATIONS.create_or_update_installation(Installation(api_url='https://%s/api' % HOSTNAME,
+                                                                     access_token='access-token',
+                                                                     refresh_token='refresh-token',
+                                                                     expiry_date=datetime.now() + timedelta(hours=1)))
+    app.SHOPS.create_or_update_shop(Shop('shop-1', HOSTNAME))
+    yield client
+    ledger.close()
+
+def test_forged_approvals_cannot_drain_the_rate_limit_of_the_shop_they_name(approvals, monkeypatch):
+    # given
+    client = approvals
+    monkeypatch.setattr(app, 'SHOP_RATE_LIMITS', TokenBuckets(rate=0.001, burst=1))
+    monkeypatch.setattr(app.payments, 'approve_payment', lambda installation, payment_id: 'https://%s/return' % HOSTNAME)
+    forged = {'shop_id': 'shop-1', 'signature': 'forged'}
+    signed = {'shop_id': 'shop-1', 'signature': sign('shop-1:payment-1', CLIENT_SECRET)}
+    token = {'token': create_payment_token('shop-1', HOSTNAME, 'payment-2', CLIENT_SECRET)}
+
+    # when
+    forged_statuses = [client.post('/payments/payment-1/approve', base_url='http://localhost:8080', data=forged).status_code
+                       for _ in range(3)]
+    response = client.post('/payments/payment-1/approve', base_url='http://localhost:8080', data=signed)
+    token_response = client.post('/payments/payment-2/approve', base_url='http://localhost:8080', data=token)
+
+    # then
+    assert forged_statuses == [200, 429, 429]
+    assert response.status_code == 200
+    assert 'Payment approved' in response.get_data(as_text=True)
+    assert token_response.status_code == 429
+
+def test_approval_reports_an_unreachable_beyond_as_failed_and_can_be_retried(approvals, monkeypatch):
+    # given
+    client = approvals
+    token = create_payment_token('shop-1', HOSTNAME, 'payment-1', CLIENT_SECRET)
+    def unreachable(installation, payment_id):
+        raise requests.ConnectionError('connection refused')
+    monkeypatch.setattr(app.payments, 'approve_payment', unreachable)
+
+    # when
+    failed = client.post('/payments/payment-1/approve', base_url='http://localhost:8080', data={'token': token})
+    monkeypatch.setattr(app.payments, 'approve_payment', lambda installation, payment_id: 'https://%s/return' % HOSTNAME)
+    retried = client.post('/payments/payment-1/approve', base_url='http://localhost:8080', data={'token': token})
+
+    # then
+    assert failed.status_code == 200
+    assert 'Payment failed' in failed.get_data(as_text=True)
+    assert 'Payment approved' in retried.get_data(as_text=True)
+
+def test_approval_page_refuses_a_token_issued_for_another_payment_or_shop(approvals):
+    # given
+    client = approvals
+    token = create_payment_token('shop-1', HOSTNAME, 'payment-1', CLIENT_SECRET)
+
+    # when
+    statuses = [client.get('/embedded-payment-approval', base_url='http://localhost:8080',
+                           query_string={'paymentId': payment_id, 'shopId': shop_id, 'token': token}).status_code
+                for payment_id, shop_id in [('payment-1', 'shop-1'), ('payment-2', 'shop-1'), ('payment-1', 'shop-2')]]
+
+    # then
+    assert statuses == [200, 400, 400]
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import app_installations
+import http_client
+from app_installations import AppInstallations, Installation, PostgresAppInstallations
+from db import PoolTimeout
+
+class CountingAppInstallations(AppInstallations):
+    def __init__(self):
+        super().__init__('client-id', 'client-secret')
+        self.lookups = 0
+        self.refreshes_done = 0
+
+    def _find_installation(self, hostname, session=None):
+        self.lookups += 1
+        return super()._find_installation(hostname, session)
+
+    def _refresh_token(self, installation, session=None):
+        time.sleep(0.2)
+        self.refreshes_done += 1
+        self.create_or_update_installation(_installation(expires_in_minutes=60))
+
+def _installation(expires_in_minutes):
+    return Installation(api_url='https://shop.example.com/api',
+                        access_token='access-token',
+                        refresh_token='refresh-token',
+                        expiry_date=datetime.now() + timedelta(minutes=expires_in_minutes))
+
+def test_get_installation_is_served_from_cache():
+    # given
+    installations = CountingAppInstallations()
+    installations.create_or_update_installation(_installation(expires_in_minutes=60))
+
+    # when
+    first = installations.get_installation('shop.example.com')
+    second = installations.get_installation('shop.example.com')
+
+    # then
+    assert first is second
+    assert installations.lookups == 1
+    assert installations.cache.stats()['hits'] == 1
+
+def test_create_or_update_installation_invalidates_cache():
+    # given
+    installations = CountingAppInstallations()
+    installations.create_or_update_installation(_installation(expires_in_minutes=60))
+    installations.get_installation('shop.example.com')
+
+    # when
+    updated = _installation(expires_in_minutes=120)
+    installations.create_or_update_installation(updated)
+
+    # then
+    assert installations.get_installation('shop.example.com') is updated
+
+def test_concurrent_callers_trigger_a_single_token_refresh():
+    # given
+    installations = CountingAppInstallations()
+    installations.create_or_update_installation(_installation(expires_in_minutes=5))
+    results = []
+
+    def caller():
+        results.append(installations.get_installation('shop.example.com'))
+
+    # when
+    threads = [threading.Thread(target=caller) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    # then
+    assert installations.refreshes_done == 1
+    assert len(results) == 8
+    assert not any(installation.is_expired() for installation in results)
+
+def test_find_hostnames_expiring_within_horizon():
+    # given
+    installations = CountingAppInstallations()
+    installations.create_or_update_installation(_installation(expires_in_minutes=20))
+    later = Installation(api_url='https://later.example.com/api',
+                         access_token='access-token',
+                         expiry_date=datetime.now() + timedelta(hours=5))
+    installations.create_or_update_installation(later)
+
+    # when
+    hostnames = installations.find_hostnames_expiring_within(timedelta(minutes=30))
+
+    # then
+    assert hostnames == ['shop.example.com']
+
+def test_installations_can_be_listed_while_others_are_installed():
+    # given
+    installations = AppInstallations('client-id', 'client-secret')
+    errors = []
+    def install(offset):
+        for i in range(2000):
+            installations.create_or_update_installation(Installation(api_url='https://shop-%i-%i.example.com/api' % (offset, i),
+                                                                     access_token='access-token',
+                                                                     expiry_date=datetime.now() + timedelta(minutes=5)))
+    def list_expiring():
+        try:
+            for _ in range(200):
+                installations.find_hostnames_expiring_within(timedelta(minutes=30))
+                installations.hostnames()
+        except RuntimeError as error:
+            errors.append(error)
+
+    # when
+    threads = [threading.Thread(target=install, args=(offset,)) for offset in range(4)] + [threading.Thread(target=list_expiring)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # then
+    assert errors == []
+    assert len(installations.hostnames()) == 8000
+
+class FakeCursor(object):
+    def __init__(self, database):
+        self.database = database
+        self.entry = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params=None):
+        self.database.statements.append(sql)
+        if sql.startswith('SELECT pg_advisory_lock'):
+            self.database.lock_barrier.wait(timeout=5)
+        elif sql.startswith('SELECT * FROM APP_INSTALLATIONS'):
+            self.entry = self.database.rows.get(params[0])
+
+    def fetchone(self):
+        return self.entry
+
+class FakeConnection(object):
+    def __init__(self, database):
+        self.database = database
+
+    def cursor(self):
+        return FakeCursor(self.database)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def get_transaction_status(self):
+        return 0
+
+class FakePool(object):
+    """Hands out at most max_size connections, like db.ConnectionPool
+    """
+    def __init__(self, max_size, parties=1):
+        self.rows = {}
+        self.statements = []
+        self.lock_barrier = threading.Barrier(parties)
+        self.borrowed = 0
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    @contextmanager
+    def connection(self):
+        if not self._slots.acquire(timeout=0.5):
+            raise PoolTimeout('No database connection available')
+        self.borrowed += 1
+        try:
+            yield FakeConnection(self)
+        finally:
+            self._slots.release()
+
+def _execute_values(curs, sql, rows, page_size=100):
+    curs.database.statements.append(sql)
+    for row in rows:
+        curs.database.rows[row[0]] = row
+
+def test_concurrent_refreshes_need_one_connection_each(monkeypatch):
+    # given
+    pool = FakePool(max_size=2, parties=2)
+    installations = PostgresAppInstallations(None, 'client-id', 'client-secret', pool=pool)
+    for hostname in ('a.example.com', 'b.example.com'):
+        pool.rows[hostname] = (hostname, 'https://%s/api' % hostname, 'old-token', 'refresh-token', datetime.now() + timedelta(minutes=5))
+    monkeypatch.setattr(app_installations, 'execute_values', _execute_values)
+    monkeypatch.setattr(http_client, 'post', lambda **kwargs: None)
+    monkeypatch.setattr(http_client, 'json_body', lambda response: {'access_token': 'new-token', 'refresh_token': 'refresh-token', 'expires_in': 3600})
+    results = {}
+    errors = []
+
+    def refresh(hostname):
+        try:
+            results[hostname] = installations.refresh_installation(hostname)
+        except Exception as error:
+            errors.append(error)
+
+    # when
+    threads = [threading.Thread(target=refresh, args=(hostname,)) for hostname in ('a.example.com', 'b.example.com')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    # then
+    assert errors == []
+    assert [results[hostname].access_token for hostname in sorted(results)] == ['new-token', 'new-token']
+
+def test_bulk_upsert_keeps_the_last_installation_per_host():
+    # given
+    installations = CountingAppInstallations()
+    installations.create_or_update_installation(_installation(expires_in_minutes=60))
+    installations.get_installation('shop.example.com')
+    latest = _installation(expires_in_minutes=120)
+
+    # when
+    count = installations.create_or_update_installations([_installation(expires_in_minutes=90), latest])
+
+    # then
+    assert count == 2
+    assert installations.get_installation('shop.example.com') is latest
+
+def test_postgres_bulk_upsert_writes_batches_in_one_transaction(monkeypatch):
+    # given
+    pool = FakePool(max_size=1)
+    monkeypatch.setattr(app_installations, 'execute_values', _execute_values)
+    installations = PostgresAppInstallations(None, 'client-id', 'client-secret', pool=pool)
+    first = _installation(expires_in_minutes=60)
+    latest = _installation(expires_in_minutes=120)
+    other = Installation(api_url='https://other.example.com/api', access_token='access-token', expiry_date=datetime.now())
+
+    # when
+    count = installations.create_or_update_installations([first, latest, other], page_size=2)
+
+    # then
+    assert count == 2
+    assert pool.borrowed == 1
+    assert pool.statements == [PostgresAppInstallations.UPSERT_SQL] * 2
+    assert pool.rows['shop.example.com'][2:] == ('access-token', 'refresh-token', latest.expiry_date)
+    assert 'other.example.com' in pool.rows
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+
+import asgi_app
+import http_client
+from allowed_hosts import HostAllowList
+from app_installations import AppInstallations, Installation
+from payment_ledger import APPROVED, PENDING, PaymentLedger
+from payment_results import PaymentResults
+from payment_tokens import create_payment_token
+from provisioning import ProvisionedPaymentMethods
+from rate_limits import TokenBuckets
+from shops import Shop, Shops
+from signers import sign
+
+CLIENT_SECRET = 'client-secret'
+HOSTNAME = 'shop.example.com'
+
+@pytest.fixture
+def stores(monkeypatch):
+    installations = AppInstallations('client-id', CLIENT_SECRET)
+    ledger = PaymentLedger()
+    monkeypatch.setattr(asgi_app, 'APP_INSTALLATIONS', installations)
+    monkeypatch.setattr(asgi_app, 'SHOPS', Shops())
+    monkeypatch.setattr(asgi_app, 'PROVISIONED_PAYMENT_METHODS', ProvisionedPaymentMethods(installations))
+    monkeypatch.setattr(asgi_app, 'PAYMENT_RESULTS', PaymentResults())
+    monkeypatch.setattr(asgi_app, 'PAYMENT_LEDGER', ledger)
+    monkeypatch.setattr(asgi_app, 'CLIENT_SECRET', CLIENT_SECRET)
+    monkeypatch.setattr(asgi_app, 'HOST_ALLOW_LIST', HostAllowList('localhost'))
+    monkeypatch.setattr(asgi_app, 'SHOP_RATE_LIMITS', None)
+    asgi_app.PAGE_CACHE.clear()
+    yield asgi_app
+    ledger.close()
+
+def _installation():
+    return Installation(api_url='https://%s/api' % HOSTNAME,
+                        access_token='access-token',
+                        refresh_token='refresh-token',
+                        expiry_date=datetime.now() + timedelta(hours=1))
+
+def _request(method, path, **kwargs):
+    async def send():
+        response = await getattr(asgi_app.app.test_client(), method)(path, **kwargs)
+        return response.status_code, (await response.get_data()).decode('utf-8')
+    return asyncio.run(send())
+
+def test_callback_installs_the_app_and_reports_a_failed_shop_lookup(stores, monkeypatch):
+    # given
+    token_url = 'https://%s/api/oauth/token' % HOSTNAME
+    monkeypatch.setattr(http_client, 'post', lambda **kwargs: None)
+    monkeypatch.setattr(http_client, 'json_body', lambda response: {'access_token': 'access-token', 'expires_in': 3600})
+
+    async def get_shop_id(installation):
+        raise RuntimeError('shop lookup failed')
+
+    async def create_payment_method(installation, name):
+        return 200
+    monkeypatch.setattr(asgi_app.beyond_async, 'get_shop_id', get_shop_id)
+    monkeypatch.setattr(asgi_app.beyond_async, 'create_payment_method', create_payment_method)
+
+    # when
+    status, body = _request('get', '/callback', query_string={
+        'return_url': 'https://%s/cockpit' % HOSTNAME,
+        'access_token_url': token_url,
+        'api_url': 'https://%s/api' % HOSTNAME,
+        'code': 'auth-code',
+        'signature': sign('auth-code:%s' % token_url, CLIENT_SECRET)
+    })
+
+    # then
+    assert status == 200
+    assert 'was automatically created for your shop' in body
+    assert "Payments can't be approved until you reinstall the app" in body
+    assert stores.APP_INSTALLATIONS.get_installation(HOSTNAME).access_token == 'access-token'
+    assert list(stores.PROVISIONED_PAYMENT_METHODS.iter_missing(asgi_app.AUTO_INSTALLED_PAYMENT_METHOD_DEFINITIONS)) == []
+
+def test_created_payments_are_recorded_as_pending(stores):
+    # when
+    status, body = _request('post', '/payments', json={'paymentId': 'payment-1', 'shopId': 'shop-1'})
+
+    # then
+    assert status == 200
+    assert 'paymentNote' in body
+    assert stores.PAYMENT_LEDGER.get_payment('payment-1').state == PENDING
+
+def test_embedded_payment_links_to_the_approval_form_with_a_token(stores):
+    # given
+    stores.SHOPS.create_or_update_shop(Shop('shop-1', HOSTNAME))
+
+    # when
+    status, body = _request('post', '/embedded-payments', json={'paymentId': 'payment-1', 'shopId': 'shop-1', 'shop': {'name': 'shop'}})
+
+    # then
+    assert status == 200
+    assert 'embedded-payment-approval?' in body and 'token=' in body
+    assert stores.PAYMENT_LEDGER.get_payment('payment-1').shop_id == 'shop-1'
+
+def test_approval_calls_beyond_once_and_records_the_state(stores, monkeypatch):
+    # given
+    stores.APP_INSTALLATIONS.create_or_update_installation(_installation())
+    token = create_payment_token('shop-1', HOSTNAME, 'payment-1', CLIENT_SECRET)
+    approved = []
+
+    async def approve_payment(installation, payment_id):
+        approved.append(payment_id)
+        return 'https://%s/return' % HOSTNAME
+    monkeypatch.setattr(asgi_app.beyond_async, 'approve_payment', approve_payment)
+
+    # when
+    first = _request('post', '/payments/payment-1/approve', form={'token': token})
+    repeated = _request('post', '/payments/payment-1/approve', form={'token': token})
+
+    # then
+    assert first[0] == repeated[0] == 200
+    assert 'Payment approved' in repeated[1]
+    assert 'https://%s/return' % HOSTNAME in repeated[1]
+    assert approved == ['payment-1']
+    assert stores.PAYMENT_LEDGER.get_payment('payment-1').state == APPROVED
+
+def test_approval_with_a_forged_token_is_refused(stores):
+    # given
+    token = create_payment_token('shop-1', HOSTNAME, 'payment-1', 'other-secret')
+
+    # when
+    status, body = _request('post', '/payments/payment-1/approve', form={'token': token})
+
+    # then
+    assert status == 200
+    assert 'Payment failed' in body
+    assert stores.PAYMENT_LEDGER.get_payment('payment-1') is None
+
+def test_requests_for_other_hosts_are_refused(stores):
+    # when
+    status, _ = _request('post', '/payments', json={'paymentId': 'payment-1'}, headers={'Host': 'proxy.example.com'})
+
+    # then
+    assert status >= 400
+    assert stores.PAYMENT_LEDGER.get_payment('payment-1') is None
+
+def test_forged_approvals_cannot_drain_the_rate_limit_of_the_shop_they_name(stores, monkeypatch):
+    # given
+    stores.APP_INSTALLATIONS.create_or_update_installation(_installation())
+    monkeypatch.setattr(asgi_app, 'SHOP_RATE_LIMITS', TokenBuckets(rate=0.001, burst=1))
+    async def approve_payment(installation, payment_id):
+        return 'https://%s/return' % HOSTNAME
+    monkeypatch.setattr(asgi_app.beyond_async, 'approve_payment', approve_payment)
+    stores.SHOPS.create_or_update_shop(Shop('shop-1', HOSTNAME))
+    forged = {'shop_id': 'shop-1', 'signature': 'forged'}
+    signed = {'shop_id': 'shop-1', 'signature': sign('shop-1:payment-1', CLIENT_SECRET)}
+    token = {'token': create_payment_token('shop-1', HOSTNAME, 'payment-2', CLIENT_SECRET)}
+
+    # when
+    forged_statuses = [_request('post', '/payments/payment-1/approve', form=forged)[0] for _ in range(3)]
+    status, body = _request('post', '/payments/payment-1/approve', form=signed)
+    token_status, _ = _request('post', '/payments/payment-2/approve', form=token)
+
+    # then
+    assert forged_statuses == [200, 429, 429]
+    assert status == 200
+    assert 'Payment approved' in body
+    assert token_status == 429
+
+def test_approval_reports_an_unreachable_beyond_as_failed_and_can_be_retried(stores, monkeypatch):
+    # given
+    stores.APP_INSTALLATIONS.create_or_update_installation(_installation())
+    token = create_payment_token('shop-1', HOSTNAME, 'payment-1', CLIENT_SECRET)
+    async def unreachable(installation, payment_id):
+        raise httpx.ConnectError('connection refused')
+    async def approve_payment(installation, payment_id):
+        return 'https://%s/return' % HOSTNAME
+    monkeypatch.setattr(asgi_app.beyond_async, 'approve_payment', unreachable)
+
+    # when
+    failed = _request('post', '/payments/payment-1/approve', form={'token': token})
+    monkeypatch.setattr(asgi_app.beyond_async, 'approve_payment', approve_payment)
+    retried = _request('post', '/payments/payment-1/approve', form={'token': token})
+
+    # then
+    assert failed[0] == 200
+    assert 'Payment failed' in failed[1]
+    assert 'Payment approved' in retried[1]
+
+def test_approval_page_refuses_a_token_issued_for_another_payment_or_shop(stores):
+    # given
+    token = create_payment_token('shop-1', HOSTNAME, 'payment-1', CLIENT_SECRET)
+
+    # when
+    statuses = [_request('get', '/embedded-payment-approval',
+                         query_string={'paymentId': payment_id, 'shopId': shop_id, 'token': token})[0]
+                for payment_id, shop_id in [('payment-1', 'shop-1'), ('payment-2', 'shop-1'), ('payment-1', 'shop-2')]]
+
+    # then
+    assert statuses == [200, 400, 400]
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from caches import TTLCache
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+def test_get_counts_hits_and_misses():
+    # given
+    cache = TTLCache(maxsize=2, ttl=10)
+    cache.set('a', 1)
+
+    # when
+    hit = cache.get('a')
+    miss = cache.get('b')
+
+    # then
+    assert hit == 1
+    assert miss is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+def test_entries_expire_with_their_own_ttl():
+    # given
+    clock = FakeClock()
+    cache = TTLCache(maxsize=2, ttl=10, clock=clock)
+    cache.set('short', 1, ttl=2)
+    cache.set('long', 2)
+
+    # when
+    clock.now = 5
+
+    # then
+    assert cache.get('short') is None
+    assert cache.get('long') == 2
+
+def test_non_positive_ttl_is_not_cached():
+    # given
+    cache = TTLCache(maxsize=2, ttl=10)
+
+    # when
+    cache.set('expired', 1, ttl=-1)
+
+    # then
+    assert cache.get('expired') is None
+
+def test_least_recently_used_entry_is_evicted():
+    # given
+    cache = TTLCache(maxsize=2, ttl=10)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+
+    # when
+    cache.set('c', 3)
+
+    # then
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from circuit_breakers import CircuitBreaker, CircuitBreakers, HostUnavailable, CLOSED, OPEN, HALF_OPEN
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class Response(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+def _breakers(clock, **kwargs):
+    return CircuitBreakers(lambda hostname: CircuitBreaker(hostname, window=4, min_calls=4, open_seconds=10, clock=clock, **kwargs))
+
+def test_failing_host_fails_fast_until_a_probe_succeeds():
+    # given
+    clock = Clock()
+    breakers = _breakers(clock)
+    for _ in range(4):
+        breakers.call('bad.example.com', lambda: Response(503))
+
+    # when
+    with pytest.raises(HostUnavailable) as error:
+        breakers.call('bad.example.com', lambda: Response(200))
+    other = breakers.call('good.example.com', lambda: Response(200))
+    clock.now = 11
+    probe = breakers.call('bad.example.com', lambda: Response(200))
+
+    # then
+    assert error.value.reason == 'circuit open'
+    assert other.status_code == 200
+    assert probe.status_code == 200
+    assert breakers.state('bad.example.com') == CLOSED
+
+def test_failed_probe_opens_the_breaker_again():
+    # given
+    clock = Clock()
+    breaker = CircuitBreaker(window=4, min_calls=2, open_seconds=10, clock=clock)
+    for _ in range(2):
+        breaker.record(breaker.allow(), True, 0.1)
+    clock.now = 11
+
+    # when
+    probe = breaker.allow()
+    concurrent = breaker.allow()
+    breaker.record(probe, True, 0.1)
+
+    # then
+    assert probe == HALF_OPEN
+    assert concurrent is None
+    assert breaker.state == OPEN
+    assert breaker.allow() is None
+
+def test_slow_calls_open_the_breaker():
+    # given
+    breaker = CircuitBreaker(window=4, min_calls=4, slow_call_seconds=1, slow_call_rate=0.5)
+
+    # when
+    for seconds in (0.1, 2, 0.1, 3):
+        breaker.record(breaker.allow(), False, seconds)
+
+    # then
+    assert breaker.state == OPEN
+
+def test_bulkhead_limits_calls_in_flight_per_host():
+    # given
+    breakers = CircuitBreakers(bulkhead_size=2)
+    breakers.acquire('slow.example.com')
+    admitted = breakers.acquire('slow.example.com')
+
+    # when
+    with pytest.raises(HostUnavailable) as error:
+        breakers.acquire('slow.example.com')
+    breakers.acquire('other.example.com')
+    breakers.release('slow.example.com', admitted, False, 0.1)
+
+    # then
+    assert error.value.reason == 'too many calls in flight'
+    assert breakers.acquire('slow.example.com') == CLOSED
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import psycopg2
+import pytest
+
+import db
+from db import ConnectionPool, PoolTimeout
+
+class FakeConnection(object):
+    def __init__(self, healthy=True):
+        self.closed = 0
+        self.healthy = healthy
+        self.commits = 0
+        self.rollbacks = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        if error_type is None:
+            self.commits += 1
+        else:
+            self.rollbacks += 1
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        self.rollbacks += 1
+
+class FakeCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params=None):
+        if not self.conn.healthy:
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+
+class FakeThreadedConnectionPool(object):
+    """Stands in for psycopg2.pool.ThreadedConnectionPool, handing out the given connections first
+    """
+    def __init__(self, connections):
+        self.connections = list(connections)
+        self.returned = []
+
+    def getconn(self):
+        return self.connections.pop(0) if self.connections else FakeConnection()
+
+    def putconn(self, conn, close=False):
+        self.returned.append((conn, close))
+
+    def closeall(self):
+        pass
+
+def _pool(monkeypatch, connections=(), **kwargs):
+    fake = FakeThreadedConnectionPool(connections)
+    monkeypatch.setattr(db.pg_pool, 'ThreadedConnectionPool', lambda min_size, max_size, database_url: fake)
+    return ConnectionPool('postgresql://test', **kwargs), fake
+
+def test_connection_is_committed_and_returned(monkeypatch):
+    # given
+    conn = FakeConnection()
+    pool, fake = _pool(monkeypatch, [conn])
+
+    # when
+    with pool.connection() as borrowed:
+        pass
+
+    # then
+    assert borrowed is conn
+    assert conn.commits == 1
+    assert fake.returned == [(conn, False)]
+
+def test_recently_used_connection_is_not_pinged(monkeypatch):
+    # given
+    conn = FakeConnection()
+    pool, fake = _pool(monkeypatch, [conn])
+    with pool.connection():
+        pass
+
+    # when
+    conn.healthy = False
+    fake.connections.append(conn)
+    with pool.connection() as borrowed:
+        pass
+
+    # then
+    assert borrowed is conn
+
+def test_broken_connection_is_discarded(monkeypatch):
+    # given
+    conn = FakeConnection()
+    pool, fake = _pool(monkeypatch, [conn])
+
+    # when
+    with pytest.raises(psycopg2.OperationalError):
+        with pool.connection():
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+
+    # then
+    assert conn.commits == 0
+    assert fake.returned == [(conn, True)]
+
+def test_unhealthy_connection_is_replaced_at_checkout(monkeypatch):
+    # given
+    broken = FakeConnection(healthy=False)
+    healthy = FakeConnection()
+    pool, fake = _pool(monkeypatch, [broken, healthy])
+
+    # when
+    with pool.connection() as borrowed:
+        pass
+
+    # then
+    assert borrowed is healthy
+    assert fake.returned == [(broken, True), (healthy, False)]
+
+def test_waiting_for_a_connection_times_out(monkeypatch):
+    # given
+    pool, fake = _pool(monkeypatch, max_size=1, timeout=0.05)
+
+    # when
+    with pool.connection():
+        with pytest.raises(PoolTimeout):
+            with pool.connection():
+                pass
+
+    # then
+    with pool.connection():
+        assert len(fake.returned) == 1
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import gzip
+
+from http_cache import IMMUTABLE, PrecomputedResponse, StaticAssets, choose_encoding
+
+def test_matching_etag_is_answered_with_not_modified():
+    # given
+    response = PrecomputedResponse.json({'ready': True})
+    body, status, headers = response.parts({})
+    etag = dict(headers)['ETag']
+
+    # when
+    revalidated_body, revalidated_status, _ = response.parts({'If-None-Match': 'W/%s' % etag})
+
+    # then
+    assert (body, status) == (b'{"ready":true}', 200)
+    assert (revalidated_body, revalidated_status) == (b'', 304)
+
+def test_error_responses_are_not_conditional():
+    # given
+    response = PrecomputedResponse.html('<h1>Not found</h1>', status=404)
+
+    # when
+    body, status, headers = response.parts({'If-None-Match': '*'})
+
+    # then
+    assert (body, status) == (b'<h1>Not found</h1>', 404)
+    assert 'ETag' not in dict(headers)
+
+def test_compressed_variant_is_served_to_clients_accepting_it():
+    # given
+    response = PrecomputedResponse(b'body { margin: 0; }\n' * 100, 'text/css', compress=True)
+
+    # when
+    body, _, headers = response.parts({'Accept-Encoding': 'deflate, gzip;q=0.5'})
+    plain_body, _, plain_headers = response.parts({'Accept-Encoding': 'gzip;q=0'})
+    headers, plain_headers = dict(headers), dict(plain_headers)
+
+    # then
+    assert headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(body) == plain_body
+    assert 'Content-Encoding' not in plain_headers
+    assert headers['ETag'] != plain_headers['ETag']
+
+def test_identity_is_chosen_without_smaller_variants():
+    assert choose_encoding('gzip, br', {'identity': b'x'}) == 'identity'
+    assert choose_encoding('*', {'identity': b'xxxx', 'gzip': b'xx'}) == 'gzip'
+
+def test_static_files_are_linked_by_content_hash(tmpdir):
+    # given
+    tmpdir.join('site.css').write('body { margin: 0; }')
+    assets = StaticAssets(str(tmpdir))
+
+    # when
+    hashed_filename = assets.url_filename('site.css')
+    tmpdir.join('site.css').write('body { margin: 1px; }')
+    changed_filename = StaticAssets(str(tmpdir)).url_filename('site.css')
+
+    # then
+    assert hashed_filename.startswith('site.') and hashed_filename.endswith('.css')
+    assert hashed_filename != changed_filename
+    assert assets.get(hashed_filename).cache_control == IMMUTABLE
+    assert assets.get('site.css').cache_control != IMMUTABLE
+    assert assets.get('other.css') is None
+    assert assets.url_filename('other.css') == 'other.css'
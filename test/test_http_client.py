@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from urllib3.util.retry import RequestHistory
+
+import http_client
+from http_client import encode_json, hal_headers
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """Answers 503 to the first failures requests, 200 after that
+    """
+    failures = 0
+    hits = []
+
+    def _respond(self):
+        self.hits.append(self.command)
+        status = 503 if len(self.hits) <= self.failures else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    do_GET = _respond
+    do_POST = _respond
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def flaky_server(monkeypatch):
+    monkeypatch.setattr(http_client, '_session', None)
+    monkeypatch.setattr(http_client, 'HTTP_BACKOFF_FACTOR', 0)
+    FlakyHandler.hits = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FlakyHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:%i' % server.server_port
+    server.shutdown()
+    server.server_close()
+    monkeypatch.setattr(http_client, '_session', None)
+
+def test_caller_headers_are_merged_into_the_hal_headers():
+    # when
+    kwargs = encode_json('access-token', {'json': {'a': 1}, 'headers': {'X-Request-Id': 'r1', 'Accept': 'application/json'}})
+
+    # then
+    assert kwargs['data'] == b'{"a":1}'
+    assert kwargs['headers'] == {
+        'Accept': 'application/json',
+        'Authorization': 'Bearer access-token',
+        'Content-Type': 'application/json',
+        'X-Request-Id': 'r1'
+    }
+    assert hal_headers('access-token', 'application/json')['Accept'] == http_client.HAL_JSON
+
+def test_requests_without_token_only_get_the_content_type():
+    # then
+    assert encode_json(None, {'json': [], 'headers': {'X-Request-Id': 'r1'}})['headers'] == {'Content-Type': 'application/json', 'X-Request-Id': 'r1'}
+    assert 'headers' not in encode_json(None, {'data': {'grant_type': 'client_credentials'}})
+
+def test_requests_get_default_timeouts_and_headers(monkeypatch):
+    # given
+    sent = []
+    class RecordingSession(object):
+        def request(self, method, url, **kwargs):
+            sent.append(kwargs)
+            return type('Response', (), {'status_code': 200})()
+    monkeypatch.setattr(http_client, 'session', RecordingSession)
+
+    # when
+    http_client.get('https://shop.example.com/api/shop', access_token='access-token')
+
+    # then
+    assert sent[0]['timeout'] == (http_client.HTTP_CONNECT_TIMEOUT, http_client.HTTP_READ_TIMEOUT)
+    assert sent[0]['headers'] == {'Accept': http_client.HAL_JSON, 'Authorization': 'Bearer access-token'}
+
+def test_idempotent_requests_are_retried_on_unavailable(flaky_server):
+    # given
+    FlakyHandler.failures = http_client.HTTP_MAX_RETRIES
+
+    # when
+    response = http_client.get(flaky_server + '/shop')
+
+    # then
+    assert response.status_code == 200
+    assert FlakyHandler.hits == ['GET'] * (http_client.HTTP_MAX_RETRIES + 1)
+
+def test_posts_that_reached_the_server_are_not_retried(flaky_server):
+    # given
+    FlakyHandler.failures = 1
+
+    # when
+    response = http_client.post(flaky_server + '/payments/p1/approve')
+
+    # then
+    assert response.status_code == 503
+    assert FlakyHandler.hits == ['POST']
+
+def test_retries_back_off_exponentially():
+    # given
+    retry = http_client._retry()
+    failure = RequestHistory('GET', '/shop', None, 503, None)
+
+    # when
+    backoffs = [retry.new(history=(failure,) * attempts).get_backoff_time() for attempts in (2, 3)]
+
+    # then
+    assert backoffs == [http_client.HTTP_BACKOFF_FACTOR * 2, http_client.HTTP_BACKOFF_FACTOR * 4]
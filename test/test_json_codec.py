@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import glob
+import json
+
+import pytest
+from flask import Flask, jsonify
+
+import json_codec
+
+CODECS = [json_codec.StdlibCodec()] + ([json_codec.OrjsonCodec()] if json_codec.orjson is not None else [])
+
+@pytest.mark.parametrize('codec', CODECS, ids=lambda codec: codec.name)
+def test_payment_method_definitions_survive_a_round_trip(codec):
+    for path in glob.glob('test/*.json'):
+        # given
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        # when
+        payload = codec.loads(data)
+
+        # then
+        assert payload == json.loads(data)
+        assert json.loads(codec.dumps(payload)) == payload
+
+@pytest.mark.parametrize('codec', CODECS, ids=lambda codec: codec.name)
+def test_what_orjson_rejects_goes_through_the_standard_library(codec):
+    assert codec.dumps({'big': 2 ** 70}) == b'{"big":1180591620717411303424}'
+    assert codec.dumps({1: 'a'}) == b'{"1":"a"}'
+    assert codec.loads('{"big": 1180591620717411303424}') == {'big': 2 ** 70}
+    with pytest.raises(ValueError):
+        codec.loads(b'{"invalid"')
+
+def test_flask_responses_keep_their_format():
+    # given
+    app = Flask(__name__)
+    json_codec.init_app(app)
+
+    # when
+    with app.app_context():
+        body = jsonify({'b': 1, 'a': datetime.datetime(2020, 1, 1)}).get_data()
+
+    # then
+    assert body == b'{"a":"Wed, 01 Jan 2020 00:00:00 GMT","b":1}\n'
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from load_shedding import LoadShedder, parse_request_start
+
+def test_requests_beyond_the_in_flight_limit_are_shed():
+    # given
+    shedder = LoadShedder(max_in_flight=2, max_queue_seconds=0)
+    shedder.try_enter()
+    shedder.try_enter()
+
+    # when
+    shed = shedder.try_enter()
+    shedder.leave()
+    admitted = shedder.try_enter()
+
+    # then
+    assert shed == 'in_flight'
+    assert admitted is None
+    assert shedder.in_flight == 2
+
+def test_requests_queued_for_too_long_are_shed():
+    # given
+    shedder = LoadShedder(max_in_flight=0, max_queue_seconds=5, clock=lambda: 1700000000.0)
+
+    # when
+    late = shedder.try_enter('1699999990000')
+    on_time = shedder.try_enter('t=1699999998.5')
+
+    # then
+    assert late == 'queue_time'
+    assert on_time is None
+    assert shedder.in_flight == 1
+
+def test_request_start_is_read_in_any_unit():
+    assert parse_request_start('1700000000123') == 1700000000.123
+    assert parse_request_start('t=1700000000123456') == 1700000000.123456
+    assert parse_request_start('t=1700000000.5') == 1700000000.5
+    assert parse_request_start('soon') is None
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+
+from logs import JsonFormatter, SamplingFilter, redact
+
+def _record(name, level, msg, fields=None):
+    record = logging.LogRecord(name, level, __file__, 1, msg, None, None)
+    record.fields = fields or {}
+    return record
+
+def test_redact_free_text_secrets():
+    # when
+    redacted = redact("Token response: {'access_token': 'abc.def', 'expires_in': 3600} Bearer xyz")
+
+    # then
+    assert 'abc.def' not in redacted
+    assert 'xyz' not in redacted
+    assert "'expires_in': 3600" in redacted
+
+def test_formatter_redacts_sensitive_fields():
+    # given
+    record = _record('app', logging.INFO, 'Validated signature',
+                     {'signature': 'c2lnbmF0dXJl', 'status_code': 200, 'payment_id': 'p-1'})
+
+    # when
+    entry = json.loads(JsonFormatter().format(record))
+
+    # then
+    assert entry['signature'] == '[REDACTED]'
+    assert entry['status_code'] == 200
+    assert entry['payment_id'] == 'p-1'
+    assert entry['category'] == 'app'
+
+def test_sampling_keeps_warnings():
+    # given
+    sampling = SamplingFilter({'app.requests': 0.0})
+
+    # then
+    assert not sampling.filter(_record('app.requests', logging.INFO, 'Approving payment'))
+    assert sampling.filter(_record('app.requests', logging.WARNING, 'Approving payment failed'))
+    assert sampling.filter(_record('app', logging.INFO, 'Initialize'))
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from metrics import Counter, Histogram, merge, render
+
+def test_merge_sums_snapshots_of_all_processes():
+    # given
+    worker_1 = Histogram('request_seconds', 'Request duration', ['route'], buckets=(0.1, 1.0))
+    worker_2 = Histogram('request_seconds', 'Request duration', ['route'], buckets=(0.1, 1.0))
+    worker_1.observe(0.05, route='/payments')
+    worker_2.observe(0.5, route='/payments')
+    worker_2.observe(5, route='/payments')
+
+    # when
+    merged = merge([{'request_seconds': worker_1.snapshot()}, {'request_seconds': worker_2.snapshot()}])
+
+    # then
+    buckets, total, count = merged['request_seconds']['samples'][('/payments',)]
+    assert buckets == [1, 1, 1]
+    assert total == 5.55
+    assert count == 3
+
+def test_render_prometheus_text_format():
+    # given
+    requests = Counter('requests_total', 'Requests', ['status'])
+    requests.inc(status=200)
+    requests.inc(2, status=200)
+    seconds = Histogram('request_seconds', 'Request duration', [], buckets=(0.1, 1.0))
+    seconds.observe(0.5)
+
+    # when
+    text = render(merge([{'requests_total': requests.snapshot(), 'request_seconds': seconds.snapshot()}]))
+
+    # then
+    assert '# TYPE requests_total counter\nrequests_total{status="200"} 3\n' in text
+    assert 'request_seconds_bucket{le="0.1"} 0\n' in text
+    assert 'request_seconds_bucket{le="1.0"} 1\n' in text
+    assert 'request_seconds_bucket{le="+Inf"} 1\n' in text
+    assert 'request_seconds_count 1\n' in text
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from migrations import MIGRATIONS, latest_version
+
+def test_versions_are_unique_and_ascending():
+    # given
+    versions = [version for version, _, _ in MIGRATIONS]
+
+    # then
+    assert versions == sorted(set(versions))
+    assert latest_version() == versions[-1]
+
+def test_importing_the_app_does_not_touch_the_database(monkeypatch):
+    # given
+    monkeypatch.setenv('DATABASE_URL', 'postgresql://nobody@unreachable.invalid/nothing')
+
+    # when
+    import app
+
+    # then
+    assert app.APP_INSTALLATIONS is None
+    assert not app._initialized
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from payment_ledger import PaymentLedger, PENDING, APPROVED, CAPTURED
+
+class RecordingLedger(PaymentLedger):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.batches = []
+        self.failures = 0
+        self.release = threading.Event()
+        self.release.set()
+
+    def _write(self, payments):
+        self.release.wait(5)
+        if self.failures:
+            self.failures -= 1
+            raise IOError('database unavailable')
+        self.batches.append([payment.payment_id for payment in payments])
+        super()._write(payments)
+
+def test_changes_are_written_in_batches():
+    # given
+    ledger = RecordingLedger(batch_size=3, flush_interval=60)
+
+    # when
+    for i in range(7):
+        ledger.record('payment-%i' % i, PENDING, 'shop-id')
+    assert ledger.flush(timeout=5)
+    ledger.close()
+
+    # then
+    assert [len(batch) for batch in ledger.batches] == [3, 3, 1]
+    assert ledger.payments['payment-6'].state == PENDING
+
+def test_lookups_see_unwritten_changes():
+    # given
+    ledger = RecordingLedger(batch_size=100, flush_interval=60)
+    ledger.release.clear()
+
+    # when
+    ledger.record('payment-1', PENDING, 'shop-id')
+    ledger.record('payment-1', APPROVED)
+    payment = ledger.get_payment('payment-1')
+
+    # then
+    assert ledger.payments == {}
+    assert payment.state == APPROVED
+    assert payment.shop_id == 'shop-id'
+    ledger.release.set()
+    ledger.close()
+    assert ledger.get_payment('payment-1').state == APPROVED
+    assert ledger.batches == [['payment-1']]
+
+def test_failed_writes_are_retried_and_flushed_on_close():
+    # given
+    ledger = RecordingLedger(batch_size=10, flush_interval=0.01)
+    ledger.failures = 2
+
+    # when
+    ledger.record('payment-1', CAPTURED)
+    ledger.close()
+
+    # then
+    assert ledger.failures == 0
+    assert ledger.get_payment('payment-1').state == CAPTURED
+
+def test_recording_into_a_full_buffer_gives_up_after_the_timeout():
+    # given
+    ledger = RecordingLedger(batch_size=10, flush_interval=0.01, queue_size=1, record_timeout=0.1)
+    ledger.failures = 1000
+    ledger.record('payment-1', PENDING)
+
+    # when
+    started = time.monotonic()
+    ledger.record('payment-2', PENDING)
+    waited = time.monotonic() - started
+
+    # then
+    assert 0.1 <= waited < 2
+    assert ledger.get_payment('payment-2') is None
+    ledger.failures = 0
+    ledger.close()
+    assert ledger.get_payment('payment-1').state == PENDING
@@ -4,7 +4,12 @@
 import json
 import os
 
-from payment_method_definitions import read_json_file, system_token, get_payment_method_definitions
+import pytest
+
+import http_client
+import payment_method_definitions
+from payment_method_definitions import read_json_file, system_token, get_payment_method_definitions, \
+    get_payment_method_definition_catalog, PaymentMethodDefinitionCatalog
 
 CLIENT_ID = os.environ.get('CLIENT_ID', '')
 CLIENT_SECRET = os.environ.get('CLIENT_SECRET', '')
@@ -41,11 +46,12 @@ def test_get_payment_method_definitions():
     _compare_to_expected_payment_method_definitions(payment_method_definitions)
 
 def _compare_to_expected_payment_method_definitions(payment_method_definitions):
-    beautiful_test_payment = [pmd for pmd in payment_method_definitions if pmd.get('_id', '') == 'beautiful-test-payment'][0]
-    beautiful_test_payment_sandbox = [pmd for pmd in payment_method_definitions if pmd.get('_id', '') == 'beautiful-test-payment-sandbox'][0]
-    beautiful_test_payment_embedded = [pmd for pmd in payment_method_definitions if pmd.get('_id', '') == 'beautiful-test-payment-embedded'][0]
-    beautiful_test_payment_embedded_on_selection = [pmd for pmd in payment_method_definitions if pmd.get('_id', '') == 'beautiful-test-payment-embedded-selection'][0]
-    beautiful_test_payment_capture_on_demand = [pmd for pmd in payment_method_definitions if pmd.get('_id', '') == 'beautiful-test-payment-capture-on-demand'][0]
+    catalog = PaymentMethodDefinitionCatalog(payment_method_definitions)
+    beautiful_test_payment = catalog['beautiful-test-payment']
+    beautiful_test_payment_sandbox = catalog['beautiful-test-payment-sandbox']
+    beautiful_test_payment_embedded = catalog['beautiful-test-payment-embedded']
+    beautiful_test_payment_embedded_on_selection = catalog['beautiful-test-payment-embedded-selection']
+    beautiful_test_payment_capture_on_demand = catalog['beautiful-test-payment-capture-on-demand']
 
     expected_pmd = read_json_file('test/beautiful-test-payment.json')
     expected_pmd_sandbox = read_json_file('test/beautiful-test-payment-sandbox.json')
@@ -58,3 +64,72 @@ def _compare_to_expected_payment_method_definitions(payment_method_definitions):
     assert expected_pmd_embedded == beautiful_test_payment_embedded
     assert expected_pmd_embedded_on_selection == beautiful_test_payment_embedded_on_selection
     assert expected_pmd_capture_on_demand == beautiful_test_payment_capture_on_demand
+
+class FakeResponse(object):
+    def __init__(self, status_code, payload=None, headers=None):
+        self.status_code = status_code
+        self.payload = payload
+        self.content = json.dumps(payload).encode('utf-8')
+        self.headers = headers or {}
+
+    def json(self):
+        return self.payload
+
+@pytest.fixture
+def fresh_caches():
+    payment_method_definitions._system_tokens.clear()
+    payment_method_definitions.invalidate_payment_method_definitions()
+    yield
+    payment_method_definitions._system_tokens.clear()
+    payment_method_definitions.invalidate_payment_method_definitions()
+
+def test_system_token_is_reused_until_it_expires(fresh_caches, monkeypatch):
+    # given
+    calls = []
+    def post(url, **kwargs):
+        calls.append(url)
+        return FakeResponse(200, {'access_token': 'token-%i' % len(calls), 'expires_in': 3600})
+    monkeypatch.setattr(http_client, 'post', post)
+
+    # when
+    tokens = [system_token('client-id', 'client-secret') for _ in range(3)]
+
+    # then
+    assert tokens == ['token-1'] * 3
+    assert len(calls) == 1
+
+def test_catalog_is_revalidated_with_etag(fresh_caches, monkeypatch):
+    # given
+    definition = read_json_file('test/beautiful-test-payment.json')
+    requests_headers = []
+    def get(url, headers=None, **kwargs):
+        requests_headers.append(headers)
+        if headers.get('If-None-Match') == '"v1"':
+            return FakeResponse(304)
+        return FakeResponse(200, {'_embedded': {'payment-method-definitions': [definition]}}, {'ETag': '"v1"'})
+    monkeypatch.setattr(http_client, 'get', get)
+
+    # when
+    first = get_payment_method_definition_catalog('system-token')
+    cached = get_payment_method_definition_catalog('system-token')
+    monkeypatch.setattr(payment_method_definitions, 'PAYMENT_METHOD_DEFINITION_CACHE_TTL', 0)
+    payment_method_definitions.invalidate_payment_method_definitions()
+    get_payment_method_definition_catalog('system-token')
+    stale = get_payment_method_definition_catalog('system-token')
+
+    # then
+    assert first is cached
+    assert stale['beautiful-test-payment'] == definition
+    assert [headers.get('If-None-Match') for headers in requests_headers] == [None, None, '"v1"']
+
+def test_catalog_looks_up_definitions_by_id_and_name():
+    # given
+    definition = read_json_file('test/beautiful-test-payment-embedded-on-selection.json')
+
+    # when
+    catalog = PaymentMethodDefinitionCatalog([definition])
+
+    # then
+    assert catalog['beautiful-test-payment-embedded-selection'] is definition
+    assert catalog.get(definition['name']) is definition
+    assert 'unknown' not in catalog
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from contextlib import contextmanager
+
+import pytest
+
+from payment_results import PaymentResult, PaymentResults, PostgresPaymentResults
+
+def test_concurrent_duplicates_share_one_call():
+    # given
+    results = PaymentResults()
+    calls = []
+    def approve():
+        calls.append(1)
+        time.sleep(0.2)
+        return PaymentResult('payment-1', 'approve', 'APPROVED', 'https://shop.example.com/return')
+
+    # when
+    outcomes = []
+    threads = [threading.Thread(target=lambda: outcomes.append(results.complete('payment-1', 'approve', approve))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+    repeated = results.complete('payment-1', 'approve', approve)
+
+    # then
+    assert len(calls) == 1
+    assert [outcome.return_uri for outcome in outcomes] == ['https://shop.example.com/return'] * 5
+    assert repeated is outcomes[0]
+
+def test_results_are_kept_per_action():
+    # given
+    results = PaymentResults()
+    results.complete('payment-1', 'approve', lambda: PaymentResult('payment-1', 'approve', 'APPROVED', 'https://a'))
+
+    # when
+    canceled = results.complete('payment-1', 'cancel', lambda: PaymentResult('payment-1', 'cancel', 'CANCELED', 'https://c'))
+
+    # then
+    assert canceled.state == 'CANCELED'
+    assert results.find('payment-1', 'approve').state == 'APPROVED'
+
+def test_uncompleted_results_and_errors_are_not_kept():
+    # given
+    results = PaymentResults()
+    def fail():
+        raise IOError('Beyond unavailable')
+
+    # when
+    with pytest.raises(IOError):
+        results.complete('payment-1', 'approve', fail)
+    results.complete('payment-1', 'approve', lambda: PaymentResult('payment-1', 'approve', 'APPROVED', completed=False))
+    retried = results.complete('payment-1', 'approve', lambda: PaymentResult('payment-1', 'approve', 'APPROVED', 'https://a'))
+
+    # then
+    assert retried.return_uri == 'https://a'
+    assert results.cached('payment-1', 'approve') is retried
+
+def test_a_leased_payment_is_not_claimed_twice():
+    # given
+    results = PaymentResults()
+    first = results.try_claim('payment-1', 'approve')
+
+    # when
+    busy = results.try_claim('payment-1', 'approve')
+    first.finish(PaymentResult('payment-1', 'approve', 'APPROVED', 'https://a'))
+    second = results.try_claim('payment-1', 'approve')
+
+    # then
+    assert first.lease_id is not None
+    assert busy is None
+    assert second.lease_id is None
+    assert second.result.return_uri == 'https://a'
+
+def test_an_expired_lease_is_taken_over_and_not_released_by_its_old_holder():
+    # given
+    results = PaymentResults(lease=0.05)
+    stale = results.try_claim('payment-1', 'approve')
+    time.sleep(0.1)
+
+    # when
+    taken_over = results.try_claim('payment-1', 'approve')
+    stale.release()
+
+    # then
+    assert taken_over is not None and taken_over.lease_id is not None
+    assert results.try_claim('payment-1', 'approve') is None
+
+class LeaseRowPool(object):
+    """Answers the lease INSERT with a row, counts the connections borrowed
+    """
+    def __init__(self):
+        self.borrowed = 0
+        self.statements = []
+
+    @contextmanager
+    def connection(self):
+        self.borrowed += 1
+        try:
+            yield self
+        finally:
+            self.borrowed -= 1
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params):
+        self.statements.append(sql.split()[0])
+
+    def fetchone(self):
+        return ('lease',)
+
+def test_no_connection_is_held_while_completing():
+    # given
+    pool = LeaseRowPool()
+    results = PostgresPaymentResults('postgres://unused', pool=pool)
+    borrowed = []
+    def approve():
+        borrowed.append(pool.borrowed)
+        return PaymentResult('payment-1', 'approve', 'APPROVED', 'https://a')
+
+    # when
+    results.complete('payment-1', 'approve', approve)
+
+    # then
+    assert borrowed == [0]
+    assert pool.statements == ['INSERT', 'INSERT']
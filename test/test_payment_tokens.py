@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from payment_tokens import create_payment_token, read_payment_token, verify_payment_token
+
+def test_verify_payment_token_resolves_shop():
+    # given
+    token = create_payment_token('shop-1', 'shop.example.com', 'payment-1', 'secret')
+
+    # when
+    payment_token = verify_payment_token(token, 'payment-1', 'secret')
+
+    # then
+    assert payment_token.shop_id == 'shop-1'
+    assert payment_token.hostname == 'shop.example.com'
+
+def test_verify_payment_token_rejects_other_payment():
+    # given
+    token = create_payment_token('shop-1', 'shop.example.com', 'payment-1', 'secret')
+
+    # then
+    assert verify_payment_token(token, 'payment-2', 'secret') is None
+    assert verify_payment_token(token, 'payment-1', 'other-secret') is None
+
+def test_verify_payment_token_rejects_expired_token():
+    # given
+    token = create_payment_token('shop-1', 'shop.example.com', 'payment-1', 'secret', ttl=-1)
+
+    # then
+    assert verify_payment_token(token, 'payment-1', 'secret') is None
+
+def test_read_payment_token_accepts_any_payment():
+    # given
+    token = create_payment_token('shop-1', 'shop.example.com', 'payment-1', 'secret')
+
+    # when
+    payment_token = read_payment_token(token, 'secret')
+
+    # then
+    assert payment_token.payment_id == 'payment-1'
+    assert read_payment_token(token, 'other-secret') is None
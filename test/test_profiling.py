@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import sys
+
+from flask import Flask
+
+import profiling
+from profiling import RequestProfiler
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _app():
+    app = Flask(__name__)
+
+    @app.route('/payments/<payment_id>/approve', methods=['POST'])
+    def approve(payment_id):
+        return payment_id
+
+    @app.route('/')
+    def root():
+        return 'root'
+    return app
+
+def test_profiles_matching_requests_until_count_is_reached(tmp_path, monkeypatch):
+    # given
+    monkeypatch.setattr(profiling, 'PROFILER_DIR', str(tmp_path))
+    app = _app()
+    original = app.wsgi_app
+    profiler = app.wsgi_app = RequestProfiler(app, '/payments/<payment_id>/approve', 2, 60)
+    client = app.test_client()
+
+    # when
+    client.get('/')
+    responses = [client.post('/payments/p%i/approve' % i).data for i in range(3)]
+
+    # then
+    assert responses == [b'p0', b'p1', b'p2']
+    assert len(profiler.written) == 2
+    assert all(os.path.exists(path) for path in profiler.written)
+    assert app.wsgi_app == original
+
+def test_disarms_after_deadline(tmp_path, monkeypatch):
+    # given
+    monkeypatch.setattr(profiling, 'PROFILER_DIR', str(tmp_path))
+    app = _app()
+    original = app.wsgi_app
+    profiler = app.wsgi_app = RequestProfiler(app, '/payments/<payment_id>/approve', 10, -1)
+
+    # when
+    response = app.test_client().post('/payments/p1/approve')
+
+    # then
+    assert response.data == b'p1'
+    assert profiler.written == []
+    assert app.wsgi_app == original
+
+def test_profiler_routes_work_when_serving_the_lazily_initialized_app(tmp_path):
+    # given
+    script = '\n'.join([
+        'import app',
+        'client = app.app.test_client()',
+        'for _ in range(2):',
+        '    print("status", client.get("/_profiler", base_url="http://localhost:8080", headers={"Authorization": "Bearer secret"}).status_code)'
+    ])
+    env = dict(os.environ, PROFILER_TOKEN='secret', PROFILER_DIR=str(tmp_path),
+               DATABASE_URL='postgresql://nobody@unreachable.invalid/nothing')
+
+    # when
+    result = subprocess.run([sys.executable, '-c', script], cwd=ROOT, env=env, capture_output=True, text=True, timeout=60)
+
+    # then
+    statuses = [line.split()[1] for line in result.stdout.splitlines() if line.startswith('status ')]
+    assert statuses == ['200', '200'], result.stdout + result.stderr
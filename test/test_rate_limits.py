@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from rate_limits import KeyedRateLimiter, RateLimiter, TokenBucket, TokenBuckets
+
+def test_rate_limiter_spaces_out_calls():
+    # given
+    now = [100.0]
+    waits = []
+    limiter = RateLimiter(4, clock=lambda: now[0], sleep=waits.append)
+
+    # when
+    for _ in range(3):
+        limiter.acquire()
+
+    # then
+    assert waits == [0.25, 0.5]
+
+def test_keyed_rate_limiter_limits_each_key_separately():
+    # given
+    now = [100.0]
+    waits = []
+    limiter = KeyedRateLimiter(2, clock=lambda: now[0], sleep=waits.append)
+
+    # when
+    for key in ['a.example.com', 'b.example.com', 'a.example.com']:
+        limiter.acquire(key)
+
+    # then
+    assert waits == [0.5]
+
+def test_token_bucket_admits_bursts_then_tells_when_to_retry():
+    # given
+    now = [100.0]
+    bucket = TokenBucket(2, 3, clock=lambda: now[0])
+
+    # when
+    burst = [bucket.try_acquire() for _ in range(4)]
+    now[0] += 0.5
+    refilled = bucket.try_acquire()
+
+    # then
+    assert burst == [0.0, 0.0, 0.0, 0.5]
+    assert refilled == 0.0
+
+def test_token_buckets_limit_each_key_and_keep_the_most_recent():
+    # given
+    now = [100.0]
+    buckets = TokenBuckets(1, 1, maxsize=2, clock=lambda: now[0])
+    buckets.try_acquire('shop-a')
+
+    # when
+    limited = buckets.try_acquire('shop-a')
+    other = buckets.try_acquire('shop-b')
+    buckets.try_acquire('shop-c')
+    forgotten = buckets.try_acquire('shop-a')
+
+    # then
+    assert limited == 1.0
+    assert other == 0.0
+    assert forgotten == 0.0
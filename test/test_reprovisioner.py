@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from app_installations import AppInstallations, Installation
+from provisioning import PostgresProvisionedPaymentMethods, ProvisionedPaymentMethods
+import reprovisioner
+from reprovisioner import Reprovisioner
+
+DEFINITIONS = ['beautiful-test-payment-embedded', 'beautiful-test-payment-capture-on-demand']
+
+def _installations(count):
+    installations = AppInstallations('client-id', 'client-secret')
+    for i in range(count):
+        installations.create_or_update_installation(Installation(api_url='https://shop-%i.example.com/api' % i,
+                                                                 access_token='access-token',
+                                                                 refresh_token='refresh-token',
+                                                                 expiry_date=datetime.now() + timedelta(hours=1)))
+    return installations
+
+def test_creates_only_missing_payment_methods(monkeypatch):
+    # given
+    provisioned = ProvisionedPaymentMethods(_installations(3))
+    provisioned.record('shop-0.example.com', DEFINITIONS)
+    provisioned.record('shop-1.example.com', DEFINITIONS[:1])
+    created = []
+    monkeypatch.setattr(reprovisioner, 'get_payment_method_definitions_in_use', lambda installation: set())
+    monkeypatch.setattr(reprovisioner, 'create_payment_method', lambda installation, name: created.append((installation.hostname, name)) or 200)
+
+    # when
+    summary = Reprovisioner(provisioned.app_installations, provisioned, DEFINITIONS, concurrency=4, host_rate_limit=0, checkpoint_size=2).run()
+
+    # then
+    assert sorted(created) == [
+        ('shop-1.example.com', 'beautiful-test-payment-capture-on-demand'),
+        ('shop-2.example.com', 'beautiful-test-payment-capture-on-demand'),
+        ('shop-2.example.com', 'beautiful-test-payment-embedded')
+    ]
+    assert summary['created'] == 3
+    assert list(provisioned.iter_missing(DEFINITIONS)) == []
+
+def test_failed_payment_methods_are_retried_on_the_next_run(monkeypatch):
+    # given
+    provisioned = ProvisionedPaymentMethods(_installations(2), retry_backoff=0)
+    monkeypatch.setattr(reprovisioner, 'get_payment_method_definitions_in_use', lambda installation: set())
+    monkeypatch.setattr(reprovisioner, 'create_payment_method',
+                        lambda installation, name: 503 if installation.hostname == 'shop-1.example.com' else 200)
+
+    # when
+    summary = Reprovisioner(provisioned.app_installations, provisioned, DEFINITIONS, concurrency=2, host_rate_limit=0).run()
+
+    # then
+    assert summary['created'] == 2
+    assert summary['failed'] == 2
+    assert list(provisioned.iter_missing(DEFINITIONS)) == [('shop-1.example.com', DEFINITIONS)]
+
+def test_payment_methods_the_shop_already_has_are_recorded_without_creating_them(monkeypatch):
+    # given
+    provisioned = ProvisionedPaymentMethods(_installations(2))
+    created = []
+    monkeypatch.setattr(reprovisioner, 'get_payment_method_definitions_in_use',
+                        lambda installation: set(DEFINITIONS[:1]) if installation.hostname == 'shop-0.example.com' else set())
+    def create_payment_method(installation, name):
+        created.append((installation.hostname, name))
+        return 409 if installation.hostname == 'shop-1.example.com' else 201
+    monkeypatch.setattr(reprovisioner, 'create_payment_method', create_payment_method)
+
+    # when
+    summary = Reprovisioner(provisioned.app_installations, provisioned, DEFINITIONS, concurrency=2, host_rate_limit=0).run()
+
+    # then
+    assert sorted(created) == [
+        ('shop-0.example.com', 'beautiful-test-payment-capture-on-demand'),
+        ('shop-1.example.com', 'beautiful-test-payment-capture-on-demand'),
+        ('shop-1.example.com', 'beautiful-test-payment-embedded')
+    ]
+    assert summary['created'] == 1
+    assert summary['existing'] == 3
+    assert list(provisioned.iter_missing(DEFINITIONS)) == []
+
+def test_failing_shops_are_backed_off(monkeypatch):
+    # given
+    provisioned = ProvisionedPaymentMethods(_installations(2), retry_backoff=3600)
+    def get_payment_method_definitions_in_use(installation):
+        if installation.hostname == 'shop-1.example.com':
+            raise IOError('Beyond unavailable')
+        return set()
+    monkeypatch.setattr(reprovisioner, 'get_payment_method_definitions_in_use', get_payment_method_definitions_in_use)
+    monkeypatch.setattr(reprovisioner, 'create_payment_method', lambda installation, name: 200)
+
+    # when
+    summary = Reprovisioner(provisioned.app_installations, provisioned, DEFINITIONS, concurrency=2, host_rate_limit=0).run()
+
+    # then
+    assert summary['shops_failed'] == 1
+    assert list(provisioned.iter_missing(DEFINITIONS)) == []
+    assert provisioned.failures['shop-1.example.com'][0] == 1
+
+class FakeMissingRowsPool(object):
+    """Answers MISSING_SQL from a list of hostnames lacking every definition
+    """
+    def __init__(self, hostnames):
+        self.hostnames = sorted(hostnames)
+        self.borrowed = 0
+        self.queries = []
+
+    @contextmanager
+    def connection(self):
+        self.borrowed += 1
+        try:
+            yield self
+        finally:
+            self.borrowed -= 1
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params):
+        names, after, now, limit = params
+        self.queries.append(after)
+        self.rows = [(hostname, names) for hostname in self.hostnames if hostname > after][:limit]
+
+    def fetchall(self):
+        return self.rows
+
+def test_missing_shops_are_read_in_batches_without_holding_a_connection():
+    # given
+    pool = FakeMissingRowsPool(['shop-%i.example.com' % i for i in range(5)])
+    provisioned = PostgresProvisionedPaymentMethods(None, pool=pool)
+
+    # when
+    borrowed_while_yielding = []
+    hostnames = []
+    for hostname, missing in provisioned.iter_missing(DEFINITIONS, batch_size=2):
+        borrowed_while_yielding.append(pool.borrowed)
+        hostnames.append(hostname)
+
+    # then
+    assert hostnames == pool.hostnames
+    assert borrowed_while_yielding == [0] * 5
+    assert pool.queries == ['', 'shop-1.example.com', 'shop-3.example.com']
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+
+import shops
+from shops import PostgresShops, Shop, Shops
+
+class RecordingPool(object):
+    """Records the statements run through execute_values, per borrowed connection
+    """
+    def __init__(self):
+        self.connections = []
+
+    @contextmanager
+    def connection(self):
+        self.connections.append([])
+        yield self
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+def _record_execute_values(pool):
+    def execute_values(curs, sql, rows, page_size=100):
+        pool.connections[-1].append((sql, list(rows), page_size))
+    return execute_values
+
+def test_upserted_shops_can_be_found():
+    # given
+    store = Shops()
+
+    # when
+    store.create_or_update_shop(Shop('shop-1', 'old.example.com'))
+    count = store.create_or_update_shops([Shop('shop-1', 'new.example.com'), Shop('shop-2', 'other.example.com')])
+
+    # then
+    assert count == 2
+    assert store.get_shop('shop-1').hostname == 'new.example.com'
+    assert store.get_shop('shop-2').hostname == 'other.example.com'
+    assert store.get_shop('shop-3') is None
+
+def test_shop_is_upserted_in_one_statement(monkeypatch):
+    # given
+    pool = RecordingPool()
+    monkeypatch.setattr(shops, 'execute_values', _record_execute_values(pool))
+
+    # when
+    PostgresShops(None, pool=pool).create_or_update_shop(Shop('shop-1', 'shop.example.com'))
+
+    # then
+    assert pool.connections == [[(PostgresShops.UPSERT_SQL, [('shop-1', 'shop.example.com')], 100)]]
+
+def test_shops_are_upserted_in_batches_in_one_transaction(monkeypatch):
+    # given
+    pool = RecordingPool()
+    monkeypatch.setattr(shops, 'execute_values', _record_execute_values(pool))
+    batch = [Shop('shop-1', 'old.example.com'), Shop('shop-2', 'b.example.com'), Shop('shop-1', 'new.example.com'), Shop('shop-3', 'c.example.com')]
+
+    # when
+    count = PostgresShops(None, pool=pool).create_or_update_shops(batch, page_size=3)
+
+    # then
+    assert count == 3
+    assert pool.connections == [[
+        (PostgresShops.UPSERT_SQL, [('shop-1', 'new.example.com'), ('shop-2', 'b.example.com')], 3),
+        (PostgresShops.UPSERT_SQL, [('shop-3', 'c.example.com')], 3)
+    ]]
@@ -1,8 +1,65 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from signers import sign
+from signers import Signer, sign, sign_token, verify_token
 
 def test_sign():
     signature = sign('Hello, unaltered message!', 'ha2e25nfmvo1dgeqsncd3nqsoj')
     assert signature == 'WJZWs4v/Vgru4X6hdKhI71TmhUM='
+
+def test_verify_token_returns_claims():
+    # given
+    token = sign_token({'shopId': 'shop-1', 'exp': 2000}, 'secret')
+
+    # when
+    claims = verify_token(token, 'secret', now=1000)
+
+    # then
+    assert claims == {'shopId': 'shop-1', 'exp': 2000}
+
+def test_verify_token_rejects_tampered_payload():
+    # given
+    token = sign_token({'shopId': 'shop-1', 'exp': 2000}, 'secret')
+    forged_payload = sign_token({'shopId': 'shop-2', 'exp': 2000}, 'other-secret').split('.')[0]
+
+    # when
+    claims = verify_token(forged_payload + '.' + token.split('.')[1], 'secret', now=1000)
+
+    # then
+    assert claims is None
+
+def test_verify_token_rejects_expired_token():
+    # given
+    token = sign_token({'shopId': 'shop-1', 'exp': 2000}, 'secret')
+
+    # then
+    assert verify_token(token, 'secret', now=2001) is None
+    assert verify_token('', 'secret') is None
+    assert verify_token('garbage', 'secret') is None
+
+def test_verify_token_rejects_non_ascii_signature():
+    # given
+    payload = sign_token({'shopId': 'shop-1', 'exp': 2000}, 'secret').split('.')[0]
+
+    # then
+    assert verify_token(payload + '.abc\u00fcx', 'secret', now=1000) is None
+    assert verify_token('\u00fc.abc', 'secret', now=1000) is None
+
+def test_signer_matches_sign():
+    # given
+    signer = Signer('ha2e25nfmvo1dgeqsncd3nqsoj')
+
+    # when
+    signatures = signer.sign_many(['Hello, unaltered message!', 'Hello, unaltered message!'])
+
+    # then
+    assert signatures == ['WJZWs4v/Vgru4X6hdKhI71TmhUM='] * 2
+
+def test_signer_verify():
+    # given
+    signer = Signer('ha2e25nfmvo1dgeqsncd3nqsoj', digest='sha256')
+    signature = signer.sign('message')
+
+    # then
+    assert signer.verify_many([('message', signature), ('message', 'forged'), ('message', None), ('message', 'ümlaut')]) == \
+        [True, False, False, False]
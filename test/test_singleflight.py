@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import pytest
+
+from singleflight import SingleFlight
+
+def test_concurrent_calls_share_one_execution():
+    # given
+    flight = SingleFlight()
+    release = threading.Event()
+    executions = []
+    results = []
+
+    def slow_refresh():
+        executions.append(1)
+        release.wait(timeout=5)
+        return 'token'
+
+    def caller():
+        results.append(flight.do('shop.example.com', slow_refresh))
+
+    # when
+    threads = [threading.Thread(target=caller) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    # then
+    assert results == ['token'] * 8
+    assert len(executions) == 1
+    assert flight.in_flight() == 0
+
+def test_waiting_callers_see_the_leaders_error():
+    # given
+    flight = SingleFlight()
+
+    def failing_refresh():
+        raise ValueError('refresh failed')
+
+    # then
+    with pytest.raises(ValueError):
+        flight.do('shop.example.com', failing_refresh)
+    assert flight.in_flight() == 0
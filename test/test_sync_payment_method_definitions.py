@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from payment_method_definitions import PaymentMethodDefinitionCatalog, read_json_file
+import sync_payment_method_definitions
+from sync_payment_method_definitions import CREATE, UPDATE, UNCHANGED, apply, diff, plan
+
+PATHS = ['test/beautiful-test-payment.json', 'test/beautiful-test-payment-sandbox.json']
+
+def test_diff_ignores_server_managed_attributes():
+    # given
+    local = read_json_file('test/beautiful-test-payment.json')
+    remote = dict(local, _links={'self': {'href': 'https://elsewhere.example.com'}}, defaultName='Renamed')
+
+    # when
+    changed = diff(local, remote)
+
+    # then
+    assert changed == ['defaultName']
+
+def test_plan_creates_missing_and_updates_changed_definitions():
+    # given
+    registered = dict(read_json_file(PATHS[0]), officialName='Outdated')
+    catalog = PaymentMethodDefinitionCatalog([registered])
+
+    # when
+    changes = plan(PATHS, catalog)
+
+    # then
+    assert [(change.definition_id, change.action) for change in changes] == [
+        ('beautiful-test-payment', UPDATE),
+        ('beautiful-test-payment-sandbox', CREATE)
+    ]
+    assert changes[0].changed_attributes == ['officialName']
+
+def test_apply_pushes_only_changes_and_records_failures(monkeypatch):
+    # given
+    catalog = PaymentMethodDefinitionCatalog([read_json_file(PATHS[0])])
+    changes = plan(PATHS, catalog)
+    pushed = []
+    def create(token, path):
+        pushed.append(path)
+        return {'error': 'conflict'}
+    monkeypatch.setattr(sync_payment_method_definitions, 'create_payment_method_definition', create)
+
+    # when
+    apply(changes, 'system-token', concurrency=2, rate_limit=0)
+
+    # then
+    assert pushed == [PATHS[1]]
+    assert changes[0].action == UNCHANGED and changes[0].error is None
+    assert changes[1].error.startswith('unexpected response')
+
+def test_apply_replaces_changed_definitions(monkeypatch):
+    # given
+    local = read_json_file(PATHS[0])
+    catalog = PaymentMethodDefinitionCatalog([dict(local, officialName='Outdated')])
+    changes = plan(PATHS[:1], catalog)
+    replaced = []
+    def update(token, definition):
+        replaced.append(definition)
+        return definition
+    monkeypatch.setattr(sync_payment_method_definitions, 'update_payment_method_definition', update)
+
+    # when
+    apply(changes, 'system-token', rate_limit=0)
+
+    # then
+    assert replaced == [local]
+    assert changes[0].action == UPDATE and changes[0].error is None
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+
+from app_installations import AppInstallations, Installation
+from token_refresher import TokenRefresher
+
+class RefreshingAppInstallations(AppInstallations):
+    def __init__(self):
+        super().__init__('client-id', 'client-secret')
+        self.refreshed = []
+
+    def _refresh_token(self, installation, session=None):
+        self.refreshed.append(installation.hostname)
+        self.create_or_update_installation(Installation(api_url=installation.api_url,
+                                                        access_token='new-access-token',
+                                                        refresh_token='refresh-token',
+                                                        expiry_date=datetime.now() + timedelta(hours=2)))
+
+def _installation(hostname, expires_in_minutes):
+    return Installation(api_url='https://%s/api' % hostname,
+                        access_token='access-token',
+                        refresh_token='refresh-token',
+                        expiry_date=datetime.now() + timedelta(minutes=expires_in_minutes))
+
+def test_run_once_refreshes_tokens_inside_horizon_only():
+    # given
+    installations = RefreshingAppInstallations()
+    installations.create_or_update_installation(_installation('soon.example.com', expires_in_minutes=25))
+    installations.create_or_update_installation(_installation('later.example.com', expires_in_minutes=90))
+    refresher = TokenRefresher(installations, horizon=1800, jitter=0)
+
+    # when
+    refreshed = refresher.run_once()
+
+    # then
+    assert refreshed == 1
+    assert installations.refreshed == ['soon.example.com']
+    assert installations.get_installation('soon.example.com').access_token == 'new-access-token'
+
+class FailingAppInstallations(RefreshingAppInstallations):
+    def _refresh_token(self, installation, session=None):
+        if installation.hostname == 'failing.example.com':
+            self.refreshed.append(installation.hostname)
+            raise IOError('invalid_grant')
+        super()._refresh_token(installation, session)
+
+def test_failed_refreshes_are_backed_off():
+    # given
+    installations = FailingAppInstallations()
+    installations.create_or_update_installation(_installation('failing.example.com', expires_in_minutes=20))
+    installations.create_or_update_installation(_installation('soon.example.com', expires_in_minutes=25))
+    refresher = TokenRefresher(installations, horizon=1800, jitter=0, batch_size=1, retry_backoff=3600)
+
+    # when
+    first = refresher.run_once()
+    second = refresher.run_once()
+
+    # then
+    assert (first, second) == (0, 1)
+    assert installations.refreshed == ['failing.example.com', 'soon.example.com']
+    assert installations.find_hostnames_expiring_within(timedelta(seconds=1800)) == []
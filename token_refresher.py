@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+'''
+Description:
+    Background job that refreshes access tokens before they expire, so
+    request handlers rarely have to.
+
+    Run standalone with `python token_refresher.py` or inside the web
+    process by setting TOKEN_REFRESHER_IN_PROCESS=true.
+'''
+
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from app_installations import Installation, PostgresAppInstallations
+import logs
+
+# Refresh tokens whose EXPIRY_DATE lies within this many seconds
+TOKEN_REFRESH_HORIZON = float(os.environ.get('TOKEN_REFRESH_HORIZON', '1800'))
+# Seconds between two scans of APP_INSTALLATIONS
+TOKEN_REFRESH_INTERVAL = float(os.environ.get('TOKEN_REFRESH_INTERVAL', '60'))
+TOKEN_REFRESH_CONCURRENCY = int(os.environ.get('TOKEN_REFRESH_CONCURRENCY', '4'))
+# Upper bound of the random delay before each refresh and each scan, in seconds
+TOKEN_REFRESH_JITTER = float(os.environ.get('TOKEN_REFRESH_JITTER', '5'))
+TOKEN_REFRESH_BATCH_SIZE = int(os.environ.get('TOKEN_REFRESH_BATCH_SIZE', '500'))
+# Seconds an installation is left out of the scans after a failed refresh,
+# doubling with every further failure, so failing ones don't fill every batch
+TOKEN_REFRESH_RETRY_BACKOFF = float(os.environ.get('TOKEN_REFRESH_RETRY_BACKOFF', '60'))
+TOKEN_REFRESH_MAX_RETRY_BACKOFF = float(os.environ.get('TOKEN_REFRESH_MAX_RETRY_BACKOFF', '3600'))
+
+LOGGER = logs.get_logger('token_refresher')
+
+class TokenRefresher(object):
+    def __init__(self, app_installations,
+                 horizon=TOKEN_REFRESH_HORIZON,
+                 interval=TOKEN_REFRESH_INTERVAL,
+                 concurrency=TOKEN_REFRESH_CONCURRENCY,
+                 jitter=TOKEN_REFRESH_JITTER,
+                 batch_size=TOKEN_REFRESH_BATCH_SIZE,
+                 retry_backoff=TOKEN_REFRESH_RETRY_BACKOFF,
+                 max_retry_backoff=TOKEN_REFRESH_MAX_RETRY_BACKOFF):
+        self.app_installations = app_installations
+        # Never refresh later than the request path would
+        self.horizon = max(timedelta(seconds=horizon), Installation.EXPIRY_MARGIN)
+        self.interval = interval
+        self.concurrency = concurrency
+        self.jitter = jitter
+        self.batch_size = batch_size
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self.run_forever, name='token-refresher', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def run_forever(self):
+        while not self._stopped.wait(self.interval + random.uniform(0, self.jitter)):
+            try:
+                self.run_once()
+            except Exception:
+                LOGGER.exception('Token refresh scan failed')
+
+    def run_once(self):
+        """Refresh all tokens expiring within the horizon. Returns the number of refreshed installations.
+        """
+        hostnames = self.app_installations.find_hostnames_expiring_within(self.horizon, self.batch_size)
+        if not hostnames:
+            return 0
+        LOGGER.info('Refreshing expiring tokens', count=len(hostnames))
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return sum(executor.map(self._refresh, hostnames))
+
+    def _refresh(self, hostname):
+        # Spread the token requests instead of hitting the OAuth endpoints in lockstep
+        if self._stopped.wait(random.uniform(0, self.jitter)):
+            return 0
+        try:
+            self.app_installations.refresh_installation(hostname, self.horizon)
+            return 1
+        except Exception as e:
+            LOGGER.warning('Refreshing token failed', hostname=hostname, error=str(e))
+            self.app_installations.record_refresh_failure(hostname, self.retry_backoff, self.max_retry_backoff)
+            return 0
+
+if __name__ == '__main__':
+    logs.setup()
+    app_installations = PostgresAppInstallations(os.environ.get('DATABASE_URL'),
+                                                 os.environ.get('CLIENT_ID', ''),
+                                                 os.environ.get('CLIENT_SECRET', ''))
+    TokenRefresher(app_installations).run_forever()